@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ${FILENAME}
+#  
+#  Copyright 2015 Anupam Mitra <anupam.mitra@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+
+"""
+Benchmarks of the stages of the spike sorting pipeline on synthetic
+recordings of increasing duration. Run them with
+
+    python -m benchmarks --durations 10 60 600 --output results.json
+
+and compare against a stored baseline with
+
+    python -m benchmarks --durations 10 60 600 --output results.json \
+        --compare baseline.json
+"""
+
+from .pipeline import STAGES, benchmark_stages, run_benchmarks, \
+    compare_results, load_results, save_results
+
+__all__ = ["STAGES", "benchmark_stages", "run_benchmarks", \
+    "compare_results", "load_results", "save_results"]
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ${FILENAME}
+#  
+#  Copyright 2015 Anupam Mitra <anupam.mitra@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+
+import argparse
+import sys
+
+from .pipeline import STAGES, run_benchmarks, compare_results, \
+    load_results, save_results
+
+def _format_bytes (n_bytes):
+    if n_bytes is None:
+        return '-'
+    return '%.1f MB' % (n_bytes / 2.0**20)
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', \
+        description='Benchmarks the stages of the spike sorting pipeline '
+            'on synthetic recordings')
+    parser.add_argument('--durations', type=float, nargs='+', \
+        default=[10.0, 60.0], help='durations of the recordings in seconds')
+    parser.add_argument('--spike-rate', type=float, default=20.0)
+    parser.add_argument('--units', type=int, default=3)
+    parser.add_argument('--noise', type=float, default=0.1)
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--feature-extraction', default='hw')
+    parser.add_argument('--features', type=int, default=10)
+    parser.add_argument('--dtype', default='float64', \
+        help='floating point type of the recording, waveforms and features')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', \
+        help='do not trace the peak memory of each stage')
+    parser.add_argument('--output', help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON file of baseline results')
+    parser.add_argument('--time-tolerance', type=float, default=0.2)
+    parser.add_argument('--memory-tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+    
+    results = run_benchmarks(args.durations, repeat=args.repeat, \
+        trace_memory=not args.no_memory, spike_rate_Hz=args.spike_rate, \
+        n_units=args.units, noise_level=args.noise, \
+        n_channels=args.channels, \
+        feature_extraction=args.feature_extraction, \
+        n_features=args.features, dtype=args.dtype)
+    
+    for benchmark in results['benchmarks']:
+        print('%g s, %d spikes' % (benchmark['duration_s'], benchmark['n_spikes']))
+        for name, stage in STAGES:
+            s = benchmark['stages'][name]
+            print('  %-8s %9.4f s wall %9.4f s cpu %12s peak' % \
+                (name, s['t_wall'], s['t_cpu'], _format_bytes(s['peak_bytes'])))
+    
+    if args.output:
+        save_results(results, args.output)
+    
+    if args.compare:
+        comparisons = compare_results(results, load_results(args.compare), \
+            args.time_tolerance, args.memory_tolerance)
+        regressions = [c for c in comparisons if c['regression']]
+        for c in regressions:
+            print('REGRESSION %g s %s %s: %.4g -> %.4g (x%.2f)' % \
+                (c['duration_s'], c['stage'], c['metric'], \
+                c['baseline'], c['value'], c['ratio']))
+        if not comparisons:
+            print('No benchmarks in common with the baseline')
+        elif not regressions:
+            print('No regressions against the baseline')
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
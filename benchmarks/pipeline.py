@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ${FILENAME}
+#  
+#  Copyright 2015 Anupam Mitra <anupam.mitra@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+
+import json
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+
+import spikesort
+from spikesort import spikedetect
+from spikesort.cluster import euclidean
+from spikesort.features import featureselect, raw
+from datasets import synthetic
+
+def _filter (state):
+    recording = state['recording']
+    recording.frequency_band_filter(chunk_size=2**20, keep_raw=False)
+    return recording.data
+
+def _detect (state):
+    # Detections are kept apart from the ground truth times of the recording
+    data = state['recording'].data
+    if data.ndim > 1:
+        spike_table = spikedetect.detect_spikes_multichannel(\
+            data, chunk_size=2**20)
+        state['t_detect'] = spike_table['t']
+        state['spike_channels'] = spike_table['channel']
+        return spike_table
+    state['t_detect'] = spikedetect.detect_spikes(data, chunk_size=2**20)
+    return state['t_detect']
+
+def _extract (state):
+    # Waveforms are extracted at the ground truth times, so that the later
+    # stages see the same number of spikes whatever the detector finds
+    recording = state['recording']
+    state['waveforms'] = raw.extract_waveforms(recording.t_spikes, \
+        recording.data, state['samples_before'], state['samples_after'], \
+        edges='drop', dtype=recording.float_dtype)
+    return state['waveforms']
+
+def _feature (state):
+    state['features'] = spikesort.features.extract_features(\
+        state['waveforms'], state['feature_extraction'])
+    return state['features']
+
+def _select (state):
+    index_features = featureselect.kstestnormal(state['features'])
+    state['selected'] = state['features'][:, index_features[:state['n_features']]]
+    return state['selected']
+
+def _cluster (state):
+    return euclidean.kmeans(state['selected'], state['n_units'])
+
+STAGES = [\
+    ('filter', _filter), ('detect', _detect), ('extract', _extract), \
+    ('feature', _feature), ('select', _select), ('cluster', _cluster)]
+
+def _size (result):
+    if isinstance(result, tuple):
+        return sum(_size(r) for r in result)
+    return int(getattr(result, 'nbytes', 0))
+
+def _run_stages (params, trace_memory):
+    state = dict(params)
+    state['recording'] = synthetic.generate_recording(\
+        params['duration_s'], params['fs_Hz'], params['spike_rate_Hz'], \
+        params['n_units'], params['noise_level'], params['n_channels'], \
+        seed=params['seed'], dtype=np.dtype(params['dtype']))
+    
+    results = {}
+    for name, stage in STAGES:
+        if trace_memory:
+            tracemalloc.start()
+        t_wall = time.perf_counter()
+        t_cpu = time.process_time()
+        output = stage(state)
+        t_cpu = time.process_time() - t_cpu
+        t_wall = time.perf_counter() - t_wall
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            peak = None
+        results[name] = {\
+            't_wall': t_wall, 't_cpu': t_cpu, 'peak_bytes': peak, \
+            'output_bytes': _size(output)}
+    results['n_spikes'] = int(state['recording'].t_spikes.shape[0])
+    return results
+
+def benchmark_stages (duration_s, fs_Hz=24e3, spike_rate_Hz=20.0, \
+                      n_units=3, noise_level=0.1, n_channels=1, \
+                      feature_extraction='hw', n_features=10, \
+                      samples_before=20, samples_after=44, \
+                      repeat=3, trace_memory=True, seed=0, dtype='float64'):
+    """
+    Times every stage of the pipeline on a synthetic recording
+    
+    Parameters
+    ----------
+    duration_s : float
+        Duration of the synthetic recording in seconds
+        
+    fs_Hz, spike_rate_Hz, n_units, noise_level, n_channels : 
+        Parameters of the synthetic recording, as for
+        datasets.synthetic.generate_recording
+        
+    feature_extraction : str
+        Feature extraction technique, as for SpikeSorting
+        
+    n_features : int
+        Number of features to select and cluster
+        
+    samples_before, samples_after : int
+        Window around the peak of each spike
+        
+    repeat : int
+        Number of timed runs. The fastest time of each stage is kept.
+        
+    trace_memory : bool
+        Whether to make one more run under tracemalloc for the peak memory
+        of each stage. The times of this run are not used, as tracing slows
+        down allocations.
+        
+    seed : int
+        Seed of the synthetic recording
+        
+    dtype : str
+        Floating point type of the recording, waveforms and features
+        
+    Returns
+    -------
+    result : dict
+        The parameters, and for each stage in 'stages' the wall clock time
+        t_wall and processor time t_cpu in seconds, the peak traced memory
+        peak_bytes and the size of the output output_bytes
+    """
+    params = {\
+        'duration_s': duration_s, 'fs_Hz': fs_Hz, \
+        'spike_rate_Hz': spike_rate_Hz, 'n_units': n_units, \
+        'noise_level': noise_level, 'n_channels': n_channels, \
+        'feature_extraction': feature_extraction, 'n_features': n_features, \
+        'samples_before': samples_before, 'samples_after': samples_after, \
+        'seed': seed, 'dtype': np.dtype(dtype).name}
+    
+    runs = [_run_stages(params, False) for r in range(repeat)]
+    stages = {}
+    for name, stage in STAGES:
+        stages[name] = {\
+            't_wall': min(run[name]['t_wall'] for run in runs), \
+            't_cpu': min(run[name]['t_cpu'] for run in runs), \
+            'peak_bytes': None, \
+            'output_bytes': runs[0][name]['output_bytes']}
+    if trace_memory:
+        traced = _run_stages(params, True)
+        for name, stage in STAGES:
+            stages[name]['peak_bytes'] = traced[name]['peak_bytes']
+    
+    result = dict(params)
+    result['n_spikes'] = runs[0]['n_spikes'] if runs else None
+    result['stages'] = stages
+    return result
+
+def run_benchmarks (durations, repeat=3, trace_memory=True, **kwargs):
+    """
+    Runs benchmark_stages for recordings of several durations
+    
+    Parameters
+    ----------
+    durations : list
+        Durations of the synthetic recordings in seconds
+        
+    repeat, trace_memory :
+        As for benchmark_stages
+        
+    kwargs :
+        Other parameters of benchmark_stages
+        
+    Returns
+    -------
+    results : dict
+        Description of the machine and versions in 'environment' and the
+        result of each benchmark in 'benchmarks'
+    """
+    environment = {\
+        'python': platform.python_version(), 'numpy': np.__version__, \
+        'machine': platform.machine(), 'processor': platform.processor(), \
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    benchmarks = [\
+        benchmark_stages(duration_s, repeat=repeat, \
+            trace_memory=trace_memory, **kwargs) \
+        for duration_s in durations]
+    return {'environment': environment, 'benchmarks': benchmarks}
+
+def save_results (results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+def load_results (path):
+    with open(path) as f:
+        return json.load(f)
+
+def _benchmark_key (benchmark):
+    return tuple(benchmark[k] for k in sorted(benchmark) \
+        if k not in ('stages', 'n_spikes'))
+
+def compare_results (results, baseline, time_tolerance=0.2, \
+                     memory_tolerance=0.2, min_time=0.01):
+    """
+    Compares benchmark results against a baseline
+    
+    Parameters
+    ----------
+    results : dict
+        Results of run_benchmarks
+        
+    baseline : dict
+        Earlier results of run_benchmarks with the same parameters
+        
+    time_tolerance : float
+        Relative increase of the wall clock time of a stage over the
+        baseline which counts as a regression
+        
+    memory_tolerance : float
+        Relative increase of the peak memory of a stage over the baseline
+        which counts as a regression
+        
+    min_time : float
+        Stages faster than this in seconds, in both runs, are not compared
+        for time, as their times are mostly noise
+        
+    Returns
+    -------
+    comparisons : list
+        For every stage of every benchmark present in both, a dict with
+        duration_s, stage, metric, baseline, value, ratio and regression
+    """
+    baseline_benchmarks = dict(\
+        (_benchmark_key(b), b) for b in baseline['benchmarks'])
+    comparisons = []
+    for benchmark in results['benchmarks']:
+        reference = baseline_benchmarks.get(_benchmark_key(benchmark))
+        if reference is None:
+            continue
+        for name, stage in STAGES:
+            if name not in benchmark['stages'] or \
+                name not in reference['stages']:
+                continue
+            new = benchmark['stages'][name]
+            old = reference['stages'][name]
+            for metric, tolerance in (('t_wall', time_tolerance), \
+                                      ('peak_bytes', memory_tolerance)):
+                if new[metric] is None or old[metric] is None:
+                    continue
+                if metric == 't_wall' and max(new[metric], old[metric]) < min_time:
+                    continue
+                ratio = new[metric] / old[metric] if old[metric] else np.inf
+                comparisons.append({\
+                    'duration_s': benchmark['duration_s'], 'stage': name, \
+                    'metric': metric, 'baseline': old[metric], \
+                    'value': new[metric], 'ratio': ratio, \
+                    'regression': bool(ratio > 1.0 + tolerance)})
+    return comparisons
@@ -22,8 +22,9 @@
 #  
 #  
 
-import cpgjnmdata, waveclusdata
+from . import cpgjnmdata, synthetic, waveclusdata
+from .index import DatasetIndex
 
-__all__ = ["waveclusdata", "cpgjnmdata"]
+__all__ = ["waveclusdata", "cpgjnmdata", "synthetic", "DatasetIndex"]
 
 
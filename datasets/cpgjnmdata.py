@@ -22,6 +22,7 @@
 #  
 #  
 
+import functools
 import numpy as np
 import os
 import re
@@ -29,10 +30,94 @@ import scipy.io
 
 from spikesort.signals import Recording
 
+FS_HZ = 24e3
+
+def list_files (datadir):
+     """
+     Lists the simulation files of the CPGJNM 2012 dataset in a directory
+
+     Parameters
+     ----------
+     datadir : str
+     The directory where the files are present
+     """
+     return sorted(f for f in os.listdir(datadir) \
+          if f.endswith('.mat') and f != 'ground_truth.mat' \
+               and re.search('[0-9]+', f))
+
+def _sim_num (filename):
+     return int(re.findall('[0-9]+', filename)[0])
+
+@functools.lru_cache(maxsize=8)
+def _load_ground_truth (path, mtime):
+     # The modification time is part of the cache key so that a changed
+     # file is parsed again
+     w = scipy.io.loadmat(path, \
+          variable_names=['spike_classes', 'spike_first_sample'])
+     return w['spike_classes'][0], w['spike_first_sample'][0]
+
+def read_ground_truth (filename, datadir):
+     """
+     Reads the ground truth of a file from the CPGJNM 2012 dataset. The
+     ground truth of the whole dataset is parsed only once.
+
+     Parameters
+     ----------
+     filename : str
+     The name of the file
+
+     datadir : str
+     The directory where the file is present
+
+     Returns
+     -------
+     spike_times : ndarray
+     Times of the spikes, in samples
+
+     spike_class : ndarray
+     Classes of the spikes
+     """
+     path = os.path.join(datadir, 'ground_truth.mat')
+     spike_classes, spike_first_sample = \
+          _load_ground_truth(path, os.path.getmtime(path))
+     sim_num = _sim_num(filename)
+     spike_class = spike_classes[sim_num - 1][0].copy()
+     spike_times = spike_first_sample[sim_num - 1][0] + 20
+     return spike_times, spike_class
+
+def read_metadata (filename, datadir):
+     """
+     Reads the metadata of a file from the CPGJNM 2012 dataset without
+     reading the recording
+
+     Parameters
+     ----------
+     filename : str
+     The name of the file
+
+     datadir : str
+     The directory where the file is present
+
+     Returns
+     -------
+     metadata : dict
+     Number of spikes 'n_spikes', number of distinct spike classes
+     'n_classes', sampling frequency 'fs_Hz' and noise level
+     'noise_level', which is None as it is not recorded in this dataset
+     """
+     spike_times, spike_class = read_ground_truth(filename, datadir)
+     metadata = {
+          'n_spikes': int(spike_times.shape[0]),
+          'n_classes': int(np.unique(spike_class).shape[0]),
+          'fs_Hz': FS_HZ,
+          'noise_level': None,
+     }
+     return metadata
+
 def get_n_classes (filename, datadir):
      """
      Gets the number of spike classes in a file from the the CPGJNM 2012 dataset
-
+     
      Parameters
      ----------
      filename : str
@@ -41,8 +126,8 @@ def get_n_classes (filename, datadir):
      datadir : str
      The directory where the file is present
      """
-     recording_raw, sampling_interval, spike_times, spike_class = read_file(filename, datadir)
-     num_classes = np.max(np.unique(spike_class))
+     spike_times, spike_class = read_ground_truth(filename, datadir)
+     num_classes = np.unique(spike_class).shape[0]
      return num_classes
      
 def get_n_spikes (filename, datadir):
@@ -57,7 +142,7 @@ def get_n_spikes (filename, datadir):
      datadir : str
      The directory where the file is present
      """
-     recording_raw, sampling_interval, spike_times, spike_class = read_file(filename, datadir)
+     spike_times, spike_class = read_ground_truth(filename, datadir)
      num_classes = spike_times.shape[0]
      return num_classes
 
@@ -74,13 +159,10 @@ def read_file (filename, datadir):
      The directory where the file is present
      """
      
-     w = scipy.io.loadmat(os.path.join(datadir, filename))
+     w = scipy.io.loadmat(os.path.join(datadir, filename), variable_names=['data'])
      data = w['data'][0]
-     fs_Hz = 24e3
-     w = scipy.io.loadmat(os.path.join(datadir, 'ground_truth.mat'))
-     sim_num = int(re.findall('[0-9]+', filename)[0])
-     spike_class = w['spike_classes'][0][sim_num - 1][0]
-     spike_times = w['spike_first_sample'][0][sim_num - 1][0] + 20
+     fs_Hz = FS_HZ
+     spike_times, spike_class = read_ground_truth(filename, datadir)
 
      recording = Recording(data, fs_Hz, spike_times, spike_class)
      setattr(recording, 'simulation_name', filename.replace('.mat', ''))
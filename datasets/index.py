@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ${FILENAME}
+#  
+#  Copyright 2015 Anupam Mitra <anupam.mitra@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+
+import json
+import os
+
+from . import cpgjnmdata, waveclusdata
+
+DATASETS = {
+    'waveclus': waveclusdata,
+    'cpgjnm': cpgjnmdata,
+}
+
+INDEX_FILENAME = '.spikesort_index.json'
+
+# Part of the stamp of each entry, increased when the metadata read from
+# files changes so that older entries are read again
+INDEX_VERSION = 1
+
+class DatasetIndex:
+    """
+    Index of the metadata of the files of a dataset directory. The metadata
+    of each file is read once, without reading the recording, and kept in a
+    small sidecar file in the directory, so that later queries do not open
+    the data files at all. Entries are refreshed when a file changes.
+    
+    Parameters
+    ----------
+    datadir : str
+        The directory where the files are present
+        
+    dataset : str or module
+        The dataset, 'waveclus' or 'cpgjnm', or a module providing
+        list_files and read_metadata
+        
+    index_path : str
+        Path of the sidecar index. If None, it is stored in datadir.
+    """
+    def __init__ (self, datadir, dataset, index_path=None):
+        self.datadir = datadir
+        self.dataset = DATASETS[dataset] if isinstance(dataset, str) else dataset
+        if index_path is None:
+            index_path = os.path.join(datadir, INDEX_FILENAME)
+        self.index_path = index_path
+        self.entries = {}
+        self._modified = False
+        if os.path.isfile(index_path):
+            try:
+                with open(index_path) as f:
+                    self.entries = json.load(f)
+            except (IOError, OSError, ValueError):
+                self.entries = {}
+                
+    def _stamp (self, filename):
+        stat = os.stat(os.path.join(self.datadir, filename))
+        return [stat.st_mtime, stat.st_size, INDEX_VERSION]
+        
+    def files (self):
+        """
+        Names of the files of the dataset
+        """
+        return self.dataset.list_files(self.datadir)
+        
+    def metadata (self, filename):
+        """
+        Metadata of a file, read from the index when it is up to date
+        
+        Parameters
+        ----------
+        filename : str
+            The name of the file
+            
+        Returns
+        -------
+        metadata : dict
+            Number of spikes 'n_spikes', number of classes 'n_classes',
+            sampling frequency 'fs_Hz' and noise level 'noise_level'
+        """
+        stamp = self._stamp(filename)
+        entry = self.entries.get(filename)
+        if entry is None or entry['stamp'] != stamp:
+            entry = {'stamp': stamp, \
+                'metadata': self.dataset.read_metadata(filename, self.datadir)}
+            self.entries[filename] = entry
+            self._modified = True
+        return entry['metadata']
+        
+    def n_spikes (self, filename):
+        return self.metadata(filename)['n_spikes']
+        
+    def n_classes (self, filename):
+        return self.metadata(filename)['n_classes']
+        
+    def fs_Hz (self, filename):
+        return self.metadata(filename)['fs_Hz']
+        
+    def noise_level (self, filename):
+        return self.metadata(filename)['noise_level']
+        
+    def build (self):
+        """
+        Brings the metadata of every file of the dataset up to date and
+        saves the index.
+        
+        Returns
+        -------
+        table : dict
+            Metadata of each file, by file name
+        """
+        table = dict((f, self.metadata(f)) for f in self.files())
+        self.save()
+        return table
+        
+    def save (self):
+        """
+        Writes the index to its sidecar file if it changed. A directory
+        which cannot be written to leaves the index in memory only.
+        """
+        if not self._modified:
+            return
+        path_tmp = self.index_path + '.tmp'
+        try:
+            with open(path_tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(path_tmp, self.index_path)
+        except (IOError, OSError):
+            return
+        self._modified = False
+
+__all__ = ["DatasetIndex"]
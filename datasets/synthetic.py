@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ${FILENAME}
+#  
+#  Copyright 2015 Anupam Mitra <anupam.mitra@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+
+import numpy as np
+import scipy.signal
+
+from spikesort.signals import Recording
+
+def spike_templates (n_units, n_samples=48, rng=None):
+    """
+    Generates random spike shapes, each a positive peak followed by a
+    slower after-hyperpolarization, with a peak amplitude of one.
+    
+    Parameters
+    ----------
+    n_units : int
+        Number of spike shapes
+        
+    n_samples : int
+        Number of samples in each shape
+        
+    rng : numpy.random.Generator
+        Random number generator
+        
+    Returns
+    -------
+    templates : ndarray
+        The shapes, of shape (n_units, n_samples), peaking at sample
+        n_samples // 4
+    """
+    rng = np.random.default_rng(rng)
+    t = np.arange(n_samples)[np.newaxis, :]
+    t_peak = n_samples // 4
+    width = rng.uniform(1.5, 4.0, (n_units, 1))
+    ahp_amplitude = rng.uniform(0.2, 0.6, (n_units, 1))
+    ahp_delay = rng.uniform(4.0, 10.0, (n_units, 1))
+    ahp_width = rng.uniform(3.0, 8.0, (n_units, 1))
+    templates = np.exp(-0.5 * ((t - t_peak) / width) ** 2) - \
+        ahp_amplitude * np.exp(-0.5 * ((t - t_peak - ahp_delay) / ahp_width) ** 2)
+    templates /= templates[:, t_peak : t_peak + 1]
+    return templates
+
+def generate_recording (duration_s=10.0, fs_Hz=24e3, spike_rate_Hz=20.0, \
+                        n_units=3, noise_level=0.1, n_channels=1, \
+                        refractory_s=2e-3, seed=0, dtype=np.float64):
+    """
+    Generates a synthetic recording in the style of the wave_clus
+    simulations: spike trains of several units with known times and
+    classes, added to band limited background noise.
+    
+    Parameters
+    ----------
+    duration_s : float
+        Duration of the recording in seconds
+        
+    fs_Hz : float
+        The sampling frequency in Hz
+        
+    spike_rate_Hz : float
+        Mean firing rate of each unit in Hz
+        
+    n_units : int
+        Number of units
+        
+    noise_level : float
+        Standard deviation of the noise relative to the spike amplitude
+        
+    n_channels : int
+        Number of channels. Each unit has its own amplitude on each channel.
+        
+    refractory_s : float
+        Shortest interval between spikes of a unit, in seconds
+        
+    seed : int
+        Seed of the random number generator
+        
+    dtype : dtype
+        Data type of the recording, which is also its float_dtype
+        
+    Returns
+    -------
+    recording : Recording
+        The recording, with the times t_spikes of the peaks of the spikes,
+        their classes spike_class (from 1 to n_units) and, for more than
+        one channel, the channel of largest amplitude spike_channels
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = int(duration_s * fs_Hz)
+    templates = spike_templates(n_units, rng=rng)
+    template_len = templates.shape[1]
+    t_peak = template_len // 4
+    
+    # Spike trains: exponential intervals after a refractory period
+    t_spikes = []
+    spike_class = []
+    refractory = int(refractory_s * fs_Hz)
+    for unit in range(n_units):
+        n_expected = int(1.2 * duration_s * spike_rate_Hz) + 10
+        intervals = refractory + rng.exponential(fs_Hz / spike_rate_Hz, n_expected)
+        t_unit = np.cumsum(intervals).astype(np.int64)
+        t_unit = t_unit[t_unit < n_samples - template_len]
+        t_spikes.append(t_unit)
+        spike_class.append(np.full(t_unit.shape[0], unit + 1))
+    t_spikes = np.concatenate(t_spikes)
+    spike_class = np.concatenate(spike_class)
+    order = np.argsort(t_spikes, kind='stable')
+    t_spikes = t_spikes[order]
+    spike_class = spike_class[order]
+    
+    # Band limited noise
+    sos = scipy.signal.butter(4, 5000.0 / (fs_Hz / 2.0), output='sos')
+    noise = scipy.signal.sosfilt(sos, rng.standard_normal((n_channels, n_samples)), axis=-1)
+    noise *= noise_level / np.std(noise[..., :min(n_samples, 2**20)])
+    data = noise.astype(dtype)
+    
+    # Each unit has an amplitude on each channel, largest on one channel
+    gains = rng.uniform(0.1, 0.5, (n_units, n_channels))
+    gains[np.arange(n_units), rng.integers(0, n_channels, n_units)] = 1.0
+    index = t_spikes[:, np.newaxis] + np.arange(template_len)
+    for c in range(n_channels):
+        np.add.at(data[c], index, \
+            (gains[spike_class - 1, c][:, np.newaxis] * templates[spike_class - 1]).astype(dtype))
+    
+    t_spikes = t_spikes + t_peak
+    if n_channels == 1:
+        recording = Recording(data[0], fs_Hz, t_spikes, spike_class, float_dtype=dtype)
+    else:
+        recording = Recording(data, fs_Hz, t_spikes, spike_class, float_dtype=dtype)
+        setattr(recording, 'spike_channels', np.argmax(gains, axis=1)[spike_class - 1])
+    setattr(recording, 'templates', templates)
+    setattr(recording, 'noise_level', noise_level)
+    return recording
+
+__all__ = ["generate_recording", "spike_templates"]
@@ -56,6 +56,111 @@ def parse_filename (filename):
     
     return example_name, example_noise
 
+def list_files (datadir):
+    """
+    Lists the files of the wave_clus 2012 dataset in a directory
+    
+    Parameters
+    ----------
+    datadir : str
+        The directory where the files are present
+    """
+    return sorted(f for f in os.listdir(datadir) \
+        if f.endswith('.mat') and re.search('C_(.*)_noise([0-9]+)', f))
+
+def read_ground_truth (filename, datadir):
+    """
+    Reads the ground truth of a file from the wave_clus 2012 dataset,
+    without reading the recording
+    
+    Parameters
+    ----------
+    filename : str
+        The name of the file to read
+
+    datadir : str
+        The directory where the file is present
+        
+    Returns
+    -------
+    spike_times : ndarray
+        Times of the spikes, in samples
+        
+    spike_class : ndarray
+        Classes of the spikes
+        
+    fs_Hz : float
+        The sampling frequency in Hz
+    """
+    w = scipy.io.loadmat(os.path.join(datadir, filename), \
+        variable_names=['samplingInterval', 'spike_times', 'spike_class'])
+    sampling_interval = w['samplingInterval'][0][0] 
+    spike_times = w['spike_times'][0, 0][0] + 21
+    spike_class = w['spike_class'][0, 0][0]
+    fs_Hz = 1000/sampling_interval
+    return spike_times, spike_class, fs_Hz
+
+def read_metadata (filename, datadir):
+    """
+    Reads the metadata of a file from the wave_clus 2012 dataset without
+    reading the recording
+    
+    Parameters
+    ----------
+    filename : str
+        The name of the file
+
+    datadir : str
+        The directory where the file is present
+        
+    Returns
+    -------
+    metadata : dict
+        Number of spikes 'n_spikes', number of distinct spike classes
+        'n_classes', sampling frequency 'fs_Hz' and noise level
+        'noise_level'
+    """
+    spike_times, spike_class, fs_Hz = read_ground_truth(filename, datadir)
+    example_name, example_noise = parse_filename(filename)
+    metadata = {
+        'n_spikes': int(spike_times.shape[0]),
+        'n_classes': int(np.unique(spike_class).shape[0]),
+        'fs_Hz': float(fs_Hz),
+        'noise_level': example_noise,
+    }
+    return metadata
+
+def get_n_classes (filename, datadir):
+    """
+    Gets the number of spike classes in a file from the wave_clus 2012
+    dataset
+    
+    Parameters
+    ----------
+    filename : str
+        The name of the file to read
+
+    datadir : str
+        The directory where the file is present
+    """
+    spike_times, spike_class, fs_Hz = read_ground_truth(filename, datadir)
+    return np.unique(spike_class).shape[0]
+
+def get_n_spikes (filename, datadir):
+    """
+    Gets the number of spikes in a file from the wave_clus 2012 dataset
+    
+    Parameters
+    ----------
+    filename : str
+        The name of the file to read
+
+    datadir : str
+        The directory where the file is present
+    """
+    spike_times, spike_class, fs_Hz = read_ground_truth(filename, datadir)
+    return spike_times.shape[0]
+
 def read_file (filename, datadir):
     """
     Reads a file from the wave_clus 2012 dataset
@@ -68,7 +173,8 @@ def read_file (filename, datadir):
     datadir : str
     The directory where the file is present
     """
-    w = scipy.io.loadmat(os.path.join(datadir, filename))
+    w = scipy.io.loadmat(os.path.join(datadir, filename), variable_names=\
+        ['data', 'samplingInterval', 'spike_times', 'spike_class'])
     data = w['data'][0]
     sampling_interval = w['samplingInterval'][0][0] 
     spike_times = w['spike_times'][0, 0][0] + 21
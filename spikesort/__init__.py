@@ -22,9 +22,25 @@
 #  
 #  
 
-import cluster
-import features
-import signals
+from . import batch
+from . import cache
+from . import cluster
+from . import evaluate
+from . import features
+from . import instrument
+from . import online
+from . import signals
+from . import spikedetect
+from . import store
+from . import sweep
+
+class _Same:
+    # Stage key part equal only to a part holding the same object
+    def __init__ (self, obj):
+        self.obj = obj
+        
+    def __eq__ (self, other):
+        return isinstance(other, _Same) and other.obj is self.obj
 
 class SpikeSorting:
     """
@@ -63,13 +79,39 @@ class SpikeSorting:
         Number of features to use for clustering.
         
     feature_clustering:
-        Clustering algorithm to use for clustering. Currently only 'kMeans'
-        is supported
+        Clustering algorithm to use for clustering. Currently 'kMeans',
+        'miniBatchKMeans' and 'density' are supported
+        
+    cache: FeatureCache
+        Optional on disk cache of waveforms and features, shared between
+        runs over the same recording
+        
+    instrumentation: Instrumentation
+        If given, the time, memory and output sizes of the stages 'detect',
+        'waveforms', 'features', 'selection' and 'clustering' are recorded
+        in it
+        
+    float_dtype: dtype
+        Floating point type of the waveforms and features, for instance
+        np.float32 to halve their memory. If None, the float_dtype of the
+        recording is used.
+        
+    n_clusters:
+        Number of clusters, an int, 'auto' to choose it, or None to take it
+        from the ground truth spike_class of the recording when present and
+        choose it otherwise, see SpikeFeatureClustering
+        
+    selection_max_samples:
+        For 'lt' selection, number of spikes of the random subsample on
+        which features are ranked when there are more, or None to use all
+        spikes, see SpikeFeatures
     
     """
     
     def __init__ (self, recording, feature_extraction, feature_selection, \
-        feature_clustering, n_features, samples_before=20, samples_after=44):
+        feature_clustering, n_features, samples_before=20, samples_after=44, \
+        cache=None, instrumentation=None, float_dtype=None, n_clusters=None, \
+        selection_max_samples=None):
         self.recording = recording
         self.feature_extraction = feature_extraction
         self.feature_selection = feature_selection
@@ -77,23 +119,163 @@ class SpikeSorting:
         self.n_features = n_features
         self.samples_before = samples_before
         self.samples_after = samples_after
+        self.cache = cache
+        self.float_dtype = float_dtype
+        self.n_clusters = n_clusters
+        self.selection_max_samples = selection_max_samples
+        if instrumentation is None:
+            instrumentation = instrument.NULL_INSTRUMENTATION
+        self.instrumentation = instrumentation
+        self._stage_memo = {}
+        self.recomputed = []
+        
+    STAGES = ('detect', 'waveforms', 'features', 'selection', 'clustering')
+    STAGE_OUTPUTS = {'detect': 't_spikes', 'waveforms': 'spike_waveforms', \
+        'features': 'features', 'selection': 'features_selected', \
+        'clustering': 'spike_class_est'}
+    
+    def _stage_key (self, name):
+        # Parameters a stage depends on. Arrays are compared by identity.
+        recording = self.recording
+        if name == 'detect':
+            return (_Same(recording.data), self.samples_before, \
+                self.samples_after)
+        elif name == 'waveforms':
+            return (_Same(recording.data), getattr(recording, 'gain', 1.0), \
+                _Same(recording.t_spikes), \
+                _Same(getattr(recording, 'spike_channels', None)), \
+                self.samples_before, self.samples_after, \
+                self.float_dtype, _Same(self.cache))
+        elif name == 'features':
+            return (self.feature_extraction.lower(),)
+        elif name == 'selection':
+            if self.feature_selection.lower() == 'pca':
+                return (self.feature_selection.lower(), self.n_features)
+            elif self.feature_selection.lower() == 'lt':
+                return (self.feature_selection.lower(), \
+                    self.selection_max_samples)
+            return (self.feature_selection.lower(),)
+        else:
+            return (self.n_features, self.feature_clustering.lower(), \
+                self.n_clusters, _Same(getattr(recording, 'spike_class', None)))
+        
+    def invalidate (self, stage=None):
+        """
+        Forgets the outputs of a stage and of the stages after it, or of
+        every stage if stage is None, so that they are recomputed by the
+        next spike_sorting.
+        """
+        first = 0 if stage is None else self.STAGES.index(stage)
+        for name in self.STAGES[first:]:
+            self._stage_memo.pop(name, None)
+        
+    def _is_current (self, name, key):
+        memo = self._stage_memo
+        if name == 'detect':
+            detected = memo.get('detect')
+            t_spikes = getattr(self.recording, 't_spikes', None)
+            if t_spikes is not None and \
+                    (detected is None or t_spikes is not detected[1]):
+                # Spike times were given with the recording
+                return True
+            return detected is not None and detected[0] == key
+        return name in memo and memo[name][0] == key
         
     def spike_sorting (self):
-        if not hasattr(self.recording, "t_spikes"):
-            # TODO Need to detect spikes
-            pass
+        """
+        Runs the stages of spike sorting: detect (when the recording has no
+        spike times, or its data changed since they were detected),
+        waveforms, features, selection and clustering. The output of each
+        stage is kept together with the parameters it depends on, and a
+        stage runs again only when these change or an earlier stage ran
+        again. So after changing, say, n_features with 'var' selection, only
+        clustering is recomputed. The stages which ran are listed in
+        recomputed.
+        """
+        stage = self.instrumentation.stage
+        self.recomputed = []
+        
+        for name in self.STAGES:
+            key = self._stage_key(name)
+            if self._is_current(name, key):
+                continue
+            with stage(name) as record:
+                output = getattr(self, '_' + name)()
+                record.add_array(self.STAGE_OUTPUTS[name], output)
+            # Later stages depend on this one
+            self.invalidate(name)
+            self._stage_memo[name] = (key, output)
+            self.recomputed.append(name)
+            
+    def _detect (self):
+        recording = self.recording
+        if recording.data.ndim > 1:
+            # A spike seen on several channels is kept once, on the
+            # channel where it is largest
+            spike_table = spikedetect.detect_spikes_multichannel(\
+                recording.data, chunk_size=2**20, \
+                merge_window=max(1, int(round(5e-4 * recording.fs_Hz))))
+            t_spikes = spike_table['t']
+            spike_channels = spike_table['channel']
+        else:
+            t_spikes = spikedetect.detect_spikes(recording.data, chunk_size=2**20)
+            spike_channels = None
+        
+        inside = spikedetect.alignable(t_spikes, recording.data.shape[-1], \
+            self.samples_before, self.samples_after)
+        recording.t_spikes = t_spikes[inside]
+        if spike_channels is not None:
+            recording.spike_channels = spike_channels[inside]
+        return recording.t_spikes
         
+    def _waveforms (self):
         self.spike_features = \
             features.SpikeFeatures(\
-                self.recording, self.feature_extraction, self.feature_selection)
+                self.recording, self.feature_extraction, self.feature_selection, \
+                self.samples_before, self.samples_after, cache=self.cache, \
+                float_dtype=self.float_dtype)
+        return self.spike_features.spike_waveforms
         
+    def _features (self):
+        self.spike_features.feature_extraction = self.feature_extraction
         self.spike_features.extract_features()
-        self.spike_features.select_features()
+        return self.spike_features.features
         
+    def _selection (self):
+        self.spike_features.feature_selection = self.feature_selection
+        self.spike_features.selection_max_samples = self.selection_max_samples
+        self.spike_features.select_features(self.n_features)
+        return self.spike_features.features_selected
+        
+    def _clustering (self):
+        # Ground truth classes are only those of the spikes clustered when
+        # the spike times were given with the recording
+        detected = 'detect' in self._stage_memo and \
+            self.recording.t_spikes is self._stage_memo['detect'][1]
         self.clustering = \
             cluster.SpikeFeatureClustering(\
-                self.recording, self.spike_features, self.n_features, 'kMeans')
-        
+                self.recording, self.spike_features, self.n_features, \
+                self.feature_clustering, self.n_clusters, score=not detected)
         self.clustering.cluster_spike_features()
+        return self.clustering.spike_class_est
+
+    def evaluate (self, t_true, spike_class, tolerance=10):
+        """
+        Scores the detected and sorted spikes against ground truth, after
+        spike_sorting, see evaluate.evaluate_sorting.
+        
+        Parameters
+        ----------
+        t_true : ndarray
+            Times of the true spikes
+            
+        spike_class : ndarray
+            Unit of each true spike
+            
+        tolerance : float
+            Largest distance in samples between matched spikes
+        """
+        return evaluate.evaluate_sorting(t_true, spike_class, \
+            self.recording.t_spikes, self.clustering.spike_class_est, tolerance)
 
-__all__ = ["signals", "cluster", "features", "SpikeSorting"]
+__all__ = ["batch", "cache", "signals", "cluster", "evaluate", "features", "instrument", "online", "spikedetect", "store", "sweep", "SpikeSorting"]
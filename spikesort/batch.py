@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ${FILENAME}
+#  
+#  Copyright 2015 Anupam Mitra <anupam.mitra@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, \
+    ThreadPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .signals import Recording
+
+class SharedRecording:
+    """
+    A recording whose data is held in a multiprocessing.shared_memory block,
+    so that worker processes attach to it by name instead of receiving a
+    pickled copy.
+    
+    Parameters
+    ----------
+    recording : Recording
+        The recording, whose data is copied into shared memory
+    """
+    def __init__ (self, recording):
+        data = np.asarray(recording.data)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        shared_data = np.ndarray(data.shape, dtype=data.dtype, buffer=self.shm.buf)
+        shared_data[...] = data
+        del shared_data
+        self.spec = {\
+            'name': self.shm.name, 'shape': data.shape, 'dtype': data.dtype.str, \
+            'fs_Hz': recording.fs_Hz, 'gain': getattr(recording, 'gain', 1.0), \
+            'float_dtype': np.dtype(getattr(recording, 'float_dtype', np.float64)).str, \
+            't_spikes': getattr(recording, 't_spikes', None), \
+            'spike_class': getattr(recording, 'spike_class', None), \
+            'spike_channels': getattr(recording, 'spike_channels', None)}
+        
+    def release (self):
+        """
+        Frees the shared memory. Workers must have finished with it.
+        """
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+def attach_recording (spec):
+    """
+    Attaches to a recording in shared memory from its SharedRecording.spec.
+    
+    Returns
+    -------
+    shm : SharedMemory
+        The shared memory block, to close when done with the recording
+        
+    recording : Recording
+        The recording, whose data is a read only view of the block
+    """
+    shm = shared_memory.SharedMemory(name=spec['name'])
+    data = np.ndarray(spec['shape'], dtype=np.dtype(spec['dtype']), buffer=shm.buf)
+    data.flags.writeable = False
+    recording = Recording(data, spec['fs_Hz'], spec['t_spikes'], \
+        spec['spike_class'], gain=spec['gain'], float_dtype=spec['float_dtype'])
+    if spec['spike_channels'] is not None:
+        setattr(recording, 'spike_channels', spec['spike_channels'])
+    return shm, recording
+
+def _error_text ():
+    return traceback.format_exc(limit=-1).strip().replace('\n', ' | ')
+
+def sort_shared (spec, config):
+    """
+    Sorts a recording in shared memory with one pipeline configuration, as
+    run in a worker process.
+    
+    Parameters
+    ----------
+    spec : dict
+        SharedRecording.spec of the recording
+        
+    config : dict
+        Keyword arguments of SpikeSorting: feature_extraction,
+        feature_selection, feature_clustering, n_features and optionally
+        samples_before, samples_after and float_dtype
+        
+    Returns
+    -------
+    result : dict
+        n_spikes, ami, ari, t_sorting and error, which is None unless
+        sorting failed
+    """
+    from . import SpikeSorting
+    
+    result = {'n_spikes': None, 'ami': None, 'ari': None, 't_sorting': None, 'error': None}
+    shm, recording = attach_recording(spec)
+    try:
+        t = time.perf_counter()
+        sorting = SpikeSorting(recording, **config)
+        sorting.spike_sorting()
+        result.update(n_spikes=len(recording.t_spikes), \
+            ami=sorting.clustering.ami, ari=sorting.clustering.ari, \
+            t_sorting=time.perf_counter() - t)
+    except Exception:
+        result['error'] = _error_text()
+    finally:
+        # Views of the block must be gone before it can be closed
+        sorting = None
+        recording.data = None
+        recording = None
+        shm.close()
+    return result
+
+class BatchRunner:
+    """
+    Sorts every file of a dataset directory with one or more pipeline
+    configurations on a process pool. Each recording is loaded once, on a
+    thread which reads the next file while the current one is sorted, and
+    put in shared memory, where all configurations for it read it. At most
+    max_resident recordings are held at a time. A file which fails to load
+    or a configuration which fails to sort gives a row with an error and
+    the batch goes on.
+    
+    Parameters
+    ----------
+    dataset : str
+        The dataset, 'waveclus' or 'cpgjnm'
+        
+    datadir : str
+        The directory where the files of the dataset are present
+        
+    configs : list
+        Pipeline configurations, each a dict of keyword arguments of
+        SpikeSorting, see sort_shared
+        
+    filenames : list
+        Names of the files to sort. If None, all files of the dataset in
+        datadir are used.
+        
+    n_jobs : int
+        Number of worker processes, default as many as available CPUs
+        
+    max_resident : int
+        Greatest number of recordings in shared memory at once
+        
+    callback : callable
+        Function called with each result row as it completes
+    """
+    def __init__ (self, dataset, datadir, configs, filenames=None, \
+                  n_jobs=None, max_resident=2, callback=None):
+        self.dataset = dataset
+        self.datadir = datadir
+        self.configs = [dict(config) for config in configs]
+        self.filenames = filenames
+        self.n_jobs = n_jobs
+        self.max_resident = max(max_resident, 1)
+        self.callback = callback
+        
+    def files (self):
+        if self.filenames is not None:
+            return list(self.filenames)
+        import datasets.index
+        return datasets.index.DATASETS[self.dataset].list_files(self.datadir)
+        
+    def load (self, filename):
+        """
+        Reads a file of the dataset into shared memory
+        """
+        import datasets.index
+        recording = datasets.index.DATASETS[self.dataset].read_file(filename, self.datadir)
+        return SharedRecording(recording)
+        
+    def _row (self, filename, config, result):
+        row = {'filename': filename}
+        row.update(config)
+        row.update(result)
+        if self.callback is not None:
+            self.callback(row)
+        return row
+        
+    def run (self):
+        """
+        Runs the batch.
+        
+        Returns
+        -------
+        rows : list
+            One dict per file and configuration, with the filename, the
+            configuration and the result of sort_shared
+        """
+        rows = []
+        filenames = iter(self.files())
+        loading = []
+        resident = {}
+        pending = {}
+        
+        with ThreadPoolExecutor(max_workers=1) as loader, \
+                ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+            def prefetch ():
+                filename = next(filenames, None)
+                if filename is not None:
+                    loading.append((filename, loader.submit(self.load, filename)))
+                    
+            try:
+                prefetch()
+                while loading or pending:
+                    while loading and len(resident) < self.max_resident:
+                        filename, future = loading.pop(0)
+                        try:
+                            shared = future.result()
+                        except Exception:
+                            error = _error_text()
+                            for config in self.configs:
+                                rows.append(self._row(filename, config, {'error': error}))
+                            prefetch()
+                            continue
+                        resident[filename] = [shared, len(self.configs)]
+                        for config in self.configs:
+                            pending[executor.submit(sort_shared, shared.spec, config)] = \
+                                (filename, config)
+                        # The next file is read while this one is sorted
+                        prefetch()
+                        
+                    if not pending:
+                        continue
+                    done, not_done = wait(list(pending), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        filename, config = pending.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception:
+                            result = {'error': _error_text()}
+                        rows.append(self._row(filename, config, result))
+                        resident[filename][1] -= 1
+                        if resident[filename][1] == 0:
+                            resident.pop(filename)[0].release()
+            finally:
+                for future in pending:
+                    future.cancel()
+                for filename, future in loading:
+                    try:
+                        future.result().release()
+                    except Exception:
+                        pass
+                for shared, n_remaining in resident.values():
+                    shared.release()
+        return rows
+
+def run_batch (dataset, datadir, configs, filenames=None, n_jobs=None, \
+               max_resident=2, callback=None):
+    """
+    Sorts every file of a dataset directory with each configuration, see
+    BatchRunner.
+    
+    Returns
+    -------
+    rows : list
+        One dict per file and configuration
+    """
+    return BatchRunner(dataset, datadir, configs, filenames, n_jobs, \
+        max_resident, callback).run()
+
+__all__ = ["BatchRunner", "SharedRecording", "attach_recording", \
+    "run_batch", "sort_shared"]
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ${FILENAME}
+#  
+#  Copyright 2015 Anupam Mitra <anupam.mitra@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+def array_digest (a, chunk_size=2**24):
+    """
+    Computes a digest of the contents of an array, reading it in chunks so
+    that memory mapped arrays are never loaded whole.
+    
+    Parameters
+    ----------
+    a : ndarray
+        The array
+        
+    chunk_size : int
+        Number of bytes hashed at once
+        
+    Returns
+    -------
+    digest : str
+        Hexadecimal digest of the data type, shape and contents
+    """
+    a = np.asanyarray(a)
+    h = hashlib.blake2b(digest_size=20)
+    h.update(repr((a.dtype.str, a.shape)).encode())
+    if a.ndim == 0 or a.size == 0:
+        h.update(a.tobytes())
+        return h.hexdigest()
+    
+    # Chunks are taken along the last axis, so that strided views such as
+    # the channels of an interleaved recording are not copied whole
+    n_columns = max(chunk_size // (a.itemsize * (a.size // a.shape[-1])), 1)
+    for i in range(0, a.shape[-1], n_columns):
+        h.update(np.ascontiguousarray(a[..., i : i + n_columns]).data)
+    return h.hexdigest()
+
+def recording_digest (recording):
+    """
+    Digest of the data of a recording, remembered on the recording until
+    its data is replaced, for instance by filtering.
+    
+    Parameters
+    ----------
+    recording : Recording
+        The recording
+        
+    Returns
+    -------
+    digest : str
+        Hexadecimal digest of the recording data and gain
+    """
+    memo = getattr(recording, '_data_digest', None)
+    if memo is None or memo[0] is not recording.data:
+        digest = array_digest(recording.data) + repr(getattr(recording, 'gain', 1.0))
+        memo = (recording.data, digest)
+        recording._data_digest = memo
+    return memo[1]
+
+class FeatureCache:
+    """
+    Content addressed on disk cache of arrays, such as spike waveforms and
+    feature matrices. Each array is stored as a .npy file named by a digest
+    of everything it was computed from, and is loaded back as a read only
+    memory map. When the cache grows beyond its size limit, the least
+    recently used files are removed.
+    
+    Parameters
+    ----------
+    cache_dir: str
+        Directory in which arrays are stored, created if necessary
+        
+    max_bytes: int
+        Size limit of the cache in bytes. If None, the cache is unbounded.
+    """
+    def __init__ (self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+            
+    def key (self, *parts):
+        """
+        Computes the cache key of an array from the inputs and parameters
+        it is computed from.
+        
+        Parameters
+        ----------
+        parts :
+            Arrays, whose contents are hashed, and other values, whose
+            repr is hashed
+            
+        Returns
+        -------
+        key : str
+            The cache key
+        """
+        h = hashlib.blake2b(digest_size=20)
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                h.update(array_digest(part).encode())
+            else:
+                h.update(repr(part).encode())
+            h.update(b'\0')
+        return h.hexdigest()
+        
+    def _path (self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+        
+    def get (self, key):
+        """
+        Looks up an array in the cache.
+        
+        Parameters
+        ----------
+        key : str
+            The cache key
+            
+        Returns
+        -------
+        a : numpy.memmap
+            The cached array as a read only memory map, or None if it is
+            not in the cache
+        """
+        path = self._path(key)
+        try:
+            a = np.load(path, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+        # The modification time records the last use
+        os.utime(path, None)
+        return a
+        
+    def put (self, key, a):
+        """
+        Stores an array in the cache, evicting least recently used arrays
+        if the size limit is exceeded.
+        
+        Parameters
+        ----------
+        key : str
+            The cache key
+            
+        a : ndarray
+            The array
+            
+        Returns
+        -------
+        a : numpy.memmap
+            The stored array as a read only memory map
+        """
+        # Written under a temporary name and renamed, so that concurrent
+        # readers never see a partially written file
+        fd, path_tmp = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.asanyarray(a))
+            os.replace(path_tmp, self._path(key))
+        except BaseException:
+            os.unlink(path_tmp)
+            raise
+        self.evict(keep=key)
+        return np.load(self._path(key), mmap_mode='r')
+        
+    def cached (self, key, compute):
+        """
+        Returns the cached array for a key, computing and storing it if it
+        is not in the cache.
+        
+        Parameters
+        ----------
+        key : str
+            The cache key
+            
+        compute : callable
+            Function of no arguments computing the array
+            
+        Returns
+        -------
+        a : numpy.memmap
+            The array as a read only memory map
+        """
+        a = self.get(key)
+        if a is None:
+            a = self.put(key, compute())
+        return a
+        
+    def size (self):
+        """
+        Total size in bytes of the arrays in the cache
+        """
+        return sum(os.path.getsize(os.path.join(self.cache_dir, f)) \
+            for f in os.listdir(self.cache_dir) if f.endswith('.npy'))
+        
+    def evict (self, keep=None):
+        """
+        Removes least recently used arrays until the cache is within its
+        size limit.
+        
+        Parameters
+        ----------
+        keep : str
+            Key of an array never to remove, such as the one just stored
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        for f in os.listdir(self.cache_dir):
+            if f.endswith('.npy'):
+                stat = os.stat(os.path.join(self.cache_dir, f))
+                entries.append((stat.st_mtime, stat.st_size, f))
+        total = sum(e[1] for e in entries)
+        for mtime, size, f in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if f == str(keep) + '.npy':
+                continue
+            try:
+                os.unlink(os.path.join(self.cache_dir, f))
+            except OSError:
+                continue
+            total -= size
+            
+    def clear (self):
+        """
+        Removes all arrays from the cache
+        """
+        for f in os.listdir(self.cache_dir):
+            if f.endswith('.npy'):
+                os.unlink(os.path.join(self.cache_dir, f))
+
+__all__ = ["FeatureCache", "array_digest", "recording_digest"]
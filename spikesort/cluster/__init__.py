@@ -25,9 +25,12 @@
 import numpy as np
 import sklearn.metrics.cluster
 
+from . import density
 from . import euclidean
-from .. import features
-from .. import signals
+from .density import DensityClustering, density_cluster
+from .euclidean import kmeans, minibatch_kmeans, StreamingKMeans
+from .nclusters import choose_n_clusters
+from .template import TemplateClassifier, UNASSIGNED
 
 
 class SpikeFeatureClustering:
@@ -46,34 +49,104 @@ class SpikeFeatureClustering:
         Number of features to use for clustering.
         
     cluster_algo:
-        Clustering algorithm to use for clustering. Currently only 'kMeans'
-        is supported
+        Clustering algorithm to use for clustering. Currently the following
+        are supported
+        'kMeans' for K means
+        'miniBatchKMeans' for out of core mini batch K means, whose fitted
+        model is kept as model to assign new spikes
+        'density' for density based clustering, which finds the number of
+        clusters itself and labels spikes in no cluster -1, whose fitted
+        model, with the hierarchy of clusters, is kept as model
+        
+    n_clusters:
+        Number of clusters for K means. If 'auto', it is chosen with
+        choose_n_clusters, and the candidates and their scores are kept as
+        k_values and k_scores. If None, the number of classes of the ground
+        truth spike_class of the recording is used when there is one, and
+        it is chosen otherwise.
+        
+    k_values:
+        Candidate numbers of clusters when they are chosen
+        
+    k_criterion:
+        Criterion for choosing the number of clusters, 'bic', 'silhouette'
+        or 'gap', see choose_n_clusters
+        
+    score:
+        Whether the spike_class of the recording gives the class of each
+        spike clustered, so that ami and ari are computed. This is not so
+        when the spikes were detected instead of given with the recording,
+        in which case ami and ari are None; see evaluate.evaluate_sorting
+        for scoring detected spikes against ground truth times.
     """
-    def __init__(self, recording, spike_features, n_features, cluster_algo):
+    def __init__(self, recording, spike_features, n_features, cluster_algo, \
+                 n_clusters=None, k_values=range(2, 11), k_criterion='bic', \
+                 score=True):
         self.recording = recording
         self.spike_features = spike_features
         self.n_features = n_features
-        self.n_spike_classes = np.unique(self.recording.spike_class).shape[0]
-        self.n_spikes = self.recording.spike_class.shape[0]
+        self.spike_class = getattr(recording, 'spike_class', None)
+        if n_clusters is None:
+            n_clusters = 'auto' if self.spike_class is None else \
+                np.unique(self.spike_class).shape[0]
+        self.n_clusters = n_clusters
+        self.k_values = k_values
+        self.k_criterion = k_criterion
         self.cluster_algo = cluster_algo
+        self.score = score
+        
+    def template_classifier (self, **kwargs):
+        """
+        Builds a TemplateClassifier assigning new spikes to the clusters
+        found, see TemplateClassifier.from_sorting for the keyword arguments
+        """
+        return TemplateClassifier.from_sorting(self.spike_features, \
+            self.spike_class_est, self.n_features, **kwargs)
         
     def cluster_spike_features (self):
         features = self.spike_features.get_top_features(self.n_features)
+        self.n_spikes = features.shape[0]
+        
+        if self.cluster_algo.lower() in ('kmeans', 'minibatchkmeans'):
+            if self.n_clusters == 'auto':
+                self.n_spike_classes, self.k_values, self.k_scores = \
+                    choose_n_clusters(features, self.k_values, self.k_criterion)
+            else:
+                self.n_spike_classes = self.n_clusters
         
         if self.cluster_algo.lower() == 'kmeans':
             self.spike_class_est = euclidean.kmeans(features, self.n_spike_classes, feature_scaling=True)
+            
+        elif self.cluster_algo.lower() == 'minibatchkmeans':
+            self.spike_class_est, self.model = \
+                euclidean.minibatch_kmeans(features, self.n_spike_classes, feature_scaling=True)
 
-        # Not implemented at present, random assignment of class labels
+        elif self.cluster_algo.lower() == 'density':
+            self.spike_class_est, self.model = \
+                density.density_cluster(features, feature_scaling=True)
+            
         else:
-            self.spike_class_est = np.random.choice(np.arange(0, self.n_spike_classes), self.n_spikes)
+            raise ValueError('Unknown clustering algorithm %s' % self.cluster_algo)
 
+        if not self.score or self.spike_class is None or \
+                np.shape(self.spike_class)[0] != self.n_spikes:
+            self.ami = None
+            self.ari = None
+            return
         self.ami = sklearn.metrics.adjusted_mutual_info_score(\
-                    self.recording.spike_class, self.spike_class_est)
+                    self.spike_class, self.spike_class_est)
         self.ari = sklearn.metrics.cluster.adjusted_rand_score(\
-                    self.recording.spike_class, self.spike_class_est)        
+                    self.spike_class, self.spike_class_est)
 
 
 __all__ = [\
+            "choose_n_clusters", \
+            "DensityClustering", \
+            "density_cluster", \
             "kmeans", \
-            "SpikeClustering",\
+            "minibatch_kmeans", \
+            "StreamingKMeans", \
+            "TemplateClassifier", \
+            "UNASSIGNED", \
+            "SpikeFeatureClustering",\
         ]
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ${FILENAME}
+#  
+#  Copyright 2015 Anupam Mitra <anupam.mitra@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+from sklearn.neighbors import NearestNeighbors
+from sklearn.preprocessing import StandardScaler
+
+class DensityClustering:
+    """
+    Density based clustering of spike features, in the spirit of the
+    superparamagnetic clustering of wave_clus and of HDBSCAN, which does
+    not need the number of clusters.
+    
+    A k nearest neighbour graph of the spikes is computed once, weighted by
+    the mutual reachability distance max(core_i, core_j, d_ij), where the
+    core distance of a spike is the distance to its min_samples-th
+    neighbour. Its minimum spanning forest is then cut at a decreasing
+    sequence of distances, the levels, which play the part of the
+    temperatures of superparamagnetic clustering. The connected components
+    with at least min_cluster_size spikes are the clusters at each level,
+    and clusters at one level are nested in those of the previous level,
+    which gives a hierarchy. Finding neighbours with a tree and the spanning
+    forest take O(n log n), and each level only O(n).
+    
+    Parameters
+    ----------
+    n_neighbors : int
+        Number of neighbours of each spike in the graph
+        
+    min_samples : int
+        Neighbour whose distance is the core distance, at most n_neighbors.
+        Larger values smooth the density estimate.
+        
+    min_cluster_size : int
+        Smallest number of spikes of a cluster. If None, 0.5% of the spikes,
+        and at least 10.
+        
+    n_levels : int
+        Number of levels at which the spanning forest is cut
+        
+    selection : str
+        How clusters are chosen from the hierarchy. 'eom' picks the most
+        stable clusters across levels, by excess of mass as in HDBSCAN,
+        'level' picks the level with the most clusters, the largest
+        distance among ties, as wave_clus picks a temperature, among the
+        levels where at least min_clustered of the spikes are in clusters.
+        
+    min_clustered : float
+        Smallest fraction of spikes in clusters at the level picked with
+        selection='level'
+        
+    feature_scaling : bool
+        Whether to scale features to unit variance
+        
+    n_jobs : int
+        Number of threads for the neighbour search, default as many as
+        available CPUs
+        
+    Attributes
+    ----------
+    levels : ndarray
+        Cut distances, decreasing
+        
+    level_labels : ndarray
+        Cluster of each spike at each level, of shape (n_levels, n_spikes),
+        numbered by decreasing size, with -1 for spikes in no cluster
+        
+    hierarchy : list
+        Dicts with the level, cluster, parent (cluster at the previous
+        level, or -1) and size of every cluster at every level
+        
+    level : int
+        Level picked with selection='level', otherwise None
+        
+    labels : ndarray
+        Cluster of each spike, with -1 for spikes in no selected cluster
+    """
+    def __init__ (self, n_neighbors=15, min_samples=5, min_cluster_size=None, \
+                  n_levels=30, selection='eom', min_clustered=0.5, \
+                  feature_scaling=True, n_jobs=None):
+        if selection not in ('eom', 'level'):
+            raise ValueError('Unknown selection %s' % selection)
+        self.n_neighbors = n_neighbors
+        self.min_samples = min(min_samples, n_neighbors)
+        self.min_cluster_size = min_cluster_size
+        self.n_levels = n_levels
+        self.selection = selection
+        self.min_clustered = min_clustered
+        self.feature_scaling = feature_scaling
+        self.n_jobs = n_jobs
+        
+    def _spanning_forest (self, features):
+        n_spikes = features.shape[0]
+        n_neighbors = min(self.n_neighbors, n_spikes - 1)
+        n_jobs = -1 if self.n_jobs is None else self.n_jobs
+        distance, neighbors = NearestNeighbors(n_neighbors=n_neighbors + 1, \
+            n_jobs=n_jobs).fit(features).kneighbors(features)
+        # The first neighbour of each spike is itself
+        distance = distance[:, 1:]
+        neighbors = neighbors[:, 1:]
+        core = distance[:, min(self.min_samples, n_neighbors) - 1]
+        reachability = np.maximum(distance, \
+            np.maximum(core[:, np.newaxis], core[neighbors]))
+        # Zero weights would be read as missing edges
+        reachability = np.maximum(reachability, np.finfo(np.float64).tiny)
+        graph = scipy.sparse.csr_matrix(\
+            (reachability.ravel(), neighbors.ravel(), \
+             np.arange(0, n_spikes * n_neighbors + 1, n_neighbors)), \
+            shape=(n_spikes, n_spikes))
+        forest = scipy.sparse.csgraph.minimum_spanning_tree(graph).tocoo()
+        return forest.row, forest.col, forest.data
+        
+    def _level_labels (self, n_spikes, row, col, weight, level):
+        keep = weight <= level
+        graph = scipy.sparse.coo_matrix(\
+            (np.ones(np.count_nonzero(keep), dtype=np.int8), (row[keep], col[keep])), \
+            shape=(n_spikes, n_spikes))
+        n_components, components = scipy.sparse.csgraph.connected_components(\
+            graph, directed=False)
+        sizes = np.bincount(components, minlength=n_components)
+        order = np.argsort(-sizes, kind='stable')
+        n_clusters = np.count_nonzero(sizes >= self.min_cluster_size_)
+        rank = np.full(n_components, -1)
+        rank[order[:n_clusters]] = np.arange(n_clusters)
+        return rank[components], sizes[order[:n_clusters]]
+        
+    def fit (self, spike_features):
+        """
+        Builds the hierarchy and selects clusters.
+        
+        Parameters
+        ----------
+        spike_features : ndarray
+            Features of the spikes, of shape (n_spikes, n_features)
+            
+        Returns
+        -------
+        self
+        """
+        features = np.asarray(spike_features, dtype=np.float64)
+        if self.feature_scaling:
+            features = StandardScaler().fit_transform(features)
+        n_spikes = features.shape[0]
+        self.min_cluster_size_ = self.min_cluster_size
+        if self.min_cluster_size_ is None:
+            self.min_cluster_size_ = max(10, n_spikes // 200)
+        if n_spikes <= max(self.min_samples, 2):
+            self.levels = np.empty(0)
+            self.level_labels = np.empty((0, n_spikes), dtype=np.intp)
+            self.hierarchy = []
+            self.level = None
+            self.labels = np.full(n_spikes, -1)
+            return self
+            
+        row, col, weight = self._spanning_forest(features)
+        self.levels = np.unique(np.quantile(weight, \
+            np.linspace(1.0, 0.0, self.n_levels, endpoint=False)))[::-1]
+        
+        self.level_labels = np.empty((self.levels.shape[0], n_spikes), dtype=np.intp)
+        self.hierarchy = []
+        for l, level in enumerate(self.levels):
+            labels, sizes = self._level_labels(n_spikes, row, col, weight, level)
+            self.level_labels[l] = labels
+            # Clusters are nested in those of the previous level, so any
+            # member gives the parent
+            first = np.full(sizes.shape[0], -1)
+            clustered = np.flatnonzero(labels >= 0)
+            first[labels[clustered[::-1]]] = clustered[::-1]
+            for c, size in enumerate(sizes):
+                parent = self.level_labels[l - 1, first[c]] if l > 0 else -1
+                self.hierarchy.append({'level': l, 'cluster': c, \
+                    'parent': int(parent), 'size': int(size)})
+                
+        if self.selection == 'level':
+            n_clusters = np.max(self.level_labels, axis=1) + 1
+            clustered = np.mean(self.level_labels >= 0, axis=1)
+            n_clusters[clustered < self.min_clustered] = -1
+            self.level = int(np.argmax(n_clusters))
+            self.labels = self.level_labels[self.level].copy()
+        else:
+            self.level = None
+            self.labels = self._excess_of_mass()
+        return self
+        
+    def _excess_of_mass (self):
+        # Chains of clusters across levels which do not split are segments,
+        # whose stability is the mass they hold over the levels, with
+        # lambda = 1 / distance as in HDBSCAN
+        lam = 1.0 / self.levels
+        step = lam[-1] - lam[-2] if lam.shape[0] > 1 else lam[-1]
+        lam = np.append(lam, lam[-1] + step)
+        
+        by_parent = {}
+        for node in self.hierarchy:
+            by_parent.setdefault((node['level'], node['parent']), []).append(node)
+        
+        segments = []
+        segment_of = {}
+        for l in range(self.levels.shape[0]):
+            parents = [-1] if l == 0 else \
+                [node['cluster'] for node in self.hierarchy if node['level'] == l - 1]
+            for parent in parents:
+                nodes = by_parent.get((l, parent), [])
+                for node in nodes:
+                    if l > 0 and len(nodes) == 1:
+                        segment = segment_of[(l - 1, parent)]
+                    else:
+                        segment = len(segments)
+                        parent_segment = segment_of[(l - 1, parent)] if l > 0 else -1
+                        segments.append({'level': l, 'cluster': node['cluster'], \
+                            'stability': 0.0, 'children': []})
+                        if parent_segment >= 0:
+                            segments[parent_segment]['children'].append(segment)
+                    segment_of[(l, node['cluster'])] = segment
+                    segments[segment]['stability'] += \
+                        node['size'] * (lam[l + 1] - lam[l])
+        
+        # Segments are created after their parents, so children are
+        # resolved first. Roots which split are not clusters themselves.
+        roots = set(segment_of[(0, node['cluster'])] \
+            for node in self.hierarchy if node['level'] == 0)
+        best = np.zeros(len(segments))
+        selected = np.zeros(len(segments), dtype=bool)
+        for s in range(len(segments) - 1, -1, -1):
+            children = segments[s]['children']
+            children_best = sum(best[c] for c in children)
+            if not children or \
+                    (s not in roots and segments[s]['stability'] >= children_best):
+                best[s] = segments[s]['stability']
+                selected[s] = True
+            else:
+                best[s] = children_best
+                
+        chosen = []
+        stack = sorted(roots)
+        while stack:
+            s = stack.pop()
+            if selected[s]:
+                chosen.append(s)
+            else:
+                stack.extend(segments[s]['children'])
+                
+        labels = np.full(self.level_labels.shape[1], -1)
+        members = [self.level_labels[segments[s]['level']] == segments[s]['cluster'] \
+            for s in chosen]
+        sizes = [np.count_nonzero(m) for m in members]
+        for label, i in enumerate(np.argsort(sizes, kind='stable')[::-1]):
+            labels[members[i]] = label
+        return labels
+
+def density_cluster (spike_features, n_neighbors=15, min_samples=5, \
+                     min_cluster_size=None, n_levels=30, selection='eom', \
+                     min_clustered=0.5, feature_scaling=True, n_jobs=None):
+    """
+    Clusters spike features by density, without a number of clusters, see
+    DensityClustering.
+    
+    Returns
+    -------
+    spike_class_est : ndarray
+        Estimated spike classes, with -1 for spikes in no cluster
+        
+    model : DensityClustering
+        The fitted model, with the hierarchy of clusters
+    """
+    model = DensityClustering(n_neighbors, min_samples, min_cluster_size, \
+        n_levels, selection, min_clustered, feature_scaling, n_jobs).fit(spike_features)
+    return model.labels, model
+
+__all__ = ["DensityClustering", "density_cluster"]
@@ -22,10 +22,11 @@
 #  
 #  
 
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import scale
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.preprocessing import StandardScaler
 
-def kmeans(spike_features, num_classes, feature_scaling=True, n_jobs=-1):
+def kmeans(spike_features, num_classes, feature_scaling=True, n_jobs=None):
     """
     Performs K means clustering using the methods of 
     sklearn.cluster.KMeans
@@ -43,8 +44,8 @@ def kmeans(spike_features, num_classes, feature_scaling=True, n_jobs=-1):
         Whether to perform feature scaling
         
     n_jobs :
-        Number of processes to use, default use as many as available CPUs
-        using the parallelism provided by sklearn
+        Ignored. Current versions of sklearn parallelize K means over
+        threads without this parameter.
         
     Returns
     -------
@@ -55,11 +56,236 @@ def kmeans(spike_features, num_classes, feature_scaling=True, n_jobs=-1):
     
   
     if feature_scaling:
-        features = scale(spike_features, axis=0)
+        # StandardScaler, unlike scale, does not warn spuriously about
+        # centering single precision features
+        features = StandardScaler().fit_transform(spike_features)
     else:
         features = spike_features
     
-    clustering = KMeans(n_clusters=num_classes, n_init=10, n_jobs=-1)
+    clustering = KMeans(n_clusters=num_classes, n_init=10)
 
     spike_class_est = clustering.fit_predict(features)
     return spike_class_est
+
+def iter_feature_chunks (spike_features, chunk_size):
+    """
+    Iterates over the rows of a feature matrix in chunks
+    
+    Parameters
+    ----------
+    spike_features : ndarray or str
+        Features extracted from the spikes, or the path of a .npy file
+        containing them, which is memory mapped
+        
+    chunk_size : int
+        Number of spikes in each chunk
+        
+    Yields
+    ------
+    chunk : ndarray
+        Features of chunk_size consecutive spikes
+    """
+    if isinstance(spike_features, str):
+        spike_features = np.load(spike_features, mmap_mode='r')
+    for i in range(0, spike_features.shape[0], chunk_size):
+        yield np.asarray(spike_features[i : i + chunk_size], dtype=np.float64)
+
+class StreamingKMeans:
+    """
+    Out of core K means clustering using the methods of
+    sklearn.cluster.MiniBatchKMeans. Features are streamed in chunks, for
+    instance from a memory mapped file, so that they never need to fit in
+    memory. Scaling statistics are accumulated in a first pass over the
+    chunks and clusters are fitted in later passes. Once fitted, new spikes
+    are assigned to clusters without refitting.
+    
+    The clusters are initialized from the first batch_size spikes given to
+    partial_fit, which are buffered until there are enough. When streaming
+    fewer spikes than that, call flush before predict.
+    
+    Parameters
+    ----------
+    num_classes:
+        Number of clusters
+        
+    feature_scaling: boolean
+        Whether to perform feature scaling
+        
+    batch_size: int
+        Number of spikes in each mini batch
+        
+    chunk_size: int
+        Number of spikes read at once
+        
+    n_passes: int
+        Number of passes over the data for fitting clusters
+        
+    random_state: int
+        Seed of the random initialization of clusters
+        
+    n_init: int
+        Number of random initializations tried on the first batch, of
+        which the one with the lowest inertia is kept
+    """
+    def __init__ (self, num_classes, feature_scaling=True, batch_size=4096, \
+                  chunk_size=2**16, n_passes=3, random_state=0, n_init=3):
+        self.num_classes = num_classes
+        self.feature_scaling = feature_scaling
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.n_passes = n_passes
+        self.random_state = random_state
+        self.n_init = n_init
+        self.scaler = StandardScaler() if feature_scaling else None
+        self.clustering = None
+        self._buffer = []
+        self._n_buffered = 0
+            
+    def partial_fit_scaling (self, chunk):
+        """
+        Updates the running mean and variance of the features with a chunk
+        of spikes
+        """
+        if self.scaler is not None:
+            self.scaler.partial_fit(chunk)
+        return self
+        
+    def _transform (self, chunk):
+        if self.scaler is None:
+            return chunk
+        return self.scaler.transform(chunk)
+        
+    def _initialize (self, batch):
+        if batch.shape[0] < self.num_classes:
+            raise ValueError('%d spikes cannot initialize %d clusters' % \
+                (batch.shape[0], self.num_classes))
+        # MiniBatchKMeans.partial_fit tries a single initialization, so the
+        # n_init initializations are compared by K means on the first batch
+        centers = KMeans(n_clusters=self.num_classes, n_init=self.n_init, \
+            random_state=self.random_state).fit(batch).cluster_centers_
+        self.clustering = MiniBatchKMeans(n_clusters=self.num_classes, \
+            init=centers, n_init=1, batch_size=self.batch_size, \
+            random_state=self.random_state)
+        self.clustering.partial_fit(batch)
+        
+    def partial_fit (self, chunk):
+        """
+        Updates the clusters with a chunk of spikes, in mini batches
+        """
+        chunk = self._transform(chunk)
+        if self.clustering is None:
+            self._buffer.append(chunk)
+            self._n_buffered += chunk.shape[0]
+            n_first = max(self.batch_size, self.num_classes)
+            if self._n_buffered < n_first:
+                return self
+            chunk = np.concatenate(self._buffer)
+            self._buffer = []
+            self._n_buffered = 0
+            self._initialize(chunk[:n_first])
+            chunk = chunk[n_first:]
+        for i in range(0, chunk.shape[0], self.batch_size):
+            self.clustering.partial_fit(chunk[i : i + self.batch_size])
+        return self
+        
+    def flush (self):
+        """
+        Initializes the clusters from the spikes buffered by partial_fit,
+        when fewer than batch_size spikes were given. Raises ValueError if
+        there are fewer spikes than clusters.
+        """
+        if self.clustering is None:
+            batch = np.concatenate(self._buffer) if self._buffer else np.empty((0, 0))
+            self._initialize(batch)
+            self._buffer = []
+            self._n_buffered = 0
+        return self
+        
+    def fit (self, spike_features):
+        """
+        Fits scaling statistics and clusters to spike features.
+        
+        Parameters
+        ----------
+        spike_features : ndarray or str
+            Features extracted from the spikes, or the path of a .npy file
+            containing them
+        """
+        if self.scaler is not None:
+            for chunk in iter_feature_chunks(spike_features, self.chunk_size):
+                self.partial_fit_scaling(chunk)
+        for p in range(self.n_passes):
+            for chunk in iter_feature_chunks(spike_features, self.chunk_size):
+                self.partial_fit(chunk)
+            self.flush()
+        return self
+        
+    def predict (self, spike_features):
+        """
+        Assigns spikes to the fitted clusters.
+        
+        Parameters
+        ----------
+        spike_features : ndarray or str
+            Features extracted from the spikes, or the path of a .npy file
+            containing them
+            
+        Returns
+        -------
+        spike_class_est : ndarray
+            Estimated spike classes
+        """
+        spike_class_est = [np.empty(0, dtype=np.int32)]
+        for chunk in iter_feature_chunks(spike_features, self.chunk_size):
+            spike_class_est.append(self.clustering.predict(self._transform(chunk)))
+        return np.concatenate(spike_class_est)
+        
+    def fit_predict (self, spike_features):
+        return self.fit(spike_features).predict(spike_features)
+
+def minibatch_kmeans (spike_features, num_classes, feature_scaling=True, \
+                      batch_size=4096, chunk_size=2**16, n_passes=3, \
+                      random_state=0, n_init=3):
+    """
+    Performs out of core K means clustering, see StreamingKMeans
+    
+    Parameters
+    ----------
+    spike_features : ndarray or str
+        Features extracted from the spikes, or the path of a .npy file
+        containing them
+        
+    num_classes :
+        Number of classes of spike present, which will be used as the
+        number of clusters parameter for the clustering step.
+        
+    feature_scaling : boolean
+        Whether to perform feature scaling
+        
+    batch_size : int
+        Number of spikes in each mini batch
+        
+    chunk_size : int
+        Number of spikes read at once
+        
+    n_passes : int
+        Number of passes over the data for fitting clusters
+        
+    random_state : int
+        Seed of the random initialization of clusters
+        
+    n_init : int
+        Number of random initializations tried on the first batch
+        
+    Returns
+    -------
+    spike_class_est:
+        Estimated spike classes based on K means clustering
+        
+    model:
+        The fitted StreamingKMeans, which assigns new spikes with predict
+    """
+    model = StreamingKMeans(num_classes, feature_scaling, batch_size, \
+        chunk_size, n_passes, random_state, n_init)
+    spike_class_est = model.fit_predict(spike_features)
+    return spike_class_est, model
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ${FILENAME}
+#  
+#  Copyright 2015 Anupam Mitra <anupam.mitra@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sklearn.cluster import KMeans
+from sklearn.metrics import silhouette_score
+from sklearn.mixture import GaussianMixture
+from sklearn.preprocessing import StandardScaler
+
+from ..features.featureselect import subsample_rows
+
+def _add_centers (features, centers, n_new, rng):
+    # k-means++ seeding of new centers, given the existing ones
+    centers = list(centers)
+    if not centers:
+        centers.append(features[rng.integers(features.shape[0])])
+        n_new -= 1
+    distance = np.min(((features[:, np.newaxis, :] - np.array(centers)) ** 2).sum(axis=-1), axis=1)
+    for i in range(n_new):
+        total = distance.sum()
+        if total > 0:
+            new_center = features[rng.choice(features.shape[0], p=distance / total)]
+        else:
+            new_center = features[rng.integers(features.shape[0])]
+        centers.append(new_center)
+        distance = np.minimum(distance, ((features - new_center) ** 2).sum(axis=1))
+    return np.array(centers)
+
+def kmeans_path (features, k_values, random_state=0):
+    """
+    Fits K means for increasing numbers of clusters, each started from the
+    centers found for the previous number plus new centers seeded as in
+    k-means++, with a single initialization each.
+    
+    Parameters
+    ----------
+    features : ndarray
+        The (scaled) features, of shape (n_spikes, n_features)
+        
+    k_values : list
+        Numbers of clusters
+        
+    random_state : int
+        Seed for the new centers
+        
+    Returns
+    -------
+    fits : list
+        For each number of clusters, in increasing order, a tuple of the
+        labels, the centers and the inertia
+    """
+    rng = np.random.default_rng(random_state)
+    fits = []
+    centers = np.empty((0, features.shape[1]))
+    for k in sorted(k_values):
+        init = _add_centers(features, centers, k - centers.shape[0], rng)
+        clustering = KMeans(n_clusters=k, init=init, n_init=1).fit(features)
+        centers = clustering.cluster_centers_
+        fits.append((clustering.labels_, centers, clustering.inertia_))
+    return fits
+
+def _gap_reference (features, k_values, seed):
+    rng = np.random.default_rng(seed)
+    # Uniform reference in the box of the principal axes of the features
+    mean = features.mean(axis=0)
+    u, s, vt = np.linalg.svd(features - mean, full_matrices=False)
+    projected = np.dot(features - mean, vt.T)
+    reference = rng.uniform(projected.min(axis=0), projected.max(axis=0), \
+        size=projected.shape)
+    return [np.log(inertia) for labels, centers, inertia in \
+        kmeans_path(reference, k_values, seed)]
+
+def choose_n_clusters (spike_features, k_values=range(2, 11), criterion='bic', \
+                       max_samples=5000, feature_scaling=True, n_references=5, \
+                       n_jobs=None, random_state=0, min_cluster_fraction=0.1, \
+                       n_init=4):
+    """
+    Chooses the number of clusters of spike features from a range of
+    candidates. The candidates are fitted on a random subsample of the
+    spikes along one warm started K means path, with one initialization
+    per candidate, which costs far less than a full K means with many
+    initializations for every candidate. The fits of the path follow one
+    another, each using the threads of scikit-learn's K means, and the
+    candidates are then scored in parallel.
+    
+    Parameters
+    ----------
+    spike_features : ndarray
+        Features of the spikes, of shape (n_spikes, n_features)
+        
+    k_values : list
+        Candidate numbers of clusters
+        
+    criterion : str
+        'bic' for the Bayesian information criterion of a Gaussian mixture
+        started from the K means centers, lowest is best, the number of
+        clusters being that of the components of the best mixture holding
+        at least min_cluster_fraction of the spikes,
+        'silhouette' for the mean silhouette width over at most 2000 of
+        the spikes, highest is best,
+        'gap' for the gap statistic against uniform references, choosing
+        the smallest k whose gap is within one standard error of the next
+        
+    max_samples : int
+        Largest number of spikes used for choosing
+        
+    feature_scaling : bool
+        Whether to scale features to unit variance, as for kmeans
+        
+    n_references : int
+        Number of reference data sets for the gap statistic
+        
+    n_jobs : int
+        Number of threads scoring candidates, default as many as available
+        CPUs
+        
+    random_state : int
+        Seed for the subsample, the centers and the references
+        
+    min_cluster_fraction : float
+        For 'bic', smallest fraction of the spikes in a component counted
+        as a cluster. Spikes overlapping other spikes, whose waveforms are
+        mixtures, are modelled by small components of their own, which are
+        not clusters.
+        
+    Returns
+    -------
+    n_clusters : int
+        The chosen number of clusters
+        
+    k_values : ndarray
+        The candidates, in increasing order
+        
+    scores : ndarray
+        The score of each candidate
+    """
+    features = np.asarray(subsample_rows(spike_features, max_samples, random_state), \
+        dtype=np.float64)
+    if feature_scaling:
+        features = StandardScaler().fit_transform(features)
+    k_values = np.array(sorted(set(int(k) for k in k_values \
+        if 1 <= k < features.shape[0])))
+    if k_values.shape[0] == 0:
+        raise ValueError('No candidate number of clusters for %d spikes' % features.shape[0])
+    if criterion == 'silhouette' and k_values[0] < 2:
+        k_values = k_values[k_values >= 2]
+        
+    fits = kmeans_path(features, k_values, random_state)
+    
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        if criterion == 'bic':
+            def score (fit):
+                # The mixture started from the K means centers is compared
+                # with mixtures from k-means++ seeds, as a single start
+                # often merges clusters or splits one
+                labels, centers, inertia = fit
+                mixtures = [GaussianMixture(n_components=centers.shape[0], \
+                    means_init=centers, random_state=random_state).fit(features)]
+                if n_init > 1:
+                    mixtures.append(GaussianMixture(n_components=centers.shape[0], \
+                        init_params='k-means++', n_init=n_init - 1, \
+                        random_state=random_state).fit(features))
+                mixture = max(mixtures, key=lambda m: m.lower_bound_)
+                return mixture.bic(features), mixture.weights_
+            scored = list(executor.map(score, fits))
+            scores = np.array([bic for bic, weights in scored])
+            weights = scored[np.argmin(scores)][1]
+            n_clusters = max(np.sum(weights >= min_cluster_fraction), k_values[0])
+            
+        elif criterion == 'silhouette':
+            def score (fit):
+                labels, centers, inertia = fit
+                if np.unique(labels).shape[0] < 2:
+                    return -1.0
+                return silhouette_score(features, labels, \
+                    sample_size=min(2000, features.shape[0]), \
+                    random_state=random_state)
+            scores = np.array(list(executor.map(score, fits)))
+            n_clusters = k_values[np.argmax(scores)]
+            
+        elif criterion == 'gap':
+            log_w = np.log([inertia for labels, centers, inertia in fits])
+            log_w_reference = np.array(list(executor.map(\
+                lambda seed: _gap_reference(features, k_values, seed), \
+                range(random_state + 1, random_state + 1 + n_references))))
+            scores = log_w_reference.mean(axis=0) - log_w
+            s = log_w_reference.std(axis=0) * np.sqrt(1.0 + 1.0 / n_references)
+            chosen = np.flatnonzero(scores[:-1] >= scores[1:] - s[1:])
+            n_clusters = k_values[chosen[0]] if chosen.shape[0] > 0 else k_values[-1]
+            
+        else:
+            raise ValueError('Unknown criterion %s' % criterion)
+            
+    return int(n_clusters), k_values, scores
+
+__all__ = ["choose_n_clusters", "kmeans_path"]
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ${FILENAME}
+#  
+#  Copyright 2015 Anupam Mitra <anupam.mitra@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+import json
+
+import numpy as np
+import sklearn.neighbors
+
+from .. import features
+
+UNASSIGNED = -1
+
+class TemplateClassifier:
+    """
+    Assigns new spikes to the clusters of a finished spike sorting without
+    clustering again. The clusters are represented by their centroids and
+    optionally by exemplar spikes, in the scaled space of the selected
+    features, and held in a KD tree or ball tree, so each spike is assigned
+    in O(log k) for k templates. The feature extraction, the selection map
+    and the scaling are kept, so the classifier takes waveforms, and can
+    be saved and loaded for use in later sessions.
+    
+    Spikes further than a rejection distance from the nearest template are
+    labelled UNASSIGNED.
+    
+    Parameters
+    ----------
+    feature_extraction : str
+        Technique used for extraction of spike features
+        
+    selection : tuple
+        Matrix P and offset b such that the selected features are
+        np.dot(features, P) + b, see SpikeFeatures.selection_map
+        
+    mean, scale : ndarray
+        Feature scaling, subtracted from and dividing the selected features
+        
+    points : ndarray
+        Templates in the scaled feature space, of shape (n_points, n_features)
+        
+    point_labels : ndarray
+        Cluster label of each template
+        
+    reject_distance : float or ndarray
+        Distance beyond which a spike is UNASSIGNED, either one distance or
+        one per template. If None, every spike is assigned.
+        
+    tree : str
+        'kd' for a KD tree, 'ball' for a ball tree, which copes better with
+        many features
+    """
+    def __init__ (self, feature_extraction, selection, mean, scale, points, \
+                  point_labels, reject_distance=None, tree='kd'):
+        self.feature_extraction = feature_extraction
+        self.selection = (np.asarray(selection[0]), np.asarray(selection[1]))
+        self.mean = np.asarray(mean)
+        self.scale = np.asarray(scale)
+        self.points = np.asarray(points, dtype=np.float64)
+        self.point_labels = np.asarray(point_labels)
+        self.reject_distance = reject_distance
+        if tree == 'kd':
+            self.index = sklearn.neighbors.KDTree(self.points)
+        elif tree == 'ball':
+            self.index = sklearn.neighbors.BallTree(self.points)
+        else:
+            raise ValueError('Unknown tree %s' % tree)
+        self.tree = tree
+        
+    @classmethod
+    def from_sorting (cls, spike_features, spike_class_est, n_features, \
+                      n_exemplars=0, reject_quantile=None, \
+                      reject_distance=None, tree='kd', random_state=0):
+        """
+        Builds a classifier from the result of a spike sorting.
+        
+        Parameters
+        ----------
+        spike_features : SpikeFeatures
+            The features, after select_features
+            
+        spike_class_est : ndarray
+            Estimated spike classes, as from SpikeFeatureClustering. Spikes
+            labelled UNASSIGNED are left out of the templates.
+            
+        n_features : int
+            Number of selected features used for clustering
+            
+        n_exemplars : int
+            Number of randomly chosen spikes of each cluster to add as
+            templates besides its centroid, for clusters far from round
+            
+        reject_quantile : float
+            If given, each cluster rejects spikes further from its nearest
+            template than this quantile of the distances of its own spikes
+            
+        reject_distance : float
+            Distance, in scaled feature space, beyond which spikes are
+            rejected, if reject_quantile is None
+            
+        tree : str
+            'kd' or 'ball'
+            
+        random_state : int
+            Seed for the choice of exemplars
+            
+        Returns
+        -------
+        classifier : TemplateClassifier
+        """
+        P, b = spike_features.selection_map()
+        selection = (P[:, :n_features], b[:n_features])
+        features_top = np.asarray(spike_features.get_top_features(n_features), dtype=np.float64)
+        mean = features_top.mean(axis=0)
+        scale = features_top.std(axis=0)
+        scale[scale == 0] = 1.0
+        features_scaled = (features_top - mean) / scale
+        
+        spike_class_est = np.asarray(spike_class_est)
+        rng = np.random.default_rng(random_state)
+        points = []
+        point_labels = []
+        for label in np.unique(spike_class_est):
+            if label == UNASSIGNED:
+                continue
+            members = np.flatnonzero(spike_class_est == label)
+            templates = features_scaled[members].mean(axis=0, keepdims=True)
+            if n_exemplars > 0:
+                exemplars = rng.choice(members, min(n_exemplars, members.shape[0]), replace=False)
+                templates = np.concatenate([templates, features_scaled[np.sort(exemplars)]])
+            points.append(templates)
+            point_labels.append(np.full(templates.shape[0], label))
+        points = np.concatenate(points)
+        point_labels = np.concatenate(point_labels)
+        
+        classifier = cls(spike_features.feature_extraction, selection, mean, \
+            scale, points, point_labels, None, tree)
+        if reject_quantile is not None:
+            distance, nearest = classifier.index.query(features_scaled, k=1)
+            distance = distance[:, 0]
+            radius = np.zeros(points.shape[0])
+            for label in np.unique(point_labels):
+                members = spike_class_est == label
+                radius[point_labels == label] = np.quantile(distance[members], reject_quantile)
+            classifier.reject_distance = radius
+        else:
+            classifier.reject_distance = reject_distance
+        return classifier
+        
+    def transform (self, spike_features_all):
+        """
+        Selects and scales features extracted from new spikes
+        """
+        P, b = self.selection
+        features_selected = np.dot(spike_features_all, P) + b
+        return (features_selected - self.mean) / self.scale
+        
+    def predict_features (self, spike_features_all, return_distance=False):
+        """
+        Labels spikes from all their extracted features, before selection.
+        
+        Parameters
+        ----------
+        spike_features_all : ndarray
+            Features extracted from the spikes, of shape (n_spikes, n_total_features)
+            
+        return_distance : bool
+            Whether to also return the distance to the nearest template
+            
+        Returns
+        -------
+        spike_class_est : ndarray
+            Label of the nearest template, or UNASSIGNED
+            
+        distance : ndarray
+            Distance to the nearest template, if return_distance is True
+        """
+        features_scaled = self.transform(spike_features_all)
+        if features_scaled.shape[0] == 0:
+            labels = np.empty(0, dtype=self.point_labels.dtype)
+            return (labels, np.empty(0)) if return_distance else labels
+        distance, nearest = self.index.query(features_scaled, k=1)
+        distance = distance[:, 0]
+        nearest = nearest[:, 0]
+        spike_class_est = self.point_labels[nearest]
+        if self.reject_distance is not None:
+            reject_distance = np.asarray(self.reject_distance)
+            if reject_distance.ndim > 0:
+                reject_distance = reject_distance[nearest]
+            spike_class_est = np.where(distance > reject_distance, \
+                UNASSIGNED, spike_class_est)
+        if return_distance:
+            return spike_class_est, distance
+        return spike_class_est
+        
+    def predict (self, spike_waveforms, return_distance=False):
+        """
+        Labels spike waveforms, see predict_features
+        
+        Parameters
+        ----------
+        spike_waveforms : ndarray
+            The waveforms in physical units, of the same shape per spike as
+            those sorted
+        """
+        spike_features_all = features.extract_features(\
+            np.asarray(spike_waveforms), self.feature_extraction)
+        return self.predict_features(spike_features_all, return_distance)
+        
+    def save (self, filename):
+        """
+        Saves the classifier to a .npz file
+        """
+        reject_distance = self.reject_distance
+        metadata = {\
+            'feature_extraction': self.feature_extraction, 'tree': self.tree, \
+            'reject': 'none' if reject_distance is None else \
+                ('scalar' if np.ndim(reject_distance) == 0 else 'array')}
+        np.savez(filename, metadata=np.array(json.dumps(metadata)), \
+            P=self.selection[0], b=self.selection[1], mean=self.mean, \
+            scale=self.scale, points=self.points, point_labels=self.point_labels, \
+            reject_distance=np.asarray(0.0 if reject_distance is None else reject_distance))
+        
+    @classmethod
+    def load (cls, filename):
+        """
+        Loads a classifier saved with save. The tree is rebuilt from the
+        templates.
+        """
+        with np.load(filename, allow_pickle=False) as f:
+            metadata = json.loads(str(f['metadata']))
+            reject_distance = f['reject_distance']
+            if metadata['reject'] == 'none':
+                reject_distance = None
+            elif metadata['reject'] == 'scalar':
+                reject_distance = float(reject_distance)
+            return cls(metadata['feature_extraction'], (f['P'], f['b']), \
+                f['mean'], f['scale'], f['points'], f['point_labels'], \
+                reject_distance, metadata['tree'])
+
+__all__ = ["TemplateClassifier", "UNASSIGNED"]
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ${FILENAME}
+#  
+#  Copyright 2015 Anupam Mitra <anupam.mitra@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+import numpy as np
+import scipy.optimize
+import sklearn.metrics
+
+def _nearest_within (t_from, t_to, tolerance):
+    # For each time in t_from, the index of the nearest time in the sorted
+    # t_to and the distance to it, or -1 when none is within tolerance
+    n_to = t_to.shape[0]
+    right = np.searchsorted(t_to, t_from)
+    left = right - 1
+    right_distance = np.where(right < n_to, \
+        np.abs(t_to[np.minimum(right, n_to - 1)] - t_from), np.inf)
+    left_distance = np.where(left >= 0, \
+        np.abs(t_from - t_to[np.maximum(left, 0)]), np.inf)
+    nearest = np.where(left_distance <= right_distance, left, right)
+    distance = np.minimum(left_distance, right_distance)
+    nearest[distance > tolerance] = -1
+    return nearest, distance
+
+def match_spikes (t_true, t_detect, tolerance):
+    """
+    Matches detected spikes to true spikes one to one, each detected spike
+    to a true spike at most tolerance samples away. Each pass pairs every
+    unmatched detection with its nearest unmatched true spike by
+    searchsorted, keeping the closest detection where several claim the
+    same true spike, so each pass takes O(n log n) and few passes are
+    needed unless spikes are much closer together than tolerance.
+    
+    Parameters
+    ----------
+    t_true : ndarray
+        Times of the true spikes
+        
+    t_detect : ndarray
+        Times of the detected spikes
+        
+    tolerance : float
+        Largest distance in samples between matched spikes
+        
+    Returns
+    -------
+    index_true : ndarray
+        Indices into t_true of the matched true spikes
+        
+    index_detect : ndarray
+        Indices into t_detect of the detected spikes they are matched to
+    """
+    t_true = np.asarray(t_true, dtype=np.int64)
+    t_detect = np.asarray(t_detect, dtype=np.int64)
+    order_true = np.argsort(t_true, kind='stable')
+    order_detect = np.argsort(t_detect, kind='stable')
+    
+    matched_true = []
+    matched_detect = []
+    free_true = order_true
+    free_detect = order_detect
+    while free_true.shape[0] > 0 and free_detect.shape[0] > 0:
+        nearest, distance = _nearest_within(t_detect[free_detect], \
+            t_true[free_true], tolerance)
+        candidates = np.flatnonzero(nearest >= 0)
+        if candidates.shape[0] == 0:
+            break
+        # Where several detections claim one true spike the closest wins,
+        # the others try again among the true spikes left
+        by_distance = candidates[np.lexsort(\
+            (candidates, distance[candidates], nearest[candidates]))]
+        first = np.ones(by_distance.shape[0], dtype=bool)
+        first[1:] = nearest[by_distance[1:]] != nearest[by_distance[:-1]]
+        winners = by_distance[first]
+        matched_true.append(free_true[nearest[winners]])
+        matched_detect.append(free_detect[winners])
+        
+        keep_true = np.ones(free_true.shape[0], dtype=bool)
+        keep_true[nearest[winners]] = False
+        keep_detect = np.ones(free_detect.shape[0], dtype=bool)
+        keep_detect[winners] = False
+        # Detections with no true spike within tolerance never match
+        keep_detect[nearest < 0] = False
+        free_true = free_true[keep_true]
+        free_detect = free_detect[keep_detect]
+        
+    if not matched_true:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    index_true = np.concatenate(matched_true)
+    index_detect = np.concatenate(matched_detect)
+    order = np.argsort(index_true, kind='stable')
+    return index_true[order], index_detect[order]
+
+def evaluate_detection (t_true, t_detect, tolerance=10):
+    """
+    Scores spike detection against ground truth.
+    
+    Parameters
+    ----------
+    t_true : ndarray
+        Times of the true spikes
+        
+    t_detect : ndarray
+        Times of the detected spikes
+        
+    tolerance : float
+        Largest distance in samples between matched spikes
+        
+    Returns
+    -------
+    evaluation : dict
+        Numbers of hits, misses and false_positives, precision and
+        recall, and the matched indices index_true and index_detect
+    """
+    index_true, index_detect = match_spikes(t_true, t_detect, tolerance)
+    n_true = np.shape(t_true)[0]
+    n_detect = np.shape(t_detect)[0]
+    hits = index_true.shape[0]
+    return {\
+        'hits': hits, 'misses': n_true - hits, \
+        'false_positives': n_detect - hits, \
+        'precision': hits / float(n_detect) if n_detect else np.nan, \
+        'recall': hits / float(n_true) if n_true else np.nan, \
+        'index_true': index_true, 'index_detect': index_detect}
+
+def _adjusted_rand_index (contingency):
+    # Adjusted Rand index from the contingency table, as computed by
+    # sklearn.metrics.adjusted_rand_score from the labels
+    contingency = contingency.astype(np.float64)
+    n = contingency.sum()
+    sum_cells = np.sum(contingency * (contingency - 1)) / 2.0
+    rows = contingency.sum(axis=1)
+    columns = contingency.sum(axis=0)
+    sum_rows = np.sum(rows * (rows - 1)) / 2.0
+    sum_columns = np.sum(columns * (columns - 1)) / 2.0
+    expected = sum_rows * sum_columns / (n * (n - 1) / 2.0) if n > 1 else 0.0
+    maximum = (sum_rows + sum_columns) / 2.0
+    if maximum == expected:
+        return 1.0
+    return (sum_cells - expected) / (maximum - expected)
+
+def evaluate_sorting (t_true, spike_class, t_detect, spike_class_est, \
+                      tolerance=10):
+    """
+    Scores spike sorting against ground truth. Detected spikes are matched
+    to true spikes, and each true unit is paired with at most one cluster
+    by maximizing the number of spikes they share.
+    
+    Parameters
+    ----------
+    t_true : ndarray
+        Times of the true spikes
+        
+    spike_class : ndarray
+        Unit of each true spike
+        
+    t_detect : ndarray
+        Times of the detected spikes
+        
+    spike_class_est : ndarray
+        Cluster of each detected spike
+        
+    tolerance : float
+        Largest distance in samples between matched spikes
+        
+    Returns
+    -------
+    evaluation : dict
+        units and clusters, the labels of each;
+        confusion, the number of matched spikes of each unit (rows) in
+        each cluster (columns), with an extra column of true spikes not
+        detected and an extra row of detected spikes matching no true spike;
+        cluster_of_unit, the cluster paired with each unit, or None;
+        per unit arrays unit_hits (spikes of the unit in its cluster),
+        unit_misses (spikes of the unit not detected or in other clusters)
+        and unit_false_positives (other spikes in its cluster);
+        the detection scores of evaluate_detection;
+        ami and ari of the matched spikes
+    """
+    spike_class = np.asarray(spike_class)
+    spike_class_est = np.asarray(spike_class_est)
+    detection = evaluate_detection(t_true, t_detect, tolerance)
+    index_true = detection['index_true']
+    index_detect = detection['index_detect']
+    
+    units, unit_index = np.unique(spike_class, return_inverse=True)
+    clusters, cluster_index = np.unique(spike_class_est, return_inverse=True)
+    n_units = units.shape[0]
+    n_clusters = clusters.shape[0]
+    
+    # Unmatched true spikes go to the last column, unmatched detections to
+    # the last row
+    row = np.full(spike_class_est.shape[0], n_units)
+    row[index_detect] = unit_index[index_true]
+    confusion = np.bincount(row * (n_clusters + 1) + cluster_index, \
+        minlength=(n_units + 1) * (n_clusters + 1)).reshape(n_units + 1, n_clusters + 1)
+    detected = np.zeros(spike_class.shape[0], dtype=bool)
+    detected[index_true] = True
+    confusion[:n_units, n_clusters] = np.bincount(unit_index[~detected], minlength=n_units)
+    
+    pair_unit, pair_cluster = scipy.optimize.linear_sum_assignment(\
+        -confusion[:n_units, :n_clusters])
+    cluster_of_unit = np.full(n_units, -1)
+    cluster_of_unit[pair_unit] = pair_cluster
+    
+    unit_totals = confusion[:n_units].sum(axis=1)
+    cluster_totals = confusion[:, :n_clusters].sum(axis=0)
+    hits = np.zeros(n_units, dtype=np.int64)
+    hits[pair_unit] = confusion[pair_unit, pair_cluster]
+    false_positives = np.zeros(n_units, dtype=np.int64)
+    false_positives[pair_unit] = cluster_totals[pair_cluster] - hits[pair_unit]
+    
+    if index_true.shape[0] > 0:
+        ami = sklearn.metrics.adjusted_mutual_info_score(\
+            spike_class[index_true], spike_class_est[index_detect])
+        ari = _adjusted_rand_index(confusion[:n_units, :n_clusters])
+    else:
+        ami = ari = np.nan
+        
+    evaluation = dict(detection)
+    evaluation.update({\
+        'units': units, 'clusters': clusters, 'confusion': confusion, \
+        'cluster_of_unit': [clusters[c].item() if c >= 0 else None for c in cluster_of_unit], \
+        'unit_hits': hits, 'unit_misses': unit_totals - hits, \
+        'unit_false_positives': false_positives, 'ami': ami, 'ari': ari})
+    return evaluation
+
+__all__ = ["match_spikes", "evaluate_detection", "evaluate_sorting"]
@@ -22,12 +22,160 @@
 #  
 #  
 
+import numpy as np
+
 from .raw import *
 from .spectral import *
 from .featureselect import *
 from .decomposition import *
 from .diff import *
-from ..signals import Recording
+from ..cache import recording_digest
+
+FEATURE_FAMILIES = ('raw', 'hw', 'fsd', 'fdl')
+
+def _extract_family (spike_waveforms, feature_extraction, out=None):
+    # Features of one technique along the last axis, written to out if given
+    feature_extraction = feature_extraction.lower()
+    if feature_extraction == 'raw':
+        if out is None:
+            return spike_waveforms
+        np.copyto(out, spike_waveforms)
+        return out
+
+    elif feature_extraction == 'hw':
+        return wavelet_decomp(spike_waveforms, out=out)
+    
+    elif feature_extraction == 'fsd':
+        return firstsecond_differences(spike_waveforms, out=out)
+        
+    elif feature_extraction == 'fdl':
+        return first_difference_lag(spike_waveforms, [1, 3, 7], out=out)
+        
+    else:
+        raise ValueError("Unknown feature extraction technique %r" % (feature_extraction,))
+
+def extract_features (spike_waveforms, feature_extraction):
+    """
+    Extracts features from spike waveforms
+    
+    Parameters
+    ----------
+    spike_waveforms: ndarray
+        The waveforms, of shape (n_spikes, n_samples) or
+        (n_spikes, n_channels, n_samples)
+        
+    feature_extraction: str
+        Technique to use for extraction of spike features, see SpikeFeatures
+        
+    Returns
+    -------
+    features: ndarray
+        The features, of shape (n_spikes, n_features). The features of all
+        channels of multichannel waveforms are concatenated.
+    """
+    features = _extract_family(spike_waveforms, feature_extraction)
+        
+    if features.ndim > 2:
+        # Features of all channels of multichannel waveforms
+        features = features.reshape(features.shape[0], -1)
+    return features
+
+def feature_matrix (waveform_shape, feature_extraction):
+    """
+    Matrix of the feature extraction techniques, all of which are linear in
+    the waveform, such that features = waveforms.reshape(n_spikes, -1) @ E
+    
+    Parameters
+    ----------
+    waveform_shape: tuple
+        Shape of one waveform, (n_samples,) or (n_channels, n_samples)
+        
+    feature_extraction: str
+        Technique to use for extraction of spike features, see SpikeFeatures
+        
+    Returns
+    -------
+    E: ndarray
+        The matrix, of shape (prod(waveform_shape), n_features)
+    """
+    n_inputs = int(np.prod(waveform_shape))
+    basis = np.eye(n_inputs).reshape((n_inputs,) + tuple(waveform_shape))
+    return extract_features(basis, feature_extraction)
+
+class FeatureBlock:
+    """
+    Features of several extraction techniques computed from the same spike
+    waveforms in one pass, stored side by side in a single preallocated
+    array. The features of each technique are a view of its columns.
+    
+    Parameters
+    ----------
+    spike_waveforms: ndarray
+        The waveforms, of shape (n_spikes, n_samples) or
+        (n_spikes, n_channels, n_samples)
+        
+    families: sequence of str
+        Feature extraction techniques to compute, see SpikeFeatures
+        
+    dtype: dtype
+        Floating point type of the features. If None, that of the
+        waveforms, or float64 for integer waveforms.
+        
+    Attributes
+    ----------
+    features: ndarray
+        All features, of shape (n_spikes, n_columns)
+        
+    columns: dict
+        Slice of the columns of each technique in features
+        
+    labels: ndarray
+        Label of each column, 'family:index', or 'family:channel:index'
+        for multichannel waveforms
+    """
+    def __init__ (self, spike_waveforms, families=FEATURE_FAMILIES, dtype=None):
+        spike_waveforms = np.asanyarray(spike_waveforms)
+        if dtype is None:
+            dtype = spike_waveforms.dtype
+            if not np.issubdtype(dtype, np.floating):
+                dtype = np.float64
+        self.families = tuple(dict.fromkeys(f.lower() for f in families))
+        
+        n_spikes = spike_waveforms.shape[0]
+        channel_shape = spike_waveforms.shape[1:-1]
+        n_channels = int(np.prod(channel_shape))
+        
+        # Number of features of one channel, from a single zero waveform
+        widths = [_extract_family(\
+            np.zeros((1, spike_waveforms.shape[-1]), dtype=dtype), f).shape[-1] \
+            for f in self.families]
+        
+        self.columns = {}
+        labels = []
+        start = 0
+        for family, width in zip(self.families, widths):
+            self.columns[family] = slice(start, start + n_channels*width)
+            start += n_channels*width
+            if channel_shape:
+                labels += ['%s:%d:%d' % (family, c, i) \
+                    for c in range(n_channels) for i in range(width)]
+            else:
+                labels += ['%s:%d' % (family, i) for i in range(width)]
+        self.labels = np.array(labels)
+        
+        self.features = np.empty((n_spikes, start), dtype=dtype)
+        for family, width in zip(self.families, widths):
+            # Written through a view of the columns, channel by channel for
+            # multichannel waveforms
+            out = self.features[:, self.columns[family]]
+            out = out.reshape((n_spikes,) + channel_shape + (width,))
+            _extract_family(spike_waveforms, family, out=out)
+            
+    def __getitem__ (self, family):
+        return self.features[:, self.columns[family.lower()]]
+        
+    def __contains__ (self, family):
+        return family.lower() in self.columns
 
 class SpikeFeatures:
     """
@@ -61,56 +209,146 @@ class SpikeFeatures:
         Number of samples after the peak of a spike to include in the
         spike shape
         
+    cache: FeatureCache
+        If given, waveforms and features are looked up in and stored to
+        this on disk cache, and are memory maps of the cached arrays
+        
+    float_dtype: dtype
+        Floating point type of the waveforms and features. If None, the
+        float_dtype of the recording is used.
+        
+    selection_max_samples: int
+        For 'lt' selection, if given and there are more spikes than this,
+        features are ranked on a random subsample of this many spikes, see
+        kstestnormal
+        
     """
     def __init__(self, recording, feature_extraction, feature_selection,\
-                samples_before=20, samples_after=44):
+                samples_before=20, samples_after=44, cache=None, \
+                float_dtype=None, selection_max_samples=None):
+        if float_dtype is None:
+            float_dtype = getattr(recording, 'float_dtype', np.float64)
+        self.float_dtype = np.dtype(float_dtype)
         self.recording = recording
         self.samples_before = samples_before
         self.samples_after = samples_after
         self.feature_extraction = feature_extraction
         self.feature_selection = feature_selection
-        self.spike_waveforms = extract_waveforms(recording.t_spikes, recording.data, samples_before, samples_after)
+        self.selection_max_samples = selection_max_samples
+        self.cache = cache
+        if cache is None:
+            self.spike_waveforms = self._extract_waveforms()
+        else:
+            self.waveforms_key = cache.key('waveforms', \
+                recording_digest(recording), np.asarray(recording.t_spikes), \
+                getattr(recording, 'spike_channels', None), \
+                samples_before, samples_after, self.float_dtype.str)
+            self.spike_waveforms = \
+                cache.cached(self.waveforms_key, self._extract_waveforms)
+            
+    def _extract_waveforms (self):
+        recording = self.recording
+        spike_waveforms = extract_waveforms(recording.t_spikes, \
+            recording.data, self.samples_before, self.samples_after, \
+            channels=getattr(recording, 'spike_channels', None), \
+            dtype=self.float_dtype)
+        if getattr(recording, 'gain', 1.0) != 1.0:
+            # Only the samples around spikes are read from memory mapped
+            # recordings, and converted to physical units afterwards
+            spike_waveforms *= recording.gain
+        return spike_waveforms
         
     def extract_features (self):
         """
         Feature extraction step of spike sorting
         """
-        if self.feature_extraction.lower() == 'raw':
-            self.features = self.spike_waveforms
-
-        elif self.feature_extraction.lower() == 'hw':
-            self.features = wavelet_decomp(self.spike_waveforms)
-        
-        elif self.feature_extraction.lower() == 'fsd':
-            self.features = firstsecond_differences(self.spike_waveforms)
-            
-        elif self.feature_extraction.lower() == 'fdl':
-            self.features = first_difference_lag(self.spike_waveforms, [1, 3, 7])
-            
+        feature_block = getattr(self, 'feature_block', None)
+        compute = self._extract_features
+        if feature_block is not None and self.feature_extraction in feature_block:
+            compute = lambda: feature_block[self.feature_extraction]
+        if self.cache is None or self.feature_extraction.lower() == 'raw':
+            self.features = compute()
+        else:
+            # Features taken from a block are stored too, so that other
+            # processes find them in the cache
+            self.features = self.cache.cached(\
+                self.cache.key('features', self.waveforms_key, \
+                    self.feature_extraction.lower()), compute)
         self.n_total_features = self.features.shape[1]
         
-    def select_features (self):
+    def _extract_features (self):
+        return extract_features(self.spike_waveforms, self.feature_extraction)
+        
+    def extract_feature_block (self, families=FEATURE_FAMILIES):
+        """
+        Extracts the features of several techniques at once into a
+        FeatureBlock, kept as feature_block. Afterwards extract_features
+        takes the features of any technique in the block as a view of it,
+        so that comparing techniques needs a single extraction. Change
+        feature_extraction and call extract_features again to switch.
+        """
+        self.feature_block = FeatureBlock(self.spike_waveforms, families, \
+            dtype=self.float_dtype)
+        return self.feature_block
+        
+    def select_features (self, n_features=None):
         """
         Feature selection by ranking features based on a criterion.
+        
+        Parameters
+        ----------
+        n_features: int
+            Number of principal components to compute for 'pca'. If None,
+            all are computed. Other criteria rank all features.
         """
-        if self.feature_selection.lower() == 'pca':
-            self.features_selected = \
-                principalcomp(self.features, \
-                    n_components=self.n_total_features)
-            self.index_features_selected = range(self.n_total_features)
-        elif self.feature_selection.lower() == 'var':
+        feature_selection = self.feature_selection.lower()
+        self.decomposition = None
+        if feature_selection == 'pca':
+            n_components = self.n_total_features
+            if n_features is not None:
+                n_components = min(n_features, n_components)
+            self.features_selected, self.decomposition = \
+                principalcomp(self.features, n_components=n_components, \
+                    return_model=True)
+            self.index_features_selected = np.arange(n_components)
+            return
+        elif feature_selection == 'var':
             self.index_features_selected = variance(self.features)
-        elif self.feature_selection.lower() == 'lt':
-            self.index_features_selected = kstestnormal(self.features)
+        elif feature_selection == 'lt':
+            self.index_features_selected = kstestnormal(self.features, \
+                max_samples=self.selection_max_samples)
+        else:
+            raise ValueError('Unknown feature selection %s' % self.feature_selection)
             
         self.features_selected = self.features[:, self.index_features_selected]
+        
+    def selection_map (self):
+        """
+        Returns the matrix P and offset b of the feature selection, such
+        that features_selected == np.dot(features, P) + b
+        """
+        if self.decomposition is not None:
+            return affine_map(self.decomposition)
+        P = np.eye(self.n_total_features)[:, self.index_features_selected]
+        return P, np.zeros(P.shape[1])
+        
+    def transform_features (self, features):
+        """
+        Applies the fitted feature selection to features of other spikes,
+        projecting them on the principal components for 'pca' without
+        refitting
+        """
+        if self.decomposition is not None:
+            return self.decomposition.transform(features)
+        return np.asarray(features)[:, self.index_features_selected]
                     
     def get_top_features (self, n_features):
         features_top = self.features_selected[:, :n_features]
         return features_top
 
 __all__ = [\
-          "SpikeFeatures",
+          "SpikeFeatures", "FeatureBlock", "FEATURE_FAMILIES", \
+          "extract_features", "feature_matrix",
           "kstestnormal", "variance", "selectfeatures", \
           "principalcomp", "indepcomp", \
           "wavelet_decomp", "firstsecond_difference", "first_difference_lag", \
@@ -24,9 +24,19 @@
 
 import numpy as np
 import sklearn.decomposition
+import sklearn.pipeline
 import sklearn.preprocessing
+import sklearn.utils
     
-def principalcomp (s, n_components=None, scale=False):
+def _scaled_batches (s, batch_size, scaler):
+    for batch in sklearn.utils.gen_batches(s.shape[0], batch_size):
+        s_batch = np.asarray(s[batch], dtype=np.float64)
+        if scaler is not None:
+            s_batch = scaler.transform(s_batch)
+        yield batch, s_batch
+
+def principalcomp (s, n_components=None, scale=False, svd_solver='auto', \
+                   batch_size=None, random_state=0, return_model=False):
     """
     Extracts features based on decomposition in terms of principal 
     components
@@ -35,19 +45,112 @@ def principalcomp (s, n_components=None, scale=False):
     ----------
     s:
         Signal segments from which to compute first difference with
-        lag. The shape should be (n_signals, n_samples)
+        lag. The shape should be (n_signals, n_samples). For the incremental
+        solver this may be a memory map larger than memory.
     
     n_components:
-        Number of principal components to use
+        Number of principal components to use. If None, all components are
+        computed.
         
     scale:
+        Whether to scale each column to unit variance before decomposition
+        
+    svd_solver:
+        'full' for a full singular value decomposition, 'randomized' for a
+        randomized one, which is much faster for few components,
+        'incremental' to fit batch by batch, or 'auto' to use incremental
+        fitting when batch_size is given and otherwise let
+        sklearn.decomposition.PCA choose between full and randomized
+        
+    batch_size:
+        Number of rows per batch for incremental fitting and projection
+        
+    random_state:
+        Seed for the randomized solver
+        
+    return_model:
+        Whether to also return the fitted model, whose transform method
+        projects later spikes on the same basis
+        
+    Returns
+    -------
+    s_pca:
+        The principal components of each segment, of shape
+        (n_signals, n_components)
+        
+    model:
+        The fitted PCA or IncrementalPCA, preceded by a StandardScaler in a
+        pipeline if scale is True, if return_model is True
+    """
+    if n_components is None:
+        n_components = min(np.shape(s))
+    if svd_solver == 'auto' and batch_size is not None:
+        svd_solver = 'incremental'
+        
+    if svd_solver == 'incremental':
+        if batch_size is None:
+            batch_size = max(5 * np.shape(s)[1], 4096)
+        batch_size = max(batch_size, n_components)
+        scaler = None
+        if scale:
+            scaler = sklearn.preprocessing.StandardScaler()
+            for batch, s_batch in _scaled_batches(s, batch_size, None):
+                scaler.partial_fit(s_batch)
+        pca = sklearn.decomposition.IncrementalPCA(n_components=n_components)
+        for batch in sklearn.utils.gen_batches(np.shape(s)[0], batch_size, \
+                                               min_batch_size=n_components):
+            s_batch = np.asarray(s[batch], dtype=np.float64)
+            if scaler is not None:
+                s_batch = scaler.transform(s_batch)
+            pca.partial_fit(s_batch)
+        s_pca = np.empty((np.shape(s)[0], n_components))
+        for batch, s_batch in _scaled_batches(s, batch_size, scaler):
+            s_pca[batch] = pca.transform(s_batch)
+    else:
+        scaler = None
+        if scale:
+            scaler = sklearn.preprocessing.StandardScaler()
+            s = scaler.fit_transform(s)
+        pca = sklearn.decomposition.PCA(n_components=n_components, \
+            svd_solver=svd_solver, random_state=random_state)
+        s_pca = pca.fit_transform(s)
+        
+    if not return_model:
+        return s_pca
+    if scaler is None:
+        return s_pca, pca
+    return s_pca, sklearn.pipeline.Pipeline([('scaler', scaler), ('pca', pca)])
+
+def affine_map (model):
+    """
+    Returns the projection matrix and offset of a model returned by
+    principalcomp, such that model.transform(s) == np.dot(s, P) + b
     
+    Parameters
+    ----------
+    model:
+        A fitted PCA or IncrementalPCA, possibly preceded by a
+        StandardScaler in a pipeline
+        
+    Returns
+    -------
+    P:
+        Projection matrix, of shape (n_samples, n_components)
+        
+    b:
+        Offset, of shape (n_components,)
     """
-    if n_components == None:
-        n_components =  np.shape(s)[1]
-    if scale:
-        s = sklearn.preprocessing.scale(s)
-    pca = sklearn.decomposition.PCA(n_components=n_components)
-    pca.fit(s)
-    s_pca = pca.transform(s)
-    return s_pca
+    pca = model
+    scale = 1.0
+    shift = 0.0
+    if isinstance(model, sklearn.pipeline.Pipeline):
+        scaler = model.named_steps['scaler']
+        pca = model.named_steps['pca']
+        scale = 1.0 / scaler.scale_
+        shift = scaler.mean_ * scale
+    P = pca.components_.T
+    if getattr(pca, 'whiten', False):
+        P = P / np.sqrt(pca.explained_variance_)
+    b = -np.dot(shift + pca.mean_, P)
+    P = P * np.reshape(scale, (-1, 1))
+    return P, b
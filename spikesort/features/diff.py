@@ -41,14 +41,223 @@ def teo(x, k=1):
     te : ndarray
         The operated signal
     """
+    x = np.asarray(x)
+    if not np.issubdtype(x.dtype, np.floating):
+        x = x.astype(np.float64)
     num_samples = np.shape(x)[0]
-    te = np.zeros(np.shape(x))
-    te = x**2 - \
-        np.concatenate([np.zeros(k), x[0 : num_samples - k]]) *\
-        np.concatenate([x[k :], np.zeros(k)])
+    te = np.square(x)
+    # The signal is taken as zero outside, so the edges keep x**2
+    if num_samples > 2*k:
+        te[k : num_samples - k] -= x[0 : num_samples - 2*k] * x[2*k :]
     return te
 
-def mteo (x, k_values):
+def mteo_windows (k_values):
+    """
+    Hamming smoothing windows of length 4k+1 for each k, zero padded at
+    the end to a common length, as rows of an array.
+    """
+    from scipy.signal.windows import hamming
+    
+    k_values = np.asarray(k_values, dtype=np.intp)
+    windows = np.zeros((k_values.shape[0], 4*np.max(k_values) + 1))
+    for i, k in enumerate(k_values):
+        windows[i, :4*k + 1] = hamming(4*k + 1)
+    return windows
+
+def mteo_variance (x, k_values, chunk_size=2**16, end=True):
+    """
+    Variance of the Teager energy of a signal for each value of k, by
+    which the energies are normalized in MTEO, computed chunk by chunk.
+    
+    Parameters
+    ----------
+    x : ndarray
+        The signal, or a training segment of it
+        
+    k_values : ndarray
+        The values of k to use for estimating MTEO
+        
+    chunk_size : int
+        Number of samples processed at a time
+        
+    end : bool
+        Whether x ends the signal, so that the energies of its last
+        max(k_values) samples are included as in mteo
+        
+    Returns
+    -------
+    variance : ndarray
+        The variance of the energy for each value of k
+    """
+    operator = StreamingMTEO(k_values, variance=np.ones(len(k_values)))
+    for start in range(0, x.shape[0], chunk_size):
+        operator._update_variance(operator.energies(x[start:start + chunk_size]))
+    if end:
+        operator._update_variance(operator.energies(np.zeros(operator.k_max)))
+    return operator.running_variance()
+
+class StreamingMTEO:
+    """
+    Multi resolution Teagre Energy Operator of a signal arriving in
+    consecutive chunks. For each chunk, the energies for all values of k
+    are computed together, smoothed with the Hamming windows by overlap add
+    convolution, divided by the variance of the energy for each k, and the
+    maximum over k is returned. Only the last samples of the signal and the
+    tails of the convolutions are kept between chunks, so the memory used
+    depends on the chunk size and not on the length of the signal.
+    
+    The energy at a sample needs the signal max(k_values) samples later, so
+    the output lags the input by that many samples, and flush gives the
+    last samples, with the signal taken as zero after its end as in teo.
+    
+    Parameters
+    ----------
+    k_values : ndarray
+        The values of k to use for estimating MTEO
+        
+    variance : ndarray
+        Variance of the energy for each value of k. If None, it is
+        computed from a training segment, the first training_size samples
+        of the signal, which are held back until then. The output thus
+        does not depend on how the signal is split into chunks, and for
+        signals no longer than training_size equals mteo.
+        
+    training_size : int
+        Number of samples of the training segment
+    """
+    def __init__ (self, k_values, variance=None, training_size=2**20):
+        self.k_values = np.asarray(k_values, dtype=np.intp)
+        if np.any(self.k_values < 1):
+            raise ValueError('Values of k must be positive')
+        self.k_max = int(np.max(self.k_values))
+        self.windows = mteo_windows(self.k_values)
+        self.variance = None if variance is None else np.asarray(variance, dtype=np.float64)
+        self.training_size = training_size
+        self.reset()
+        
+    def reset (self):
+        n_k = self.k_values.shape[0]
+        # The signal before its start is taken as zero, as in teo
+        self._x_tail = np.zeros(self.k_max)
+        self._conv_tail = np.zeros((n_k, self.windows.shape[1] - 1))
+        self._count = 0
+        self._mean = np.zeros(n_k)
+        self._m2 = np.zeros(n_k)
+        self._variance = self.variance
+        self._training = []
+        self._n_training = 0
+        self.n_samples_out = 0
+        
+    def running_variance (self):
+        """
+        Variance of the energy for each value of k over the energies
+        accumulated with _update_variance
+        """
+        return self._m2 / max(self._count, 1)
+        
+    def _update_variance (self, te):
+        # Chan et al. update of the mean and sum of squared deviations.
+        # Chunks shorter than 2*max(k_values) give no energies until
+        # more samples arrive.
+        n = te.shape[1]
+        if n == 0:
+            return
+        mean = np.mean(te, axis=1)
+        m2 = np.sum((te - mean[:, np.newaxis])**2, axis=1)
+        count = self._count + n
+        delta = mean - self._mean
+        self._mean += delta * n / count
+        self._m2 += m2 + delta**2 * self._count * n / count
+        self._count = count
+        
+    def energies (self, x):
+        """
+        Teager energies of the next chunk for each value of k, before
+        smoothing, of shape (len(k_values), n), where n is the number of
+        samples whose energies can be computed
+        """
+        from numpy.lib.stride_tricks import sliding_window_view
+        
+        k_max = self.k_max
+        ext = np.concatenate([self._x_tail, np.asarray(x, dtype=np.float64)])
+        n = ext.shape[0] - 2*k_max
+        if n <= 0:
+            self._x_tail = ext
+            return np.empty((self.k_values.shape[0], 0))
+        self._x_tail = ext[n:]
+        
+        windows = sliding_window_view(ext, 2*k_max + 1)
+        centre = windows[:, k_max]
+        te = centre**2 - \
+            (windows[:, k_max - self.k_values] * windows[:, k_max + self.k_values]).T
+        return te
+        
+    def _process (self, x):
+        te = self.energies(x)
+        n = te.shape[1]
+        if n == 0:
+            return np.empty(0)
+        
+        from scipy.signal import oaconvolve
+        smoothed = oaconvolve(te, self.windows, mode='full', axes=-1)
+        smoothed[:, :self._conv_tail.shape[1]] += self._conv_tail
+        self._conv_tail = smoothed[:, n:]
+        
+        # A constant energy, as for a signal of one sample, has no variance
+        # and is left unnormalized
+        variance = np.where(self._variance > 0, self._variance, 1.0)
+        smoothed = smoothed[:, :n] / variance[:, np.newaxis]
+        self.n_samples_out += n
+        return np.max(smoothed, axis=0)
+        
+    def _end_training (self, end):
+        # The variance is computed from exactly the first training_size
+        # samples, and the samples held back are then operated on like any
+        # other chunk
+        held = np.concatenate([np.empty(0)] + self._training)
+        self._training = []
+        self._variance = mteo_variance(held[:self.training_size], \
+            self.k_values, end=end)
+        return self._process(held)
+        
+    def process (self, x):
+        """
+        Operates on the next chunk of the signal.
+        
+        Parameters
+        ----------
+        x : ndarray
+            The next samples of the signal
+            
+        Returns
+        -------
+        tem : ndarray
+            The operated signal for the samples from n_samples_out, before
+            this call, on. It is empty while the training segment is being
+            collected.
+        """
+        if self._variance is not None:
+            return self._process(x)
+        self._training.append(np.asarray(x, dtype=np.float64))
+        self._n_training += self._training[-1].shape[0]
+        if self._n_training < self.training_size:
+            return np.empty(0)
+        return self._end_training(end=False)
+        
+    def flush (self):
+        """
+        Returns the operated signal for the last max(k_values) samples, and
+        resets the state
+        """
+        tem = [np.empty(0)]
+        if self._variance is None:
+            # The whole signal was shorter than the training segment
+            tem.append(self._end_training(end=True))
+        tem.append(self._process(np.zeros(self.k_max)))
+        self.reset()
+        return np.concatenate(tem)
+
+def mteo (x, k_values, chunk_size=2**16):
     """
     Multi resolution Teagre Energy Operator
 
@@ -59,26 +268,34 @@ def mteo (x, k_values):
 
     k_values : ndarray
         The values of k to use for estimating MTEO
+        
+    chunk_size : int
+        Number of samples processed at a time. Memory use is of the order of
+        len(k_values) * chunk_size, rather than len(k_values) * len(x).
 
     Returns
     -------
     tem : ndarray
         The operated signal
     """
-    from scipy.signal import hamming
-    from scipy.signal import lfilter
-
-    teo_k_wise = np.zeros((len(k_values), len(x)))
-    for i in range(len(k_values)):
-        teo_k_wise[i, :] = teo(x, k_values[i])
-        variance = np.var(teo_k_wise[i, :])
-        window = hamming(4*k_values[i] + 1)
-        teo_k_wise[i, :] = lfilter(window, 1, teo_k_wise[i, :]) / variance
+    x = np.asarray(x)
+    n_samples = x.shape[0]
     
-    tem = np.max(teo_k_wise, axis=0)
+    # First pass for the variance of the energy for each k, as the energies
+    # are normalized by their variance over the whole signal
+    operator = StreamingMTEO(k_values, \
+        variance=mteo_variance(x, k_values, chunk_size))
+    tem = np.empty(n_samples)
+    position = 0
+    for start in range(0, n_samples, chunk_size):
+        tem_chunk = operator.process(x[start:start + chunk_size])
+        tem[position : position + tem_chunk.shape[0]] = tem_chunk
+        position += tem_chunk.shape[0]
+    tem_chunk = operator.flush()
+    tem[position : position + tem_chunk.shape[0]] = tem_chunk
     return tem
 
-def firstsecond_differences (s, axis=-1):
+def firstsecond_differences (s, axis=-1, out=None):
     """
     First and second differences features
     delta_x = x[i] - x[i-1]
@@ -95,21 +312,34 @@ def firstsecond_differences (s, axis=-1):
     axis:
         Axis along which to compute differences.
         
+    out: ndarray
+        Optional array into which the features are written, of the shape
+        of s with 2*n_samples - 3 along axis
+        
     Returns
     -------
     features:
         Concatenation of feature extracted using first and second 
         differences.
     """
-    s_first_diff = np.diff(s, axis=axis)
-    s_second_diff = np.diff(s_first_diff, axis=axis)
-    features = np.hstack(\
-        (s_first_diff, s_second_diff)\
-    )
+    s = np.moveaxis(np.asanyarray(s), axis, -1)
+    n_samples = s.shape[-1]
+    if out is None:
+        out = np.empty(s.shape[:-1] + (max(2*n_samples - 3, 0),), \
+            dtype=np.result_type(s.dtype, np.int8))
+        features = np.moveaxis(out, -1, axis)
+    else:
+        features = out
+        out = np.moveaxis(out, axis, -1)
+    
+    # The second differences are taken from the first, already in out
+    first = out[..., :n_samples - 1]
+    np.subtract(s[..., 1:], s[..., :-1], out=first)
+    np.subtract(first[..., 1:], first[..., :-1], out=out[..., n_samples - 1:])
     return features
     
 
-def first_difference_lag (s, deltas, axis=-1):
+def first_difference_lag (s, deltas, axis=-1, out=None):
     """
     First difference features with lag
     x[i] - x[i+delta]
@@ -127,6 +357,10 @@ def first_difference_lag (s, deltas, axis=-1):
         
     axis:
         Axis along which to compute differences.
+        
+    out: ndarray
+        Optional array into which the features are written, of the shape
+        of s with sum(n_samples - delta) along axis
     
     Returns
     -------
@@ -134,23 +368,23 @@ def first_difference_lag (s, deltas, axis=-1):
         Concatenation of feature extracted using first differences with
         lags.
     """
+    s = np.moveaxis(np.asanyarray(s), axis, -1)
+    n_samples = s.shape[-1]
+    widths = [max(n_samples - delta, 0) for delta in deltas]
+    if out is None:
+        out = np.empty(s.shape[:-1] + (sum(widths),), \
+            dtype=np.result_type(s.dtype, np.int8))
+        features = np.moveaxis(out, -1, axis)
+    else:
+        features = out
+        out = np.moveaxis(out, axis, -1)
     
-    s = np.asanyarray(s)
-    ndim = len(s.shape)
-
-    features = []
-    for delta in deltas:
-        slice1 = [slice(None)]*ndim
-        slice2 = [slice(None)]*ndim
-        slice1[axis] = slice(delta, None)
-        slice2[axis] = slice(None, -delta)
-        slice1 = tuple(slice1)
-        slice2 = tuple(slice2)
-        
-        difference_current = s[slice1] - s[slice2]
-        features.append(difference_current)
-    
-    features = np.concatenate(features, axis=axis)
+    # Each lag is written directly into its columns of out
+    start = 0
+    for delta, width in zip(deltas, widths):
+        np.subtract(s[..., delta:], s[..., :width], \
+            out=out[..., start:start + width])
+        start += width
     return features
 
 
@@ -23,9 +23,154 @@
 #  
 
 import numpy as np
-import heapq
+import scipy.special
 
-def kstestnormal (spike_features):
+def lilliefors_statistic (x, block_size=2**22):
+    """
+    Kolmogorov-Smirnov statistic of the Lilliefors test for normality of
+    each column of a matrix, computed for all columns at once.
+    
+    Parameters
+    ----------
+    x : ndarray
+        The samples, of shape (n_samples, n_columns)
+        
+    block_size : int
+        Approximate number of elements processed at once, which bounds the
+        temporary memory used
+        
+    Returns
+    -------
+    ksD : ndarray
+        Kolmogorov-Smirnov statistic of each column, with the mean and
+        variance estimated from the column
+    """
+    x = np.asarray(x)
+    n_samples, n_columns = x.shape
+    ksD = np.empty(n_columns)
+    
+    # Empirical CDF just after and just before each order statistic
+    ecdf_after = np.arange(1, n_samples + 1)[:, np.newaxis] / float(n_samples)
+    ecdf_before = np.arange(0, n_samples)[:, np.newaxis] / float(n_samples)
+    
+    n_block = max(block_size // max(n_samples, 1), 1)
+    for b in range(0, n_columns, n_block):
+        z = np.sort(x[:, b : b + n_block], axis=0).astype(np.float64)
+        z -= z.mean(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z /= z.std(axis=0, ddof=1)
+        cdf = scipy.special.ndtr(z)
+        ksD[b : b + n_block] = np.maximum(\
+            np.max(ecdf_after - cdf, axis=0), np.max(cdf - ecdf_before, axis=0))
+    return ksD
+
+def lilliefors (x, block_size=2**22):
+    """
+    Lilliefors test for normality of each column of a matrix, computed for
+    all columns at once.
+    
+    Parameters
+    ----------
+    x : ndarray
+        The samples, of shape (n_samples, n_columns)
+        
+    block_size : int
+        Approximate number of elements processed at once, see
+        lilliefors_statistic
+        
+    Returns
+    -------
+    ksD : ndarray
+        Kolmogorov-Smirnov statistic of each column, with the mean and
+        variance estimated from the column
+        
+    ksp : ndarray
+        Approximate p-value of each column, as computed by statsmodels'
+        lilliefors with pvalmethod='approx'
+    """
+    ksD = lilliefors_statistic(x, block_size)
+    return ksD, lilliefors_pvalue(ksD, np.shape(x)[0])
+
+def _lilliefors_table ():
+    # statsmodels keeps its table of critical values in a private module,
+    # under a name which changed between versions
+    try:
+        from statsmodels.stats._lilliefors import get_lilliefors_table
+        return get_lilliefors_table(dist='norm')
+    except ImportError:
+        pass
+    try:
+        from statsmodels.stats._lilliefors import lilliefors_table
+        return lilliefors_table
+    except ImportError:
+        raise ImportError('The table of critical values of the Lilliefors '
+            'test, needed for p-values above 0.1, was not found in statsmodels')
+
+def lilliefors_pvalue (ksD, n_samples):
+    """
+    Approximate p-values of the Lilliefors test statistic, using the
+    formula of Dallal and Wilkinson where it is valid (p-values below 0.1)
+    and statsmodels' table of critical values elsewhere, as statsmodels'
+    lilliefors does with pvalmethod='approx'.
+    
+    Parameters
+    ----------
+    ksD : ndarray
+        Kolmogorov-Smirnov statistics
+        
+    n_samples : int
+        Number of samples from which each statistic was computed
+        
+    Returns
+    -------
+    ksp : ndarray
+        The p-values
+    """
+    ksD = np.asarray(ksD, dtype=np.float64)
+    d_max, n = ksD, n_samples
+    if n > 100:
+        d_max = ksD * (n / 100.0) ** 0.49
+        n = 100
+    ksp = np.exp(-7.01256 * d_max ** 2 * (n + 2.78019) \
+        + 2.99587 * d_max * np.sqrt(n + 2.78019) - 0.122119 \
+        + 0.974598 / np.sqrt(n) + 1.67997 / n)
+    
+    # Interpolated in the table for all such statistics at once
+    outside = ksp > 0.1
+    if np.any(outside):
+        ksp[outside] = _lilliefors_table().prob(ksD[outside], n_samples)
+    return ksp
+
+def subsample_rows (spike_features, max_samples, random_state=0):
+    """
+    Selects a random subset of the rows of a matrix
+    
+    Parameters
+    ----------
+    spike_features : ndarray
+        The spike features
+        
+    max_samples : int
+        Largest number of rows to keep. If None, or not smaller than the
+        number of rows, the matrix is returned unchanged.
+        
+    random_state : int or numpy.random.Generator
+        Seed or generator for the random choice of rows
+        
+    Returns
+    -------
+    spike_features_subset : ndarray
+        The selected rows, in their original order
+    """
+    n_spikes = np.shape(spike_features)[0]
+    if max_samples is None or n_spikes <= max_samples:
+        return spike_features
+    rng = np.random.default_rng(random_state)
+    rows = np.sort(rng.choice(n_spikes, max_samples, replace=False))
+    return spike_features[rows]
+
+def kstestnormal (spike_features, max_samples=None, random_state=0, \
+                  return_stats=False):
     """
     Ranks features using a Lilliefors test for
     normality
@@ -35,20 +180,37 @@ def kstestnormal (spike_features):
     spike_features : ndarray
         The spike features
         
+    max_samples : int
+        If given and there are more spikes than this, the features are
+        ranked on a random subsample of this many spikes, which is faster
+        but may change the ranking. If None, all spikes are used.
+        
+    random_state : int or numpy.random.Generator
+        Seed or generator for the choice of the subsample
+        
+    return_stats : bool
+        Whether to also return the test statistics and p-values
+        
     Returns
     -------
     index_features_sorted : ndarray
         The indices of selected features in order of decreasing KS test
         statistic
+        
+    ksD : ndarray
+        The KS test statistic of each feature, if return_stats is True
+        
+    ksp : ndarray
+        The approximate p-value of each feature, if return_stats is True
     """
-    num_total_features =  np.shape(spike_features)[1]
-    from statsmodels.stats.diagnostic import kstest_normal
-    ksD = np.zeros(num_total_features)
-    ksp = np.zeros(num_total_features)
-    for f in range(num_total_features):
-        ksD[f], ksp[f] = kstest_normal(spike_features[:,f], pvalmethod='approx')
+    spike_features = subsample_rows(spike_features, max_samples, random_state)
+    ksD = lilliefors_statistic(spike_features)
 
-    index_features_sorted = heapq.nlargest(num_total_features, range(len(ksD)), ksD.take)
+    # Constant features, whose statistic is undefined, are ranked last
+    index_features_sorted = np.argsort(-np.nan_to_num(ksD, nan=-np.inf), kind='stable')
+    if return_stats:
+        ksp = lilliefors_pvalue(ksD, np.shape(spike_features)[0])
+        return index_features_sorted, ksD, ksp
     return index_features_sorted
     
 def variance (spike_features):
@@ -67,11 +229,9 @@ def variance (spike_features):
         The indices of selected features in order of decreasing KS test
         statistic
     """
-    num_total_features =  np.shape(spike_features)[1]
     spike_features_variance = np.var(spike_features, axis=0)
 
-    index_features_sorted = heapq.nlargest(num_total_features, \
-        range(len(spike_features_variance)), spike_features_variance.take)
+    index_features_sorted = np.argsort(-spike_features_variance, kind='stable')
     return index_features_sorted
     
 def selectfeatures (spike_features, n_features, criterion='Var'):
@@ -106,8 +266,8 @@ def selectfeatures (spike_features, n_features, criterion='Var'):
     elif criterion.lower() == 'lt':
         index_features_sorted = kstestnormal(spike_features)
         
-    if index_features_sorted == None:
-        print '***** Something Wrong *****'
+    if index_features_sorted is None:
+        raise ValueError("Unknown feature selection criterion %r" % (criterion,))
     
     index_features_selected = index_features_sorted[:n_features]
     spike_features_selected = spike_features[:, index_features_selected]
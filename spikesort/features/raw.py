@@ -22,9 +22,66 @@
 #  
 #  
 
+
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
-def adjust_spike_times(t_spikes, data, samples_before, samples_after):
+def gather_windows (data, start, width, out, fill=0, block_size=65536):
+    """
+    Copies the segments data[start[j] : start[j] + width] of a signal into
+    the rows of an output array, without a Python loop over segments.
+    
+    Parameters
+    ----------
+    data : ndarray
+        The signal, of shape (n_samples,)
+        
+    start : ndarray
+        Index of the first sample of each segment
+        
+    width : int
+        Number of samples in each segment
+        
+    out : ndarray
+        Array of shape (len(start), width) into which segments are written
+        
+    fill : scalar
+        Value given to samples of segments lying outside the signal
+        
+    block_size : int
+        Number of segments copied at once, which bounds the temporary
+        memory used
+        
+    Returns
+    -------
+    out : ndarray
+        The segments
+    """
+    n_data = data.shape[0]
+    inside = (start >= 0) & (start + width <= n_data)
+    
+    if n_data >= width and np.all(inside):
+        # Zero copy strided view of every window of the signal, of which
+        # only the requested rows are read
+        windows = sliding_window_view(data, width)
+        for b in range(0, start.shape[0], block_size):
+            out[b : b + block_size] = windows[start[b : b + block_size]]
+        return out
+    
+    if n_data >= width:
+        windows = sliding_window_view(data, width)
+        out[inside] = windows[start[inside]]
+        
+    # Segments overhanging an end of the signal
+    index = start[~inside, np.newaxis] + np.arange(width)
+    in_range = (index >= 0) & (index < n_data)
+    segments = np.full(index.shape, fill, dtype=out.dtype)
+    segments[in_range] = data[index[in_range]]
+    out[~inside] = segments
+    return out
+
+def adjust_spike_times(t_spikes, data, samples_before, samples_after, \
+                      channels=None, block_size=65536):
     """
     Adjusts the spike times such that they coincide with the peak of the
     spike waveform
@@ -33,7 +90,8 @@ def adjust_spike_times(t_spikes, data, samples_before, samples_after):
     ----------
 
     data : ndarray
-        The signal from which to detect spikes
+        The signal from which to detect spikes, of shape (n_samples,) or
+        (n_channels, n_samples)
         
     t_spikes : ndarray
         The times of spikes in the signal
@@ -44,25 +102,62 @@ def adjust_spike_times(t_spikes, data, samples_before, samples_after):
     samples_after : int
         Number of samples after each spike time to include in the waveform
         
+    channels : ndarray
+        For multichannel signals, the channel on which to find the peak of
+        each spike. If None, the peak across all channels is used.
+        
+    block_size : int
+        Number of spikes aligned at once, which bounds the temporary
+        memory used
+        
     Returns
     -------
     
     t_spikes_adj : ndarray
         The times of spikes after adjustment
         
+    Notes
+    -----
+    The peak is searched for within max(samples_before, samples_after)
+    samples on both sides of each spike time. For spikes near the ends
+    of the signal only the part of this window inside the signal is
+    searched.
     """
+    t_spikes = np.asarray(t_spikes, dtype=np.intp)
     n_spikes = t_spikes.shape[0]
     n_samples = max(samples_before, samples_after)
     t_spikes_adj = np.empty(t_spikes.shape, dtype=int)
-    for j in range(n_spikes):
+    
+    if data.ndim > 1 and channels is not None:
+        channels = np.asarray(channels)
+        for c in np.unique(channels):
+            on_channel = channels == c
+            t_spikes_adj[on_channel] = adjust_spike_times(t_spikes[on_channel], \
+                data[c], samples_before, samples_after, block_size=block_size)
+        return t_spikes_adj
+    data_channels = data[np.newaxis] if data.ndim == 1 else data
+    
+    fill = -np.inf if np.issubdtype(data.dtype, np.floating) \
+        else np.iinfo(data.dtype).min
+    segments = np.empty((2, min(block_size, n_spikes), 2 * n_samples), \
+        dtype=data.dtype)
+    for b in range(0, n_spikes, block_size):
         # Extract segments of max(samples_before, samples_after) samples
-        # from both sides of the spike time
-        s = data[t_spikes[j] - n_samples : t_spikes[j] + n_samples]
-        t_spikes_adj[j] = t_spikes[j] - n_samples + np.argmax(s)
+        # from both sides of the spike times, and align all of them with a
+        # single argmax
+        start = t_spikes[b : b + block_size] - n_samples
+        s = gather_windows(data_channels[0], start, 2 * n_samples, \
+            segments[0, :start.shape[0]], fill=fill)
+        for data_channel in data_channels[1:]:
+            np.maximum(s, gather_windows(data_channel, start, 2 * n_samples, \
+                segments[1, :start.shape[0]], fill=fill), out=s)
+        t_spikes_adj[b : b + block_size] = start + np.argmax(s, axis=1)
         
     return t_spikes_adj
 
-def extract_waveforms(t_spikes, data, samples_before, samples_after):
+def extract_waveforms(t_spikes, data, samples_before, samples_after, \
+                      edges='raise', align=True, channels=None, \
+                      dtype=np.float64, out=None, return_index=False):
     """
     Extracts spike waveforms from the signal
     
@@ -70,7 +165,8 @@ def extract_waveforms(t_spikes, data, samples_before, samples_after):
     ----------
 
     data : ndarray
-        The signal from which to detect spikes
+        The signal from which to detect spikes, of shape (n_samples,) or
+        (n_channels, n_samples)
         
     t_spikes : ndarray
         The times of spikes in the signal
@@ -81,18 +177,81 @@ def extract_waveforms(t_spikes, data, samples_before, samples_after):
     samples_after : int
         Number of samples after each spike time to include in the waveform
         
+    edges : str
+        What to do with spikes whose waveform extends past an end of the
+        signal. Currently the following are supported
+        'raise' to raise a ValueError reporting the offending spikes
+        'drop' to leave these spikes out
+        'pad' to set the samples outside the signal to zero
+        
+    align : bool
+        Whether to first adjust the spike times to the peaks of the
+        waveforms, see adjust_spike_times
+        
+    channels : ndarray
+        For multichannel signals, the channel on which each spike was
+        detected, used for alignment
+        
+    dtype : dtype
+        Data type of the waveforms. If None, the data type of the signal
+        is used and no conversion takes place.
+        
+    out : ndarray
+        Optional array of the shape of waveforms into which the waveforms are written, for instance a numpy.memmap.
+        With edges='drop', n_spikes is the number of spikes kept.
+        
+    return_index : bool
+        Whether to also return the indices of the spikes extracted
+        
     Returns
     -------
     
     waveforms : ndarray
-        The waveforms of the spikes extracted from the signal
+        The waveforms of the spikes extracted from the signal, of shape
+        (n_spikes, samples_before + samples_after) for a single channel or
+        (n_spikes, n_channels, samples_before + samples_after) otherwise
+        
+    index_spikes : ndarray
+        Indices in t_spikes of the spikes whose waveforms were extracted.
+        Only returned if return_index is True.
     
     """
-    n_spikes = t_spikes.shape[0]
+    if edges not in ('raise', 'drop', 'pad'):
+        raise ValueError("edges must be 'raise', 'drop' or 'pad', not %r" % (edges,))
+    
+    t_spikes = np.asarray(t_spikes, dtype=np.intp)
     n_samples = samples_before + samples_after
-    waveforms = np.empty((n_spikes, n_samples))
-    t_spikes = adjust_spike_times(t_spikes, data, samples_before, samples_after)
-    for j in range(n_spikes):
-        waveforms[j, :] = \
-            data[t_spikes[j] - samples_before: t_spikes[j] + samples_after]
+    if align:
+        t_spikes = adjust_spike_times(t_spikes, data, samples_before, \
+            samples_after, channels=channels)
+    
+    start = t_spikes - samples_before
+    inside = (start >= 0) & (start + n_samples <= data.shape[-1])
+    index_spikes = np.arange(t_spikes.shape[0])
+    if not np.all(inside):
+        if edges == 'raise':
+            index_outside = np.flatnonzero(~inside)
+            raise ValueError(\
+                "%d spike waveform(s) extend past the ends of the signal, "
+                "first at spike index %d (t = %d). Use edges='drop' or "
+                "edges='pad'." % (index_outside.shape[0], index_outside[0], \
+                    t_spikes[index_outside[0]]))
+        elif edges == 'drop':
+            index_spikes = index_spikes[inside]
+            start = start[inside]
+    
+    if out is None:
+        if dtype is None:
+            dtype = data.dtype
+        out = np.empty((start.shape[0],) + data.shape[:-1] + (n_samples,), \
+            dtype=dtype)
+    if data.ndim == 1:
+        waveforms = gather_windows(data, start, n_samples, out)
+    else:
+        for c in range(data.shape[0]):
+            gather_windows(data[c], start, n_samples, out[:, c, :])
+        waveforms = out
+    
+    if return_index:
+        return waveforms, index_spikes
     return waveforms
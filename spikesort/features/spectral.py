@@ -25,7 +25,7 @@
 import numpy as np
 import pywt
 
-def wavelet_decomp (s, wavelet='haar', levels=4):
+def wavelet_decomp (s, wavelet='haar', levels=4, mode='symmetric', out=None):
     """
     Wavelet decomposition based features
     
@@ -33,20 +33,39 @@ def wavelet_decomp (s, wavelet='haar', levels=4):
     ----------
     s:
         Signal segments from which to compute first difference with
-        lag. The shape should be (n_signals, n_samples)
+        lag. The shape should be (n_signals, n_samples), or
+        (n_signals, n_channels, n_samples) for multichannel segments
         
     wavelet: str
-        Wavelet basis to use for decomposition
+        Wavelet basis to use for decomposition, any discrete wavelet
+        known to pywt, e.g. 'haar', 'db4', 'sym5'
         
     levels: int
         Level of wavelet decomposition
+        
+    mode: str
+        Signal extension mode used by pywt
+        
+    out: ndarray
+        Optional array into which the coefficients are written
+        
+    Returns
+    -------
+    features:
+        Wavelet coefficients of each segment in the order returned by
+        pywt.wavedec, [cA_n, cD_n, cD_n-1, ..., cD_1], concatenated. The
+        shape is (n_signals, n_coefficients), where n_coefficients equals
+        n_samples for the Haar wavelet and even length segments.
     """
-
-    n_features = np.shape(s)[1]
-    n_spikes = np.shape(s)[0]
-    features = np.empty((n_spikes, n_features))
-    for j in range(n_spikes):
-        wd = pywt.wavedec(s[j, :], wavelet=wavelet, level=levels)
-        features[j,:] = np.hstack(wd)
+    s = np.asanyarray(s)
+    if not np.issubdtype(s.dtype, np.floating):
+        s = s.astype(np.float64)
+    
+    # All segments are decomposed at once along the sample axis
+    wd = pywt.wavedec(s, wavelet=wavelet, level=levels, mode=mode, axis=-1)
+    
+    n_features = sum(c.shape[-1] for c in wd)
+    if out is None:
+        out = np.empty(np.shape(s)[:-1] + (n_features,), dtype=s.dtype)
+    features = np.concatenate(wd, axis=-1, out=out)
     return features
-
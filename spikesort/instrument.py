@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ${FILENAME}
+#  
+#  Copyright 2015 Anupam Mitra <anupam.mitra@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+
+import time
+import tracemalloc
+
+class StageRecord:
+    """
+    Measurements of one stage of a pipeline
+    
+    Attributes
+    ----------
+    name : str
+        Name of the stage
+        
+    t_wall : float
+        Wall clock time of the stage in seconds
+        
+    t_cpu : float
+        Processor time of the process during the stage in seconds
+        
+    peak_bytes : int
+        Peak memory allocated during the stage above the memory allocated
+        at its start, as traced by tracemalloc, or None if memory is not
+        traced
+        
+    arrays : dict
+        Shape, dtype and size in bytes of the arrays added with add_array
+    """
+    def __init__ (self, name):
+        self.name = name
+        self.t_wall = None
+        self.t_cpu = None
+        self.peak_bytes = None
+        self.arrays = {}
+        
+    def add_array (self, label, a):
+        """
+        Records the shape, dtype and size of an array produced by the stage
+        """
+        self.arrays[label] = {\
+            'shape': tuple(getattr(a, 'shape', ())), \
+            'dtype': str(getattr(a, 'dtype', type(a).__name__)), \
+            'nbytes': int(getattr(a, 'nbytes', 0))}
+        
+    def as_dict (self):
+        return {\
+            'name': self.name, 't_wall': self.t_wall, 't_cpu': self.t_cpu, \
+            'peak_bytes': self.peak_bytes, 'arrays': dict(self.arrays)}
+
+class _Stage:
+    def __init__ (self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.record = StageRecord(name)
+        self.started_tracing = False
+        
+    def __enter__ (self):
+        instrumentation = self.instrumentation
+        for hook in instrumentation.start_hooks:
+            hook(self.record)
+        if instrumentation.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            tracemalloc.reset_peak()
+            self.memory_start = tracemalloc.get_traced_memory()[0]
+        self.t_cpu = time.process_time()
+        self.t_wall = time.perf_counter()
+        return self.record
+        
+    def __exit__ (self, exc_type, exc_value, traceback):
+        record = self.record
+        record.t_wall = time.perf_counter() - self.t_wall
+        record.t_cpu = time.process_time() - self.t_cpu
+        if self.instrumentation.trace_memory:
+            record.peak_bytes = \
+                tracemalloc.get_traced_memory()[1] - self.memory_start
+            if self.started_tracing:
+                tracemalloc.stop()
+        self.instrumentation.records.append(record)
+        for callback in self.instrumentation.callbacks:
+            callback(record)
+        return False
+
+class _NullRecord:
+    def add_array (self, label, a):
+        pass
+
+class _NullStage:
+    def __enter__ (self):
+        return _NULL_RECORD
+        
+    def __exit__ (self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_RECORD = _NullRecord()
+_NULL_STAGE = _NullStage()
+
+class Instrumentation:
+    """
+    Collects the time, memory and array sizes of the stages of a pipeline.
+    Stages are measured with
+    
+        with instrumentation.stage('features') as record:
+            features = ...
+            record.add_array('features', features)
+    
+    Parameters
+    ----------
+    trace_memory : bool
+        Whether to trace the peak memory of each stage with tracemalloc.
+        Tracing slows down allocations, which makes the measured times
+        longer.
+        
+    callbacks : list
+        Functions called with the StageRecord of each stage when the stage
+        ends, for instance to forward it to a metrics system
+        
+    start_hooks : list
+        Functions called with the StageRecord of each stage, not yet
+        measured, when the stage starts
+        
+    Attributes
+    ----------
+    records : list
+        StageRecord of every finished stage, in order. Peak memory of
+        stages nested in other stages is counted in the inner stages only.
+    """
+    enabled = True
+    
+    def __init__ (self, trace_memory=False, callbacks=None, start_hooks=None):
+        self.trace_memory = trace_memory
+        self.callbacks = list(callbacks or [])
+        self.start_hooks = list(start_hooks or [])
+        self.records = []
+        
+    def add_callback (self, callback):
+        self.callbacks.append(callback)
+        
+    def add_start_hook (self, hook):
+        self.start_hooks.append(hook)
+        
+    def stage (self, name):
+        """
+        Context manager measuring a stage, which gives its StageRecord
+        """
+        return _Stage(self, name)
+        
+    def summary (self):
+        """
+        Returns the records of the finished stages as a list of dicts
+        """
+        return [record.as_dict() for record in self.records]
+        
+    def clear (self):
+        self.records = []
+
+class NullInstrumentation:
+    """
+    Instrumentation which measures nothing, used when instrumentation is
+    disabled. Its stages only cost a method call.
+    """
+    enabled = False
+    trace_memory = False
+    records = ()
+    
+    def stage (self, name):
+        return _NULL_STAGE
+        
+    def summary (self):
+        return []
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+__all__ = ["Instrumentation", "NullInstrumentation", "StageRecord", \
+    "NULL_INSTRUMENTATION"]
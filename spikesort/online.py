@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ${FILENAME}
+#  
+#  Copyright 2015 Anupam Mitra <anupam.mitra@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+
+import collections
+import time
+
+import numpy as np
+import scipy.signal
+
+from . import features
+from .features.raw import extract_waveforms
+from .signals import Recording, bandpass_sos
+from .spikedetect import ThresholdDetector, alignable, detect_spikes, \
+    estimate_threshold
+
+class OnlineSpikeSorter:
+    """
+    Sorts spikes of a single channel recording online, as sample buffers
+    arrive. Templates and the feature projection are fitted on a training
+    segment with the offline pipeline. Each buffer is then causally
+    filtered and thresholded, and each new spike is assigned to the nearest
+    template through a precomputed linear projection of its waveform. The
+    state kept between buffers is bounded.
+    
+    Parameters
+    ----------
+    recording_train:
+        Training segment of the recording. If it has no spike times,
+        spikes are detected in it.
+    
+    feature_extraction: str
+        Technique to use for extraction of spike features, see SpikeSorting
+        
+    feature_selection: str
+        Technique to use for selection of spike features
+        
+    feature_clustering: str
+        Clustering algorithm to use on the training segment
+        
+    n_features: int
+        Number of features to use for clustering.
+        
+    samples_before: int
+        Number of samples before the peak of a spike to include in the
+        spike shape
+        
+    samples_after: int
+        Number of samples after the peak of a spike to include in the
+        spike shape
+        
+    flow, fhigh, order:
+        Band pass filter, see Recording.frequency_band_filter
+        
+    threshold: float
+        The threshold to use for detecting spikes. If None, it is estimated
+        from the filtered training segment.
+        
+    history_len: int
+        Number of past filtered samples kept, besides the current buffer,
+        for extracting waveforms of spikes detected late
+        
+    n_latencies: int
+        Number of recent per buffer latencies kept
+    """
+    def __init__ (self, recording_train, feature_extraction, feature_selection, \
+                  feature_clustering, n_features, samples_before=20, \
+                  samples_after=44, flow=300, fhigh=3000, order=3, \
+                  threshold=None, history_len=None, n_latencies=1000):
+        self.recording_train = recording_train
+        self.feature_extraction = feature_extraction
+        self.feature_selection = feature_selection
+        self.feature_clustering = feature_clustering
+        self.n_features = n_features
+        self.samples_before = samples_before
+        self.samples_after = samples_after
+        self.sos = bandpass_sos(flow, fhigh, recording_train.fs_Hz, order)
+        self.threshold = threshold
+        if history_len is None:
+            history_len = 4 * (samples_before + samples_after)
+        self.history_len = history_len
+        self.latencies = collections.deque(maxlen=n_latencies)
+        
+    def fit (self):
+        """
+        Runs the offline pipeline on the causally filtered training segment
+        and precomputes the projection of waveforms onto the templates.
+        """
+        from . import SpikeSorting
+        
+        recording = self.recording_train
+        data = scipy.signal.sosfilt(self.sos, recording.get_slice(0, recording.n_samples))
+        if self.threshold is None:
+            self.threshold = estimate_threshold(data)
+        t_spikes = recording.t_spikes
+        spike_class = recording.spike_class
+        if t_spikes is None:
+            # As in SpikeSorting, detected spikes too close to the ends to
+            # be aligned are left out, and ground truth classes do not
+            # label them
+            t_spikes = detect_spikes(data, self.threshold)
+            t_spikes = t_spikes[alignable(t_spikes, data.shape[0], \
+                self.samples_before, self.samples_after)]
+            spike_class = None
+        recording_filtered = Recording(data, recording.fs_Hz, t_spikes, spike_class)
+        
+        sorting = SpikeSorting(recording_filtered, self.feature_extraction, \
+            self.feature_selection, self.feature_clustering, self.n_features, \
+            self.samples_before, self.samples_after)
+        sorting.spike_sorting()
+        self.sorting = sorting
+        
+        # Features are linear in the waveform, and clustering scales them,
+        # so the whole chain is one affine map of the waveform
+        spike_features = sorting.spike_features
+        P, b = spike_features.selection_map()
+        E = np.dot(features.feature_matrix(spike_features.spike_waveforms.shape[1:], \
+            self.feature_extraction), P[:, :self.n_features])
+        features_train = spike_features.get_top_features(self.n_features)
+        mean = features_train.mean(axis=0)
+        std = features_train.std(axis=0)
+        std[std == 0] = 1.0
+        self.projection = E / std
+        self.offset = (mean - b[:self.n_features]) / std
+        
+        features_scaled = (features_train - mean) / std
+        labels = np.asarray(sorting.clustering.spike_class_est)
+        self.classes = np.unique(labels)
+        self.templates = np.array([features_scaled[labels == c].mean(axis=0) \
+            for c in self.classes])
+        self._template_norms = np.sum(self.templates ** 2, axis=1)
+        
+        self.reset()
+        return self
+        
+    def reset (self):
+        """
+        Clears the state kept between buffers, to start a new stream
+        """
+        self.n_samples_seen = 0
+        self.n_spikes_dropped = 0
+        self._zi = np.zeros((self.sos.shape[0], 2))
+        self._detector = ThresholdDetector(self.threshold)
+        self._history = np.empty(0)
+        self._pending = np.empty(0, dtype=np.int64)
+        self.latencies.clear()
+        
+    def assign (self, spike_waveforms):
+        """
+        Assigns spike waveforms to the nearest template.
+        
+        Parameters
+        ----------
+        spike_waveforms : ndarray
+            The waveforms, of shape (n_spikes, samples_before + samples_after)
+            
+        Returns
+        -------
+        spike_class_est : ndarray
+            Estimated spike classes
+        """
+        z = np.dot(spike_waveforms, self.projection) - self.offset
+        # |z - t|^2 = |z|^2 - 2 z.t + |t|^2, of which |z|^2 is common
+        distances = self._template_norms - 2 * np.dot(z, self.templates.T)
+        return self.classes[np.argmin(distances, axis=1)]
+        
+    def process (self, buffer):
+        """
+        Sorts the spikes of the next buffer of samples.
+        
+        Parameters
+        ----------
+        buffer : ndarray
+            The next raw samples of the recording, in physical units
+            
+        Returns
+        -------
+        t_spikes : ndarray
+            Times, counted from the start of the stream, of the spikes
+            whose waveforms were completed by this buffer
+            
+        spike_class_est : ndarray
+            Estimated classes of these spikes
+        """
+        t_start = time.perf_counter()
+        
+        filtered, self._zi = scipy.signal.sosfilt(self.sos, buffer, zi=self._zi)
+        n_buffer = filtered.shape[0]
+        self.n_samples_seen += n_buffer
+        self._history = np.concatenate([self._history, filtered])\
+            [-(self.history_len + n_buffer):]
+        history_start = self.n_samples_seen - self._history.shape[0]
+        
+        # Waveforms are aligned to their peaks as in fit, which moves a
+        # spike by up to margin samples
+        margin = max(self.samples_before, self.samples_after)
+        pending = np.concatenate([self._pending, self._detector.process(filtered)])
+        ready = pending + margin + self.samples_after <= self.n_samples_seen
+        t_spikes = pending[ready]
+        self._pending = pending[~ready]
+        
+        # Spikes detected too late for their waveform to still be in the
+        # history are dropped
+        kept = t_spikes - self.samples_before - margin >= history_start
+        self.n_spikes_dropped += int(np.sum(~kept))
+        t_spikes = t_spikes[kept]
+        spike_waveforms = extract_waveforms(t_spikes - history_start, \
+            self._history, self.samples_before, self.samples_after)
+        spike_class_est = self.assign(spike_waveforms)
+        
+        self.latencies.append(time.perf_counter() - t_start)
+        return t_spikes, spike_class_est
+        
+    def latency_summary (self):
+        """
+        Summary of the recent per buffer latencies, in milliseconds
+        
+        Returns
+        -------
+        summary : dict
+            Median, 99th percentile and maximum latency, and the number of
+            buffers they were computed over
+        """
+        latencies = 1e3 * np.asarray(self.latencies)
+        if latencies.shape[0] == 0:
+            return {'n_buffers': 0}
+        return {'n_buffers': latencies.shape[0], \
+            'median_ms': float(np.median(latencies)), \
+            'p99_ms': float(np.percentile(latencies, 99)), \
+            'max_ms': float(np.max(latencies))}
+
+__all__ = ["OnlineSpikeSorter"]
@@ -22,8 +22,192 @@
 #  
 #  
 
+import tempfile
+
 import numpy as np
 import scipy.signal
+from concurrent.futures import ThreadPoolExecutor
+
+def bandpass_sos (flow, fhigh, fs_Hz, order=3):
+    """
+    Designs a Butterworth band pass filter in second order sections form,
+    which stays numerically stable at high orders, unlike the (b, a) form.
+    
+    Parameters
+    ----------
+    flow : float
+        Lower cutoff frequency in Hz
+        
+    fhigh : float
+        Upper cutoff frequency in Hz
+        
+    fs_Hz : float
+        The sampling frequency in Hz
+        
+    order : int
+        Order of the filter
+        
+    Returns
+    -------
+    sos : ndarray
+        Second order sections of the filter
+    """
+    sos = scipy.signal.butter(order, \
+        ((flow / (fs_Hz / 2.0)), 
+        (fhigh / (fs_Hz / 2.0))), 'pass', output='sos')
+    return sos
+
+def impulse_response_length (sos, tol=1e-9, max_length=2**20):
+    """
+    Number of samples after which the impulse response of a filter has
+    decayed below a tolerance relative to its peak.
+    
+    Parameters
+    ----------
+    sos : ndarray
+        Second order sections of the filter
+        
+    tol : float
+        Tolerance relative to the largest magnitude of the response
+        
+    max_length : int
+        Largest length considered
+        
+    Returns
+    -------
+    length : int
+        Length of the significant part of the impulse response
+    """
+    length = 256
+    while True:
+        impulse = np.zeros(length)
+        impulse[0] = 1.0
+        h = np.abs(scipy.signal.sosfilt(sos, impulse))
+        significant = np.flatnonzero(h > tol * np.max(h))
+        if significant[-1] < length // 2 or length >= max_length:
+            return int(significant[-1]) + 1
+        length *= 2
+
+def map_channels (func, data, executor=None):
+    """
+    Applies a function to each channel of a multichannel signal on a thread
+    pool. SciPy releases the GIL in its filters, so the channels are
+    processed in parallel.
+    
+    Parameters
+    ----------
+    func : callable
+        Function taking the samples of one channel and returning an array
+        
+    data : ndarray
+        The signal, of shape (n_samples,) or (n_channels, n_samples)
+        
+    executor : concurrent.futures.Executor
+        Executor to use. If None, a thread pool with as many threads as
+        available CPUs is created.
+        
+    Returns
+    -------
+    result : ndarray
+        Outputs of func stacked along the first axis, or the output of
+        func(data) for a single channel signal
+    """
+    if data.ndim == 1:
+        return func(data)
+    if executor is None:
+        with ThreadPoolExecutor() as executor:
+            return map_channels(func, data, executor)
+    return np.stack(list(executor.map(func, data)))
+
+def sosfilt_chunks (sos, chunks, zi=None, n_jobs=None):
+    """
+    Causally filters a signal arriving in consecutive chunks, carrying the
+    filter state from one chunk to the next. The concatenated output equals
+    scipy.signal.sosfilt applied to the whole signal.
+    
+    Parameters
+    ----------
+    sos : ndarray
+        Second order sections of the filter
+        
+    chunks : iterable
+        Consecutive chunks of the signal, of shape (..., n_samples)
+        
+    zi : ndarray
+        Initial filter state, of shape (n_sections, ..., 2). If None, the
+        filter starts at rest.
+        
+    n_jobs : int
+        Number of threads over which channels are filtered
+        
+    Yields
+    ------
+    chunk_filtered : ndarray
+        Each chunk after filtering
+    """
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for chunk in chunks:
+            chunk = np.asarray(chunk)
+            if zi is None:
+                zi = np.zeros((sos.shape[0],) + chunk.shape[:-1] + (2,))
+            if chunk.ndim == 1:
+                chunk_filtered, zi = scipy.signal.sosfilt(sos, chunk, zi=zi)
+            else:
+                # The state of each channel is updated in place
+                def filter_channel (c):
+                    y, zi[:, c] = scipy.signal.sosfilt(sos, chunk[c], zi=zi[:, c])
+                    return y
+                chunk_filtered = np.stack(list(\
+                    executor.map(filter_channel, range(chunk.shape[0]))))
+            yield chunk_filtered
+
+def sosfiltfilt_chunks (sos, data, chunk_size, padlen=None, n_jobs=None):
+    """
+    Zero phase filters a signal chunk by chunk. Each chunk is filtered
+    forwards and backwards together with padlen samples on each side, which
+    are then discarded. When padlen covers the decay of the impulse
+    response, the concatenated output matches scipy.signal.sosfiltfilt
+    applied to the whole signal to within the decay tolerance.
+    
+    Parameters
+    ----------
+    sos : ndarray
+        Second order sections of the filter
+        
+    data : ndarray
+        The signal, of shape (..., n_samples). Any object supporting
+        slicing, such as a numpy.memmap, may be used.
+        
+    chunk_size : int
+        Number of samples in each chunk
+        
+    padlen : int
+        Number of samples of overlap on each side of a chunk. If None,
+        the length of the impulse response of the filter is used.
+        
+    n_jobs : int
+        Number of threads over which channels are filtered
+        
+    Yields
+    ------
+    chunk_start : int
+        Index of the first sample of the chunk
+        
+    chunk_filtered : ndarray
+        The filtered chunk
+    """
+    if padlen is None:
+        padlen = impulse_response_length(sos)
+    n_samples = data.shape[-1]
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for chunk_start in range(0, n_samples, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, n_samples)
+            read_start = max(chunk_start - padlen, 0)
+            read_stop = min(chunk_stop + padlen, n_samples)
+            segment = np.asarray(data[..., read_start:read_stop])
+            segment_filtered = map_channels(\
+                lambda x: scipy.signal.sosfiltfilt(sos, x), segment, executor)
+            yield chunk_start, segment_filtered[..., chunk_start - read_start : chunk_stop - read_start]
 
 class Recording:
     """
@@ -32,38 +216,281 @@ class Recording:
     Parameters
     ----------
     data: ndarray
-        The recording signal(s)
+        The recording signal(s). This may be a numpy.memmap, in which case
+        samples are only read from disk when a slice of them is used.
         
     fs_Hz: float
         The sampling frequency in Hz used for recording the signal(s)
+        
+    gain: float
+        Factor converting the values stored in data to physical units
+        
+    float_dtype: dtype
+        Floating point type of the samples in physical units, and of the
+        filtered signal, waveforms and features computed from them.
+        np.float32 halves the memory used by all of these, while data may
+        stay in a compact integer type such as np.int16 with a gain.
     """
-    def __init__ (self, data, fs_Hz, t_spikes=None, spike_class=None):
+    def __init__ (self, data, fs_Hz, t_spikes=None, spike_class=None, gain=1.0, \
+                  float_dtype=np.float64):
         self.data = data
         self.t_spikes = t_spikes
         self.spike_class = spike_class
         self.fs_Hz = fs_Hz
+        self.gain = gain
+        self.float_dtype = np.dtype(float_dtype)
         self.is_filtered = False
         
-    def frequency_band_filter (self, flow=300, fhigh=3000, order=3):
+    @classmethod
+    def from_file (cls, filename, fs_Hz, dtype=np.int16, gain=1.0, \
+                   n_channels=1, offset=0, t_spikes=None, spike_class=None, \
+                   float_dtype=np.float64):
         """
-        Band pass filters a signal in the frequency domain.
+        Creates a recording backed by a memory mapped file, without
+        reading the file into memory.
         
         Parameters
         ----------
-        recording :
+        filename : str
+            Path of a .npy file, or of a raw binary file of samples
+            interleaved across channels
+            
+        fs_Hz : float
+            The sampling frequency in Hz used for recording the signal(s)
+            
+        dtype : dtype
+            Data type of the samples in a raw binary file. Ignored for
+            .npy files, which record their own data type.
+            
+        gain : float
+            Factor converting the stored samples to physical units
+            
+        n_channels : int
+            Number of channels in the file
+            
+        offset : int
+            Number of bytes of header to skip in a raw binary file
+            
+        float_dtype : dtype
+            Floating point type of the samples in physical units
+            
+        Returns
+        -------
+        recording : Recording
+            The recording, whose data is a read only memory map of shape
+            (n_samples,) for a single channel, or a view of shape
+            (n_channels, n_samples) otherwise
+        """
+        if filename.endswith('.npy'):
+            data = np.load(filename, mmap_mode='r')
+        else:
+            data = np.memmap(filename, dtype=dtype, mode='r', offset=offset)
+            
+        if n_channels > 1 and data.ndim == 1:
+            data = data.reshape(-1, n_channels).T
+            
+        recording = cls(data, fs_Hz, t_spikes, spike_class, gain=gain, \
+            float_dtype=float_dtype)
+        setattr(recording, 'filename', filename)
+        return recording
         
-        sampling_interval :
-
-        flow :
+    @property
+    def n_samples (self):
+        """
+        Number of samples in each channel of the recording
+        """
+        return self.data.shape[-1]
+        
+    @property
+    def n_channels (self):
+        """
+        Number of channels of the recording
+        """
+        return 1 if self.data.ndim == 1 else self.data.shape[0]
+        
+    def get_slice (self, start, stop):
+        """
+        Reads the samples start to stop of the recording, in physical
+        units.
+        
+        Parameters
+        ----------
+        start : int
+            Index of the first sample
+            
+        stop : int
+            Index one past the last sample
+            
+        Returns
+        -------
+        data_slice : ndarray
+            The samples, a copy of the recording data multiplied by gain, of
+            type float_dtype
+        """
+        data_slice = np.asarray(self.data[..., start:stop])
+        if self.gain != 1.0:
+            data_slice = np.multiply(data_slice, self.gain, dtype=self.float_dtype)
+        else:
+            data_slice = data_slice.astype(self.float_dtype)
+        return data_slice
+        
+    def iter_chunks (self, chunk_size, overlap=0):
+        """
+        Iterates over the recording in chunks, in physical units, so that
+        only one chunk at a time is held in memory.
+        
+        Parameters
+        ----------
+        chunk_size : int
+            Number of samples in each chunk, not counting overlap
+            
+        overlap : int
+            Number of samples of the neighbouring chunks to include on
+            each side of a chunk
+            
+        Yields
+        ------
+        chunk_start : int
+            Index of the first sample of the chunk, before overlap
+            
+        data_chunk : ndarray
+            Samples max(0, chunk_start - overlap) to
+            min(n_samples, chunk_start + chunk_size + overlap)
+        """
+        n_samples = self.n_samples
+        for chunk_start in range(0, n_samples, chunk_size):
+            yield chunk_start, self.get_slice(max(chunk_start - overlap, 0), \
+                min(chunk_start + chunk_size + overlap, n_samples))
+        
+    def iter_filtered (self, flow=300, fhigh=3000, order=3, causal=False, \
+                       chunk_size=2**20, padlen=None, n_jobs=None):
+        """
+        Band pass filters the recording chunk by chunk, holding only one
+        chunk at a time in memory.
+        
+        Parameters
+        ----------
+        flow : float
+            Lower cutoff frequency in Hz
+            
+        fhigh : float
+            Upper cutoff frequency in Hz
+        
+        order : int
+            Order of the Butterworth filter
+            
+        causal : bool
+            Whether to filter forwards only, carrying the filter state
+            across chunks, as for online use. Otherwise the filter is zero
+            phase, see sosfiltfilt_chunks.
+            
+        chunk_size : int
+            Number of samples in each chunk
+            
+        padlen : int
+            Overlap between chunks for zero phase filtering
+            
+        n_jobs : int
+            Number of threads over which channels are filtered, default
+            as many as available CPUs
+            
+        Yields
+        ------
+        chunk_start : int
+            Index of the first sample of the chunk
+            
+        chunk_filtered : ndarray
+            The filtered chunk, in physical units. Filters are computed in
+            double precision whatever float_dtype is.
+        """
+        sos = bandpass_sos(flow, fhigh, self.fs_Hz, order)
+        if causal:
+            chunk_starts = range(0, self.n_samples, chunk_size)
+            chunks = (self.get_slice(c, c + chunk_size) for c in chunk_starts)
+            for chunk_start, chunk_filtered in \
+                    zip(chunk_starts, sosfilt_chunks(sos, chunks, n_jobs=n_jobs)):
+                yield chunk_start, chunk_filtered
+        else:
+            for chunk_start, chunk_filtered in \
+                    sosfiltfilt_chunks(sos, self.data, chunk_size, padlen, n_jobs):
+                if self.gain != 1.0:
+                    chunk_filtered *= self.gain
+                yield chunk_start, chunk_filtered
+                
+    def frequency_band_filter (self, flow=300, fhigh=3000, order=3, \
+                               causal=False, chunk_size=None, out=None, \
+                               keep_raw=True, n_jobs=None):
+        """
+        Band pass filters a signal in the frequency domain.
+        
+        Parameters
+        ----------
+        flow : float
+            Lower cutoff frequency in Hz
 
-        fhigh :
+        fhigh : float
+            Upper cutoff frequency in Hz
         
-        order :
+        order : int
+            Order of the Butterworth filter
+            
+        causal : bool
+            Whether to filter forwards only instead of forwards and
+            backwards (zero phase)
+            
+        chunk_size : int
+            If given, the recording is filtered in chunks of this many
+            samples, see iter_filtered. Memory mapped recordings are always
+            filtered in chunks, of 2**20 samples by default.
+            
+        out : str or ndarray
+            Where to write the filtered recording, either an array or the
+            path of a .npy file created as a memory map. If None, an array
+            is allocated, or for a memory mapped recording a memory map of
+            an unnamed temporary file, removed once the map is released.
+            
+        keep_raw : bool
+            Whether to keep the unfiltered data as data_raw
+            
+        n_jobs : int
+            Number of threads over which channels are filtered, default
+            as many as available CPUs
         """
-        self.data_raw = self.data
-        b, a = scipy.signal.butter(order, \
-            ((flow / (self.fs_Hz / 2.0)), 
-            (fhigh / (self.fs_Hz / 2.0))), 'pass')
-        self.data = scipy.signal.filtfilt(b, a, self.data)
+        memory_mapped = isinstance(self.data, np.memmap)
+        if chunk_size is None and out is None and not memory_mapped:
+            sos = bandpass_sos(flow, fhigh, self.fs_Hz, order)
+            data = self.get_slice(0, self.n_samples)
+            filt = scipy.signal.sosfilt if causal else scipy.signal.sosfiltfilt
+            float_dtype = self.float_dtype
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                data_filtered = map_channels(\
+                    lambda x: filt(sos, x).astype(float_dtype, copy=False), \
+                    data, executor)
+        else:
+            if chunk_size is None:
+                chunk_size = 2**20
+            if out is None and memory_mapped:
+                # Neither the recording nor its filtered version is held
+                # in memory
+                data_filtered = np.memmap(tempfile.TemporaryFile(), \
+                    mode='w+', dtype=self.float_dtype, shape=self.data.shape)
+            elif out is None:
+                data_filtered = np.empty(self.data.shape, dtype=self.float_dtype)
+            elif isinstance(out, str):
+                data_filtered = np.lib.format.open_memmap(out, mode='w+', \
+                    dtype=self.float_dtype, shape=self.data.shape)
+            else:
+                data_filtered = out
+            for chunk_start, chunk_filtered in self.iter_filtered(\
+                    flow, fhigh, order, causal, chunk_size, n_jobs=n_jobs):
+                data_filtered[..., chunk_start : chunk_start + \
+                    chunk_filtered.shape[-1]] = chunk_filtered
+            if isinstance(data_filtered, np.memmap):
+                data_filtered.flush()
+                
+        if keep_raw:
+            self.data_raw = self.data
+            self.gain_raw = self.gain
+        self.data = data_filtered
+        self.gain = 1.0
         self.is_filtered = True
-
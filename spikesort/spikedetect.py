@@ -22,24 +22,299 @@
 #  
 # 
 
+
 import numpy as np
-import scipy.io
-import os
 
-import datasets
+from .features.diff import StreamingMTEO
+
+def estimate_threshold (data):
+    """
+    Estimates a spike detection threshold from the median absolute
+    deviation of the signal, assuming normally distributed noise.
+    
+    Parameters
+    ----------
+    data : ndarray
+        The signal (or a representative segment of it) from which to
+        estimate the noise level
+        
+    Returns
+    -------
+    threshold : float
+        The threshold to use for detecting spikes
+    """
+    import statsmodels.robust.scale
+
+    # sigmaN = np.median(np.abs(data))/0.6745
+    mad = 1.4826 * statsmodels.robust.scale.mad(np.abs(data))
+    threshold = 3.38 * mad
+    return threshold
+
+def spread_sample (data, n_samples, n_blocks=64):
+    """
+    Reads a sample of a long signal from blocks spread evenly across it,
+    for estimating its noise level without reading all of it.
+    
+    Parameters
+    ----------
+    data : ndarray
+        The signal. Any object supporting slicing, such as a numpy.memmap,
+        may be used.
+        
+    n_samples : int
+        Number of samples to read in total. If the signal is not longer
+        than this, all of it is returned.
+        
+    n_blocks : int
+        Number of blocks of consecutive samples read
+        
+    Returns
+    -------
+    sample : ndarray
+        The samples read
+    """
+    n_total = data.shape[0]
+    if n_total <= n_samples:
+        return np.asarray(data[:])
+    block_size = max(n_samples // n_blocks, 1)
+    n_blocks = n_samples // block_size
+    block_starts = np.linspace(0, n_total - block_size, n_blocks).astype(np.intp)
+    return np.concatenate([np.asarray(data[b : b + block_size]) \
+        for b in block_starts])
 
-def detect_spikes (data, threshold=None):
+def threshold_runs (data, threshold):
     """
-    Detects spikes.
-    This is not completely implemented.
+    Finds the runs of consecutive samples of a signal which lie above a
+    threshold.
     
     Parameters
     ----------
     data : ndarray
         The signal from which to detect spikes
+        
+    threshold : float
+        The threshold to use for detecting spikes
+        
+    Returns
+    -------
+    run_start : ndarray
+        Index of the first sample of each run
+        
+    run_end : ndarray
+        Index one past the last sample of each run
+    """
+    n_samples = data.shape[0]
+    above = np.zeros(n_samples + 2, dtype=np.int8)
+    np.greater(data, threshold, out=above[1:-1], casting='unsafe')
+    
+    # +1 where a run begins and -1 one past where it ends
+    edges = np.diff(above)
+    run_start = np.flatnonzero(edges == 1)
+    run_end = np.flatnonzero(edges == -1)
+    return run_start, run_end
 
+def run_peaks (data, run_start, run_end):
+    """
+    Finds the position of the maximum of the signal within each run, all
+    runs being processed at once.
+    
+    Parameters
+    ----------
+    data : ndarray
+        The signal from which to detect spikes
+        
+    run_start : ndarray
+        Index of the first sample of each run
+        
+    run_end : ndarray
+        Index one past the last sample of each run
+        
+    Returns
+    -------
+    t_peaks : ndarray
+        Index of the first maximum of the signal within each run
+    """
+    n_runs = run_start.shape[0]
+    if n_runs == 0:
+        return np.empty(0, dtype=np.int64)
+    
+    # Maximum over each run; the gaps between runs are reduced as well
+    # and discarded. reduceat cannot take an index equal to the length of
+    # the signal, in which case the last run extends to the end anyway.
+    bounds = np.empty(2 * n_runs, dtype=np.intp)
+    bounds[0::2] = run_start
+    bounds[1::2] = run_end
+    if bounds[-1] == data.shape[0]:
+        bounds = bounds[:-1]
+    peak_values = np.maximum.reduceat(data, bounds)[0::2]
+    
+    # Flat indices of every sample belonging to a run, together with the
+    # run it belongs to
+    run_length = run_end - run_start
+    run_id = np.repeat(np.arange(n_runs), run_length)
+    run_offset = np.cumsum(run_length) - run_length
+    members = np.arange(run_id.shape[0]) + np.repeat(run_start - run_offset, run_length)
+    
+    # First sample of each run attaining the maximum, as np.argmax would
+    at_peak = np.flatnonzero(data[members] == peak_values[run_id])
+    first = np.ones(at_peak.shape[0], dtype=bool)
+    first[1:] = run_id[at_peak[1:]] != run_id[at_peak[:-1]]
+    t_peaks = members[at_peak[first]].astype(np.int64)
+    return t_peaks
+
+def iter_detect_spikes (data, threshold=None, chunk_size=2**20, overlap=1024):
+    """
+    Detects spikes reading the signal in fixed size chunks, so that the
+    memory used does not depend on the length of the recording. Each chunk
+    is read together with one sample before it and `overlap` samples after
+    it. A spike belongs to the chunk in which its threshold crossing
+    begins, so a spike straddling a chunk boundary is found exactly once.
+    
+    Parameters
+    ----------
+    data : ndarray
+        The signal from which to detect spikes. Any object supporting
+        slicing, such as a numpy.memmap, may be used.
+        
     threshold : float
+        The threshold to use for detecting spikes. If None, the threshold
+        is estimated from chunk_size samples spread across the whole
+        signal, see spread_sample, or from all of it if it is shorter.
+        
+    chunk_size : int
+        Number of samples in each chunk
+        
+    overlap : int
+        Number of samples read past the end of each chunk to complete
+        runs crossing the boundary. It is extended as needed for runs
+        longer than this.
+        
+    Yields
+    ------
+    t_spikes_detect : ndarray
+        Times of spikes detected in each chunk
+    """
+    n_samples = data.shape[0]
+    overlap = max(int(overlap), 1)
+    if threshold is None:
+        threshold = estimate_threshold(spread_sample(data, chunk_size))
+
+    for chunk_start in range(0, n_samples, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, n_samples)
+        read_start = max(chunk_start - 1, 0)
+        read_stop = min(chunk_stop + overlap, n_samples)
+        while read_stop < n_samples and data[read_stop - 1] > threshold:
+            read_stop = min(read_stop + overlap, n_samples)
+        
+        segment = np.asarray(data[read_start:read_stop])
+        run_start, run_end = threshold_runs(segment, threshold)
+        
+        # Runs beginning in the lookback sample started in the previous
+        # chunk, those beginning in the overlap belong to the next one
+        owned = (run_start + read_start >= chunk_start) & \
+            (run_start + read_start < chunk_stop)
+        t_peaks = run_peaks(segment, run_start[owned], run_end[owned])
+        yield t_peaks + read_start
+
+class ThresholdDetector:
+    """
+    Detects spikes in a signal arriving in consecutive buffers, as for
+    online use. A run of samples above threshold which is still open at the
+    end of a buffer is carried over to the next one, so the spikes found
+    are the same as with detect_spikes on the whole signal, and the state
+    kept does not depend on the length of the signal.
+    
+    Parameters
+    ----------
+    threshold: float
         The threshold to use for detecting spikes
+    """
+    def __init__ (self, threshold):
+        self.threshold = threshold
+        self.n_samples_seen = 0
+        # Time and value of the peak of a run open at the end of the last
+        # buffer
+        self._open_run = None
+        
+    def process (self, data):
+        """
+        Detects spikes in the next buffer of the signal.
+        
+        Parameters
+        ----------
+        data : ndarray
+            The next samples of the signal
+            
+        Returns
+        -------
+        t_spikes_detect : ndarray
+            Times, counted from the start of the signal, of the spikes whose
+            runs ended within this buffer
+        """
+        data = np.asarray(data)
+        n_samples = data.shape[0]
+        if n_samples == 0:
+            return np.empty(0, dtype=np.int64)
+        offset = self.n_samples_seen
+        self.n_samples_seen += n_samples
+        
+        run_start, run_end = threshold_runs(data, self.threshold)
+        t_peaks = run_peaks(data, run_start, run_end)
+        peak_values = data[t_peaks]
+        t_peaks = t_peaks + offset
+        
+        t_closed = []
+        if self._open_run is not None:
+            if run_start.shape[0] > 0 and run_start[0] == 0:
+                # The first run continues the open one, whose peak is kept
+                # unless exceeded, as np.argmax keeps the first maximum
+                if not peak_values[0] > self._open_run[1]:
+                    t_peaks[0], peak_values[0] = self._open_run
+            else:
+                t_closed.append(self._open_run[0])
+            self._open_run = None
+            
+        if run_end.shape[0] > 0 and run_end[-1] == n_samples:
+            self._open_run = (t_peaks[-1], peak_values[-1])
+            t_peaks = t_peaks[:-1]
+            
+        t_spikes_detect = np.concatenate(\
+            [np.asarray(t_closed, dtype=np.int64), t_peaks])
+        return t_spikes_detect
+        
+    def flush (self):
+        """
+        Ends the signal, closing any open run.
+        
+        Returns
+        -------
+        t_spikes_detect : ndarray
+            Time of the spike of the open run, if any
+        """
+        t_spikes_detect = np.asarray(\
+            [] if self._open_run is None else [self._open_run[0]], dtype=np.int64)
+        self._open_run = None
+        return t_spikes_detect
+
+def detect_spikes (data, threshold=None, chunk_size=None, overlap=1024):
+    """
+    Detects spikes as the peaks of runs of samples above a threshold.
+    
+    Parameters
+    ----------
+    data : ndarray
+        The signal from which to detect spikes
+
+    threshold : float
+        The threshold to use for detecting spikes. If None, a threshold
+        is estimated from the median absolute deviation of the signal.
+        
+    chunk_size : int
+        If given, the signal is processed in chunks of this many samples,
+        see iter_detect_spikes
+        
+    overlap : int
+        Number of samples of overlap between chunks
         
     Returns
     -------
@@ -47,29 +322,274 @@ def detect_spikes (data, threshold=None):
         Times of detect spikes
     
     """
-    import numpy as np
-    import statsmodels.robust.scale
+    if chunk_size is not None:
+        t_spikes_detect = np.concatenate(\
+            [np.empty(0, dtype=np.int64)] + \
+            list(iter_detect_spikes(data, threshold, chunk_size, overlap)))
+        return t_spikes_detect
+    
+    data = np.asarray(data)
+    if threshold is None:
+        threshold = estimate_threshold(data)
+
+    run_start, run_end = threshold_runs(data, threshold)
+    t_spikes_detect = run_peaks(data, run_start, run_end)
+    return t_spikes_detect
+
+def alignable (t_spikes, n_samples, samples_before, samples_after):
+    """
+    Finds the spikes whose waveforms lie inside the signal after
+    alignment, which moves a spike by up to max(samples_before,
+    samples_after) samples, see features.raw.adjust_spike_times
+
+    Parameters
+    ----------
+    t_spikes : ndarray
+        Times of spikes
+
+    n_samples : int
+        Number of samples in the signal
+
+    samples_before, samples_after : int
+        Numbers of samples before and after the peak in a waveform
+
+    Returns
+    -------
+    inside : ndarray
+        Boolean mask of the spikes that can be aligned and extracted
+    """
+    margin = max(samples_before, samples_after)
+    return (t_spikes >= samples_before + margin) & \
+        (t_spikes + margin + samples_after <= n_samples)
+
+class MTEODetector:
+    """
+    Detects spikes in a signal arriving in consecutive buffers as the
+    peaks of runs of its multi resolution Teager energy above a threshold.
+    The energy is computed chunk by chunk by features.diff.StreamingMTEO,
+    and its peaks found by a ThresholdDetector.
+    
+    The smoothing of the energy delays its peaks by about 2k samples from
+    those of the spikes, which extract_waveforms corrects when aligning
+    waveforms.
+    
+    Parameters
+    ----------
+    k_values : ndarray
+        The values of k to use for estimating MTEO
+        
+    threshold : float
+        The threshold on the energy, which is normalized by its variance.
+        If None, it is estimated from the median absolute deviation of the
+        energy of the first training_size samples.
+        
+    variance : ndarray
+        Variance of the energy for each value of k, as for StreamingMTEO.
+        If None, it is computed from the first training_size samples.
+        
+    training_size : int
+        Number of samples of the training segment from which the variance
+        and threshold are estimated, which are held back until then. The
+        spikes detected thus do not depend on the sizes of the buffers.
+    """
+    def __init__ (self, k_values=(1, 3, 5), threshold=None, variance=None, \
+                  training_size=2**20):
+        self.operator = StreamingMTEO(k_values, variance, training_size)
+        self.threshold = threshold
+        self.training_size = training_size
+        self.detector = None if threshold is None else ThresholdDetector(threshold)
+        self._training = []
+        
+    def _detect (self, tem, end=False):
+        if self.detector is None:
+            self._training.append(tem)
+            n_training = sum(t.shape[0] for t in self._training)
+            if n_training == 0 or (n_training < self.training_size and not end):
+                return np.empty(0, dtype=np.int64)
+            tem = np.concatenate(self._training)
+            self._training = []
+            self.threshold = estimate_threshold(tem[:self.training_size])
+            self.detector = ThresholdDetector(self.threshold)
+        return self.detector.process(tem)
+        
+    def process (self, data):
+        """
+        Detects spikes in the next buffer of the signal, see
+        ThresholdDetector.process
+        """
+        return self._detect(self.operator.process(data))
+        
+    def flush (self):
+        """
+        Detects spikes in the last samples of the signal and closes a run
+        still open
+        """
+        t_spikes_detect = self._detect(self.operator.flush(), end=True)
+        if self.detector is None:
+            return t_spikes_detect
+        return np.concatenate([t_spikes_detect, self.detector.flush()])
+
+def detect_spikes_mteo (data, k_values=(1, 3, 5), threshold=None, \
+                        chunk_size=2**20, training_size=2**20):
+    """
+    Detects spikes as the peaks of the multi resolution Teager energy of
+    the signal above a threshold, processing the signal in chunks.
+    
+    Parameters
+    ----------
+    data : ndarray
+        The signal from which to detect spikes
+        
+    k_values : ndarray
+        The values of k to use for estimating MTEO
+        
+    threshold : float
+        The threshold on the energy. If None, it is estimated from the
+        training segment, see MTEODetector.
+        
+    chunk_size : int
+        Number of samples processed at a time
+        
+    training_size : int
+        Number of samples at the start of the signal from which the
+        variance of the energy and the threshold are estimated
+        
+    Returns
+    -------
+    t_spikes_detect : ndarray
+        Times of detected spikes
+    """
+    detector = MTEODetector(k_values, threshold, training_size=training_size)
+    t_spikes_detect = [np.empty(0, dtype=np.int64)]
+    for start in range(0, data.shape[0], chunk_size):
+        t_spikes_detect.append(detector.process(data[start:start + chunk_size]))
+    t_spikes_detect.append(detector.flush())
+    return np.concatenate(t_spikes_detect)
 
-    if threshold == None:
-        # Default threshold assuming a normal distribution
-        # sigmaN = np.median(np.abs(data))/0.6745
-        mad = 1.4826 * statsmodels.robust.scale.mad(np.abs(data))
-        threshold = 3.38 * mad
-
-    index_cross_threshold = np.where(data > threshold)[0]
-
-    t_spikes_detect = []
-    i = 0
-    while i <= len(index_cross_threshold)-1:
-        j = i
-        while (index_cross_threshold[j+1] - index_cross_threshold[j] == 1):
-            j = j+1
-            if j >= len(index_cross_threshold)-1:
-                break
-        t = index_cross_threshold[i] + \
-            np.argmax(recording[index_cross_threshold[i]:index_cross_threshold[j]+1])
-        i = j+1
-        
-        t_spikes_detect.append(t)
-    return np.asarray(t_spikes_detect)
+SPIKE_TABLE_DTYPE = np.dtype([\
+    ('t', np.int64), ('channel', np.int32), ('amplitude', np.float64)])
 
+def merge_detections (spike_table, window):
+    """
+    Merges detections of the same spike on several channels, by non
+    maximum suppression: going through the detections in order of
+    decreasing amplitude, each detection not yet suppressed is kept and
+    suppresses the detections within window samples of it. Among equal
+    amplitudes the earliest detection comes first.
+    
+    Parameters
+    ----------
+    spike_table : ndarray
+        Detections sorted by time, as returned by
+        detect_spikes_multichannel
+        
+    window : int
+        Detections less than or this many samples apart, on any channels,
+        are taken to be the same spike
+        
+    Returns
+    -------
+    spike_table : ndarray
+        The detections kept, sorted by time
+    """
+    n_spikes = spike_table.shape[0]
+    if n_spikes == 0:
+        return spike_table
+    t = spike_table['t']
+    
+    # Unique rank of each detection, higher for larger amplitude and then
+    # for earlier time
+    rank = np.empty(n_spikes, dtype=np.intp)
+    rank[np.lexsort((-np.arange(n_spikes), spike_table['amplitude']))] = \
+        np.arange(n_spikes)
+    
+    # Bounds of the window of each detection, interleaved for reduceat; the
+    # gaps between the windows are reduced as well and discarded
+    window_start = np.searchsorted(t, t - window, side='left')
+    window_stop = np.searchsorted(t, t + window, side='right')
+    bounds = np.empty(2 * n_spikes, dtype=np.intp)
+    bounds[0::2] = window_start
+    bounds[1::2] = window_stop
+    
+    # In each round, the undecided detections of highest rank within their
+    # windows are kept, as every detection ranked above them there has
+    # been suppressed, and suppress the undecided ones in their windows.
+    # This gives the same result as going through the detections one by
+    # one, in few rounds.
+    kept = np.zeros(n_spikes, dtype=bool)
+    undecided = np.ones(n_spikes, dtype=bool)
+    rank_undecided = np.empty(n_spikes + 1, dtype=np.intp)
+    rank_undecided[-1] = -1
+    while np.any(undecided):
+        rank_undecided[:-1] = np.where(undecided, rank, -1)
+        rank_max = np.maximum.reduceat(rank_undecided, bounds)[0::2]
+        new = undecided & (rank == rank_max)
+        kept |= new
+        cover = np.cumsum(np.bincount(window_start[new], minlength=n_spikes + 1) - \
+            np.bincount(window_stop[new], minlength=n_spikes + 1))[:n_spikes]
+        undecided &= cover == 0
+    return spike_table[kept]
+
+def detect_spikes_multichannel (data, threshold=None, chunk_size=None, \
+                                overlap=1024, n_jobs=None, merge_window=None):
+    """
+    Detects spikes on each channel of a multichannel signal, the channels
+    being processed in parallel on a thread pool.
+    
+    Parameters
+    ----------
+    data : ndarray
+        The signals from which to detect spikes, of shape
+        (n_channels, n_samples)
+        
+    threshold : float or ndarray
+        The threshold to use for detecting spikes, either common to all
+        channels or one per channel. If None, a threshold is estimated for
+        each channel.
+        
+    chunk_size : int
+        If given, each channel is processed in chunks of this many samples
+        
+    overlap : int
+        Number of samples of overlap between chunks
+        
+    n_jobs : int
+        Number of threads to use, default as many as available CPUs
+        
+    merge_window : int
+        If given, a spike crossing the threshold on several channels within
+        this many samples is kept once, on the channel of largest
+        amplitude, see merge_detections
+        
+    Returns
+    -------
+    spike_table : ndarray
+        Structured array with fields 't' (time of the spike), 'channel'
+        (channel on which it was detected) and 'amplitude' (value of the
+        signal at the peak), sorted by time and then channel
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    n_channels = data.shape[0]
+    if threshold is None or np.isscalar(threshold):
+        thresholds = [threshold] * n_channels
+    else:
+        thresholds = threshold
+    
+    def detect_channel (c):
+        # NumPy releases the GIL in the array operations of the detector
+        t_spikes_detect = detect_spikes(data[c], thresholds[c], chunk_size, overlap)
+        return t_spikes_detect, np.asarray(data[c][t_spikes_detect])
+    
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        detected = list(executor.map(detect_channel, range(n_channels)))
+        
+    n_spikes = [t.shape[0] for t, _ in detected]
+    spike_table = np.empty(sum(n_spikes), dtype=SPIKE_TABLE_DTYPE)
+    spike_table['t'] = np.concatenate([np.empty(0, np.int64)] + [t for t, _ in detected])
+    spike_table['channel'] = np.repeat(np.arange(n_channels), n_spikes)
+    spike_table['amplitude'] = np.concatenate([np.empty(0)] + [a for _, a in detected])
+    spike_table = spike_table[np.lexsort((spike_table['channel'], spike_table['t']))]
+    if merge_window is not None:
+        spike_table = merge_detections(spike_table, merge_window)
+    return spike_table
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ${FILENAME}
+#  
+#  Copyright 2015 Anupam Mitra <anupam.mitra@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+import json
+import os
+
+import numpy as np
+
+SCHEMA_FILENAME = 'schema.json'
+TIME_ORDER_FILENAME = 't.order'
+
+class SpikeStore:
+    """
+    Columnar on disk table of spikes, stored in a directory with one raw
+    array file per column and a JSON schema giving the type and per spike
+    shape of each column and the number of spikes. Spikes may be appended,
+    for instance while streaming, and columns are read back as memory maps,
+    so only the columns and time windows used are read from disk.
+    
+    The columns written by save_sorting are 't' (spike time in samples),
+    'channel', 'amplitude', 'waveform', 'features' and 'label', but any
+    names may be used.
+    
+    Parameters
+    ----------
+    path : str
+        Directory of the store, created if missing
+        
+    mode : str
+        'r' to only read, 'a' to read and append
+    """
+    def __init__ (self, path, mode='a'):
+        if mode not in ('r', 'a'):
+            raise ValueError("Mode must be 'r' or 'a'")
+        self.path = path
+        self.mode = mode
+        self._time_order = None
+        schema_path = os.path.join(path, SCHEMA_FILENAME)
+        if os.path.exists(schema_path):
+            with open(schema_path) as f:
+                schema = json.load(f)
+            self.columns = dict((name, (np.dtype(c['dtype']), tuple(c['shape']))) \
+                for name, c in schema['columns'].items())
+            self.n_rows = schema['n_rows']
+            self.time_sorted = schema['time_sorted']
+            if mode == 'a':
+                # Drop rows partially written by an interrupted append, and
+                # create the files of columns defined without rows
+                for name in self.columns:
+                    with open(self._column_path(name), 'ab') as f:
+                        f.truncate(self.n_rows * self._row_bytes(name))
+        elif mode == 'r':
+            raise IOError('No spike store at %s' % path)
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.columns = {}
+            self.n_rows = 0
+            self.time_sorted = True
+            self._write_schema()
+            
+    def __len__ (self):
+        return self.n_rows
+        
+    def _column_path (self, name):
+        return os.path.join(self.path, name + '.bin')
+        
+    def _row_bytes (self, name):
+        dtype, shape = self.columns[name]
+        return dtype.itemsize * int(np.prod(shape, dtype=np.int64))
+        
+    def _write_schema (self):
+        schema = {\
+            'columns': dict((name, {'dtype': dtype.str, 'shape': list(shape)}) \
+                for name, (dtype, shape) in self.columns.items()), \
+            'n_rows': self.n_rows, 'time_sorted': self.time_sorted}
+        schema_path = os.path.join(self.path, SCHEMA_FILENAME)
+        with open(schema_path + '.tmp', 'w') as f:
+            json.dump(schema, f, indent=1)
+        os.replace(schema_path + '.tmp', schema_path)
+        
+    def _check_writable (self):
+        if self.mode != 'a':
+            raise IOError('Spike store opened read only')
+        
+    def append (self, **columns):
+        """
+        Appends spikes. The first append defines the columns. Later appends
+        must give every column.
+        
+        Parameters
+        ----------
+        columns : ndarray
+            Values of each column for the new spikes, with the spikes along
+            the first axis, as in store.append(t=t_spikes, label=labels)
+        """
+        self._check_writable()
+        columns = dict((name, np.asarray(values)) for name, values in columns.items())
+        if not columns:
+            return
+        n_new = set(values.shape[0] for values in columns.values())
+        if len(n_new) != 1:
+            raise ValueError('Columns have different numbers of spikes')
+        n_new = n_new.pop()
+        
+        if not self.columns:
+            self.columns = dict((name, (values.dtype, values.shape[1:])) \
+                for name, values in columns.items())
+            for name in self.columns:
+                open(self._column_path(name), 'ab').close()
+        elif set(columns) != set(self.columns):
+            raise ValueError('Columns %s must all be appended' % sorted(self.columns))
+        for name, values in columns.items():
+            if values.shape[1:] != self.columns[name][1]:
+                raise ValueError('Column %s has shape %s per spike, not %s' % \
+                    (name, values.shape[1:], self.columns[name][1]))
+        if n_new == 0:
+            self._write_schema()
+            return
+        
+        if 't' in columns:
+            t = columns['t']
+            last_t = self.column('t')[-1] if self.n_rows > 0 else None
+            if np.any(np.diff(t) < 0) or (last_t is not None and t[0] < last_t):
+                self.time_sorted = False
+            self._discard_time_order()
+            
+        for name, values in columns.items():
+            with open(self._column_path(name), 'ab') as f:
+                f.write(np.ascontiguousarray(values, dtype=self.columns[name][0]).data)
+        self.n_rows += n_new
+        self._write_schema()
+        
+    def write_column (self, name, values):
+        """
+        Writes or replaces a whole column, for instance cluster labels
+        computed after all spikes were appended.
+        
+        Parameters
+        ----------
+        name : str
+            Name of the column
+            
+        values : ndarray
+            Values for every spike in the store
+        """
+        self._check_writable()
+        values = np.asarray(values)
+        if self.columns and values.shape[0] != self.n_rows:
+            raise ValueError('Column %s has %d spikes, the store has %d' % \
+                (name, values.shape[0], self.n_rows))
+        path = self._column_path(name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(np.ascontiguousarray(values).data)
+        os.replace(path + '.tmp', path)
+        if not self.columns:
+            self.n_rows = values.shape[0]
+        self.columns[name] = (values.dtype, values.shape[1:])
+        if name == 't':
+            self.time_sorted = bool(np.all(np.diff(values) >= 0))
+            self._discard_time_order()
+        self._write_schema()
+        
+    def column (self, name):
+        """
+        Returns a column as a read only memory map, of shape
+        (n_spikes,) + shape per spike
+        """
+        dtype, shape = self.columns[name]
+        if self.n_rows == 0:
+            return np.empty((0,) + shape, dtype=dtype)
+        return np.memmap(self._column_path(name), dtype=dtype, mode='r', \
+            shape=(self.n_rows,) + shape)
+        
+    def _discard_time_order (self):
+        self._time_order = None
+        path = os.path.join(self.path, TIME_ORDER_FILENAME)
+        if os.path.exists(path):
+            os.remove(path)
+            
+    def time_order (self):
+        """
+        Returns the indices of the spikes in order of time. When spikes were
+        appended in order of time this is None. Otherwise the order is
+        computed once and stored next to the columns.
+        """
+        if self.time_sorted:
+            return None
+        if self._time_order is None:
+            path = os.path.join(self.path, TIME_ORDER_FILENAME)
+            if os.path.exists(path):
+                self._time_order = np.memmap(path, dtype=np.int64, mode='r')
+            else:
+                order = np.argsort(self.column('t'), kind='stable').astype(np.int64)
+                if self.mode == 'a':
+                    order.tofile(path)
+                self._time_order = order
+        return self._time_order
+        
+    def time_range (self, t_start=None, t_stop=None):
+        """
+        Finds the spikes with t_start <= t < t_stop.
+        
+        Returns
+        -------
+        index : slice or ndarray
+            A slice of the rows when spikes are stored in order of time,
+            otherwise the indices of the rows in order of time
+        """
+        t = self.column('t')
+        order = self.time_order()
+        t_sorted = t if order is None else _Permuted(t, order)
+        start = 0 if t_start is None else _searchsorted(t_sorted, t_start, len(t))
+        stop = len(t) if t_stop is None else _searchsorted(t_sorted, t_stop, len(t))
+        if order is None:
+            return slice(start, stop)
+        return np.asarray(order[start:stop])
+        
+    def read (self, columns=None, t_start=None, t_stop=None):
+        """
+        Reads columns of the spikes with t_start <= t < t_stop.
+        
+        Parameters
+        ----------
+        columns : list
+            Names of the columns to read, all if None
+            
+        t_start, t_stop : int
+            Time window in samples. If both are None, all spikes are read.
+            
+        Returns
+        -------
+        table : dict
+            Array of each column. These are memory maps when spikes are
+            stored in order of time, otherwise copies in order of time.
+        """
+        if columns is None:
+            columns = list(self.columns)
+        if t_start is None and t_stop is None:
+            index = slice(None)
+        else:
+            index = self.time_range(t_start, t_stop)
+        return dict((name, self.column(name)[index]) for name in columns)
+
+class _Permuted:
+    # Sequence view of a column in a given order, for bisection
+    def __init__ (self, values, order):
+        self.values = values
+        self.order = order
+        
+    def __getitem__ (self, i):
+        return self.values[self.order[i]]
+
+def _searchsorted (t_sorted, value, n):
+    if isinstance(t_sorted, np.ndarray):
+        return int(np.searchsorted(t_sorted, value, side='left'))
+    low, high = 0, n
+    while low < high:
+        middle = (low + high) // 2
+        if t_sorted[middle] < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+def save_sorting (sorting, path):
+    """
+    Writes the spikes of a SpikeSorting, after spike_sorting, to a new
+    SpikeStore. A later run can reuse the detection by setting
+    recording.t_spikes (and spike_channels) from the 't' (and 'channel')
+    columns.
+    
+    Parameters
+    ----------
+    sorting : SpikeSorting
+        The spike sorting
+        
+    path : str
+        Directory of the store
+        
+    Returns
+    -------
+    store : SpikeStore
+        The store
+    """
+    recording = sorting.recording
+    spike_features = sorting.spike_features
+    t = np.asarray(recording.t_spikes, dtype=np.int64)
+    channel = getattr(recording, 'spike_channels', None)
+    if channel is None:
+        channel = np.zeros(t.shape[0], dtype=np.int32)
+    channel = np.asarray(channel, dtype=np.int32)
+    # The amplitude is taken at the peak the waveforms were aligned to,
+    # samples_before samples into each waveform, already in physical units
+    spike_waveforms = spike_features.spike_waveforms
+    if spike_waveforms.ndim > 2:
+        amplitude = spike_waveforms[np.arange(t.shape[0]), channel, \
+            spike_features.samples_before]
+    else:
+        amplitude = spike_waveforms[:, spike_features.samples_before]
+    amplitude = np.asarray(amplitude, dtype=np.float64)
+    
+    store = SpikeStore(path, mode='a')
+    if len(store) > 0:
+        raise IOError('Spike store at %s is not empty' % path)
+    store.append(t=t, channel=channel, amplitude=amplitude, \
+        waveform=spike_waveforms, \
+        features=spike_features.features_selected, \
+        label=np.asarray(sorting.clustering.spike_class_est))
+    return store
+
+__all__ = ["SpikeStore", "save_sorting"]
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ${FILENAME}
+#  
+#  Copyright 2015 Anupam Mitra <anupam.mitra@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+
+import itertools
+import shutil
+import tempfile
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from .store import SpikeStore
+
+RESULT_COLUMNS = [\
+    'filename', 'feature_extraction', 'feature_selection', 'n_features', \
+    'feature_clustering', 'n_spikes', 'ami', 'ari', \
+    't_waveforms', 't_features', 't_selection', 't_clustering', 'error']
+
+# Strings are stored at fixed widths, longer error messages are cut short.
+# Missing values are stored as nan, -1 and the empty string.
+RESULT_DTYPES = {\
+    'filename': 'U256', 'feature_extraction': 'U16', 'feature_selection': 'U16', \
+    'n_features': np.int64, 'feature_clustering': 'U32', 'n_spikes': np.int64, \
+    'ami': np.float64, 'ari': np.float64, 't_waveforms': np.float64, \
+    't_features': np.float64, 't_selection': np.float64, \
+    't_clustering': np.float64, 'error': 'U512'}
+
+KEY_COLUMNS = RESULT_COLUMNS[:5]
+
+def read_recording (dataset, filename, datadir):
+    """
+    Reads a recording of one of the datasets supported by the datasets
+    package.
+    
+    Parameters
+    ----------
+    dataset : str
+        The dataset, 'waveclus' or 'cpgjnm'
+        
+    filename : str
+        The name of the file to read
+        
+    datadir : str
+        The directory where the file is present
+    """
+    import datasets.index
+    return datasets.index.DATASETS[dataset].read_file(filename, datadir)
+
+def _result_key (row):
+    return tuple(str(row[c]) for c in KEY_COLUMNS)
+
+def _result_columns (rows):
+    columns = {}
+    for name in RESULT_COLUMNS:
+        dtype = np.dtype(RESULT_DTYPES[name])
+        missing = {'U': '', 'f': np.nan}.get(dtype.kind, -1)
+        columns[name] = np.array([missing if row.get(name) is None \
+            else row[name] for row in rows], dtype=dtype)
+    return columns
+
+def _error_text ():
+    return traceback.format_exc(limit=1).strip().replace('\n', ' | ')
+
+def _pending (done, filename, feature_extraction, feature_selection, \
+              n_features_list, feature_clusterings):
+    return [(n, c) for n, c in \
+        itertools.product(n_features_list, feature_clusterings) \
+        if _result_key(dict(filename=filename, \
+            feature_extraction=feature_extraction, \
+            feature_selection=feature_selection, \
+            n_features=n, feature_clustering=c)) not in done]
+
+def prepare_recording (dataset, datadir, filename, feature_extractions, \
+                       cache_dir, samples_before=20, samples_after=44):
+    """
+    First step of the sweep of a recording, on which the runs of
+    run_selection depend. The recording is read, its waveforms extracted
+    and the features of all extraction methods computed together into one
+    FeatureBlock, and all of these are stored in the FeatureCache.
+    
+    Parameters
+    ----------
+    dataset : str
+        The dataset, 'waveclus' or 'cpgjnm'
+        
+    datadir : str
+        The directory where the file is present
+        
+    filename : str
+        The name of the file to read
+        
+    feature_extractions : list
+        Techniques to use for extraction of spike features
+        
+    cache_dir : str
+        Directory of the FeatureCache shared with run_selection
+        
+    samples_before : int
+        Number of samples before the peak of a spike to include
+        
+    samples_after : int
+        Number of samples after the peak of a spike to include
+        
+    Returns
+    -------
+    prepared : dict
+        n_spikes, t_waveforms, t_features, the time taken to compute the
+        features of all extraction methods together, and errors, the error
+        message of each extraction method that failed
+    """
+    from . import features
+    from .cache import FeatureCache
+    
+    prepared = {'errors': {}}
+    try:
+        recording = read_recording(dataset, filename, datadir)
+        
+        t = time.perf_counter()
+        spike_features = features.SpikeFeatures(recording, \
+            feature_extractions[0], None, samples_before, samples_after, \
+            cache=FeatureCache(cache_dir))
+        prepared['t_waveforms'] = time.perf_counter() - t
+        prepared['n_spikes'] = spike_features.spike_waveforms.shape[0]
+        
+        # Unknown methods are left out of the block, and fail on their own
+        # in extract_features below
+        t = time.perf_counter()
+        spike_features.extract_feature_block(\
+            [f for f in feature_extractions \
+                if f.lower() in features.FEATURE_FAMILIES])
+        prepared['t_features'] = time.perf_counter() - t
+    except Exception:
+        error = _error_text()
+        prepared['errors'] = dict((f, error) for f in feature_extractions)
+        return prepared
+    
+    for feature_extraction in feature_extractions:
+        try:
+            spike_features.feature_extraction = feature_extraction
+            spike_features.extract_features()
+        except Exception:
+            prepared['errors'][feature_extraction] = _error_text()
+    return prepared
+
+def run_selection (dataset, datadir, filename, feature_extraction, \
+                   feature_selection, configurations, cache_dir, \
+                   samples_before=20, samples_after=44):
+    """
+    Ranks the features of one extraction method of a recording with one
+    selection method, once, and clusters the top features for each number
+    of features and clustering method. The waveforms and features are
+    read from the FeatureCache filled by prepare_recording. The recording
+    is read again for its ground truth.
+    
+    Parameters
+    ----------
+    dataset, datadir, filename :
+        The recording, see prepare_recording
+        
+    feature_extraction : str
+        Technique to use for extraction of spike features
+        
+    feature_selection : str
+        Technique to use for selection of spike features
+        
+    configurations : list
+        Pairs of the number of features and clustering algorithm to run
+        
+    cache_dir : str
+        Directory of the FeatureCache filled by prepare_recording
+        
+    samples_before, samples_after : int
+        As given to prepare_recording
+        
+    Returns
+    -------
+    rows : list
+        One dict of results per configuration, with the columns of
+        RESULT_COLUMNS except n_spikes, t_waveforms and t_features
+    """
+    from . import cluster, features
+    from .cache import FeatureCache
+    
+    base = {'filename': filename, 'feature_extraction': feature_extraction, \
+        'feature_selection': feature_selection}
+    try:
+        recording = read_recording(dataset, filename, datadir)
+        spike_features = features.SpikeFeatures(recording, \
+            feature_extraction, feature_selection, samples_before, \
+            samples_after, cache=FeatureCache(cache_dir))
+        spike_features.extract_features()
+        
+        t = time.perf_counter()
+        spike_features.select_features(max(n for n, _ in configurations))
+        t_selection = time.perf_counter() - t
+    except Exception:
+        error = _error_text()
+        return [dict(base, n_features=n_features, \
+            feature_clustering=feature_clustering, error=error) \
+            for n_features, feature_clustering in configurations]
+    
+    rows = []
+    for n_features, feature_clustering in configurations:
+        row = dict(base, n_features=n_features, \
+            feature_clustering=feature_clustering, t_selection=t_selection)
+        try:
+            t = time.perf_counter()
+            clustering = cluster.SpikeFeatureClustering(\
+                recording, spike_features, n_features, feature_clustering)
+            clustering.cluster_spike_features()
+            row.update(ami=clustering.ami, ari=clustering.ari, \
+                t_clustering=time.perf_counter() - t)
+        except Exception:
+            row['error'] = _error_text()
+        rows.append(row)
+    return rows
+
+class ParameterSweep:
+    """
+    Sweep over spike sorting configurations, the grid of feature
+    extraction x feature selection x number of features x clustering
+    methods, over the files of a dataset, run on a process pool as a task
+    graph. Each recording is read, and its waveforms and features of all
+    extraction methods computed, once by prepare_recording. The rankings
+    of each extraction and selection method then run as separate tasks
+    of run_selection, each followed by its clusterings. Results are
+    appended to a SpikeStore as each task completes, and a sweep which is
+    interrupted resumes from it, skipping completed configurations.
+    
+    Parameters
+    ----------
+    dataset: str
+        The dataset, 'waveclus' or 'cpgjnm'
+        
+    datadir: str
+        The directory where the files of the dataset are present
+        
+    results_path: str
+        Directory of the SpikeStore of results, with one row per
+        configuration and the columns of RESULT_COLUMNS. Read it back with
+        SpikeStore(results_path, 'r').read().
+        
+    filenames: list
+        Names of the files to sweep over. If None, all files of the dataset
+        in datadir are used.
+        
+    feature_extractions: list
+        Techniques to use for extraction of spike features
+        
+    feature_selections: list
+        Techniques to use for selection of spike features
+        
+    n_features_list: list
+        Numbers of features to use for clustering
+        
+    feature_clusterings: list
+        Clustering algorithms to use
+        
+    n_jobs: int
+        Number of worker processes, default as many as available CPUs
+        
+    cache_dir: str
+        Directory of the FeatureCache of waveforms and features, through
+        which the tasks of a recording share them, kept so that a resumed
+        sweep does not extract them again. If None, a temporary directory
+        is used for the duration of the sweep.
+    """
+    def __init__ (self, dataset, datadir, results_path, filenames=None, \
+                  feature_extractions=('raw', 'hw', 'fsd', 'fdl'), \
+                  feature_selections=('var', 'lt', 'pca'), \
+                  n_features_list=(2, 3, 5, 8, 10), \
+                  feature_clusterings=('kMeans',), n_jobs=None, \
+                  cache_dir=None, samples_before=20, samples_after=44):
+        self.dataset = dataset
+        self.datadir = datadir
+        self.results_path = results_path
+        self.filenames = filenames
+        self.feature_extractions = list(feature_extractions)
+        self.feature_selections = list(feature_selections)
+        self.n_features_list = list(n_features_list)
+        self.feature_clusterings = list(feature_clusterings)
+        self.n_jobs = n_jobs
+        self.cache_dir = cache_dir
+        self.samples_before = samples_before
+        self.samples_after = samples_after
+        
+    def completed (self):
+        """
+        Keys of the configurations already completed without error,
+        including those of recordings without ground truth, whose ami and
+        ari are missing
+        """
+        try:
+            store = SpikeStore(self.results_path, mode='r')
+        except IOError:
+            return set()
+        if len(store) == 0:
+            return set()
+        results = store.read(KEY_COLUMNS + ['error'])
+        return set(_result_key(dict((c, results[c][i]) for c in KEY_COLUMNS)) \
+            for i in np.flatnonzero(results['error'] == ''))
+        
+    def pending (self, done, filename, feature_extraction, feature_selection):
+        """
+        Pairs of the number of features and clustering algorithm still to
+        run for a file, extraction and selection method
+        """
+        return _pending(done, filename, feature_extraction, feature_selection, \
+            self.n_features_list, self.feature_clusterings)
+        
+    def tasks (self, done=()):
+        """
+        Groups of configurations, by file, which still have configurations
+        to run, as pairs of the file and its feature extraction methods
+        with configurations to run
+        """
+        if self.filenames is None:
+            import datasets.index
+            filenames = datasets.index.DATASETS[self.dataset].list_files(self.datadir)
+        else:
+            filenames = self.filenames
+            
+        tasks = []
+        for filename in filenames:
+            feature_extractions = [f for f in self.feature_extractions \
+                if any(self.pending(done, filename, f, s) \
+                    for s in self.feature_selections)]
+            if feature_extractions:
+                tasks.append((filename, feature_extractions))
+        return tasks
+        
+    def run (self):
+        """
+        Runs the configurations not yet completed.
+        
+        Returns
+        -------
+        n_rows : int
+            Number of result rows written
+        """
+        done = self.completed()
+        tasks = self.tasks(done)
+        if not tasks:
+            return 0
+        
+        cache_dir = self.cache_dir
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp(prefix='spikesort_sweep_')
+            
+        store = SpikeStore(self.results_path, mode='a')
+        n_rows = 0
+        try:
+            with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+                # Maps each running task to its file, and for the tasks of
+                # run_selection to the result of prepare_recording
+                running = {}
+                for filename, feature_extractions in tasks:
+                    future = executor.submit(prepare_recording, self.dataset, \
+                        self.datadir, filename, feature_extractions, cache_dir, \
+                        self.samples_before, self.samples_after)
+                    running[future] = (filename, feature_extractions, None)
+                    
+                while running:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        filename, feature_extractions, prepared = running.pop(future)
+                        if prepared is not None:
+                            rows = [dict(row, n_spikes=prepared['n_spikes'], \
+                                t_waveforms=prepared['t_waveforms'], \
+                                t_features=prepared['t_features']) \
+                                for row in future.result()]
+                        else:
+                            prepared = future.result()
+                            rows = []
+                            for feature_extraction, feature_selection in \
+                                    itertools.product(feature_extractions, \
+                                        self.feature_selections):
+                                configurations = self.pending(done, filename, \
+                                    feature_extraction, feature_selection)
+                                if not configurations:
+                                    continue
+                                error = prepared['errors'].get(feature_extraction)
+                                if error is not None:
+                                    rows += [dict(filename=filename, \
+                                        feature_extraction=feature_extraction, \
+                                        feature_selection=feature_selection, \
+                                        n_features=n, feature_clustering=c, \
+                                        error=error) for n, c in configurations]
+                                    continue
+                                running[executor.submit(run_selection, \
+                                    self.dataset, self.datadir, filename, \
+                                    feature_extraction, feature_selection, \
+                                    configurations, cache_dir, \
+                                    self.samples_before, self.samples_after)] = \
+                                    (filename, [feature_extraction], prepared)
+                        if rows:
+                            # Written as each task completes, so that an
+                            # interrupted sweep loses at most the running tasks
+                            store.append(**_result_columns(rows))
+                            n_rows += len(rows)
+        finally:
+            if self.cache_dir is None:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+        return n_rows
+
+__all__ = ["ParameterSweep", "prepare_recording", "run_selection", "RESULT_COLUMNS"]